@@ -0,0 +1,237 @@
+"""Precomputed field aggregates for context-unaware requests.
+
+Without a context, the stats and distribution of a field are the same for
+every user, yet each page load recomputes the MIN/MAX/AVG or GROUP BY over
+the whole table. The `precompute_field_aggregates` command stores them as
+`FieldAggregate` rows after each data load and the stats and distribution
+resources serve them while the field's `data_modified` is unchanged. The
+live queries are still used for context-aware requests.
+"""
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q, Min, Max, Avg, Count
+from django.utils.datastructures import SortedDict
+from avocado.models import DataField
+from avocado.query import pipeline
+from modeltree.tree import trees
+from serrano.models import FieldAggregate
+
+# Percentiles stored with the stats of numeric fields
+PERCENTILES = (25, 50, 75)
+
+
+def compute_stats(instance, queryset):
+    "Returns the stats of the field `instance` over `queryset`."
+    if instance.simple_type == 'number':
+        # Since the call to max() returns an Aggregator object with the
+        # queryset stored internally, we don't pass the queryset to min()
+        # or avg() like we do when we call max() which is called on the
+        # instance itself not on an Aggregator like min() or avg() are
+        # called on.
+        stats = instance.max(queryset=queryset).min().avg()
+    elif instance.simple_type in ('date', 'time', 'datetime'):
+        stats = instance.max(queryset=queryset).min()
+    else:
+        stats = instance.count(queryset=queryset, distinct=True)
+
+    if stats is None:
+        return {}
+
+    try:
+        return next(iter(stats))
+    except StopIteration:
+        return {}
+
+
+def stats_aggregates(instance):
+    "Returns the names and aggregates of the stats of the field `instance`."
+    name = instance.field_name
+
+    if instance.simple_type == 'number':
+        return [('max', Max(name)), ('min', Min(name)), ('avg', Avg(name))]
+
+    if instance.simple_type in ('date', 'time', 'datetime'):
+        return [('max', Max(name)), ('min', Min(name))]
+
+    return [('count', Count(name, distinct=True))]
+
+
+def compute_bulk_stats(fields, queryset):
+    """Returns the stats of several fields of the same model over
+    `queryset`, keyed by field pk.
+
+    All stats are computed with a single aggregate query, so the table is
+    scanned once rather than once per field.
+    """
+    aggregates = SortedDict()
+    names = []
+
+    for instance in fields:
+        for stat, aggregate in stats_aggregates(instance):
+            alias = 'f{0}_{1}'.format(instance.pk, stat)
+            aggregates[alias] = aggregate
+            names.append((instance.pk, stat, alias))
+
+    if not aggregates:
+        return {}
+
+    row = queryset.aggregate(**aggregates)
+    stats = dict((instance.pk, {}) for instance in fields)
+
+    for pk, stat, alias in names:
+        stats[pk][stat] = row[alias]
+
+    return stats
+
+
+def compute_percentiles(instance, queryset, ranks=PERCENTILES):
+    """Returns the nearest-rank percentiles of the field's non-null values,
+    keyed by rank.
+    """
+    lookup = instance.field_name
+    values = queryset.exclude(**{'{0}__isnull'.format(lookup): True})\
+        .order_by(lookup).values_list(lookup, flat=True)
+
+    count = values.count()
+
+    if not count:
+        return {}
+
+    return dict((str(rank), values[int(round(rank / 100.0 * (count - 1)))])
+                for rank in ranks)
+
+
+def tree_field(tree):
+    "Returns a DataField of the primary key of the root model of `tree`."
+    opts = tree.root_model._meta
+
+    return DataField(pk='{0}:{1}'.format(opts.db_table, opts.pk.name),
+                     app_name=opts.app_label,
+                     model_name=opts.module_name,
+                     field_name=opts.pk.name)
+
+
+def compute_distribution(instance, tree, queryset):
+    """Returns the value counts of the enumerable field `instance` like the
+    default, context-unaware distribution response.
+    """
+    lookup = tree.query_string_for_field(instance.field, model=instance.model)
+
+    stats = tree_field(tree).count(lookup).apply(queryset)\
+        .exclude(Q(**{lookup: None})).order_by(lookup)
+
+    points = list(stats)
+
+    return {
+        'data': points,
+        'clustered': False,
+        'outliers': [],
+        'size': len(points),
+    }
+
+
+def precompute_field(instance, tree, max_values=None):
+    """Computes and stores the aggregates of `instance` over all records.
+
+    Value counts are only stored for enumerable, non-numeric fields with at
+    most `max_values` distinct values; numeric distributions are clustered
+    or checked for outliers per request.
+
+    Fields without a `data_modified` timestamp are skipped since there is
+    no way to tell when their aggregates become stale. Returns the
+    aggregate or None if the field was skipped.
+    """
+    if instance.data_modified is None:
+        return None
+
+    QueryProcessor = pipeline.query_processors['default']
+
+    queryset = QueryProcessor(tree=instance.model).get_queryset()
+    stats = compute_stats(instance, queryset)
+
+    if instance.simple_type == 'number':
+        stats['percentiles'] = compute_percentiles(instance, queryset)
+
+    distribution = None
+
+    if instance.enumerable and instance.simple_type != 'number':
+        queryset = QueryProcessor(tree=tree).get_queryset()
+        distribution = compute_distribution(instance, tree, queryset)
+
+        if max_values is not None and distribution['size'] > max_values:
+            distribution = None
+
+    aggregate, created = FieldAggregate.objects.get_or_create(
+        field_id=instance.pk)
+
+    aggregate.model_version_id = getattr(instance, 'model_version_id', None)
+    aggregate.data_modified = instance.data_modified
+    aggregate.stats = json.dumps(stats, cls=DjangoJSONEncoder)
+    aggregate.distribution = json.dumps(distribution, cls=DjangoJSONEncoder)\
+        if distribution is not None else ''
+    aggregate.save()
+
+    return aggregate
+
+
+def precompute_model_version(model_version_id, model_name, max_values=None):
+    """Precomputes the aggregates of every field of a model version.
+
+    Returns the number of fields whose aggregates were stored.
+    """
+    tree = trees[model_name]
+    count = 0
+
+    for instance in DataField.objects.filter(
+            model_version_id=model_version_id):
+        if precompute_field(instance, tree, max_values=max_values):
+            count += 1
+
+    return count
+
+
+def get_field_aggregate(instance):
+    """Returns the current aggregate of the field `instance` or None if
+    there is none or the field's data was modified since it was computed.
+    """
+    try:
+        aggregate = FieldAggregate.objects.get(field_id=instance.pk)
+    except FieldAggregate.DoesNotExist:
+        return None
+
+    if instance.data_modified is None or \
+            aggregate.data_modified != instance.data_modified:
+        return None
+
+    return aggregate
+
+
+def get_precomputed_stats(instance, percentiles=False):
+    """Returns the precomputed stats of `instance` or None.
+
+    The percentiles of numeric fields are only included if `percentiles`
+    is true, like the live stats.
+    """
+    aggregate = get_field_aggregate(instance)
+
+    if aggregate is None or not aggregate.stats:
+        return None
+
+    stats = json.loads(aggregate.stats)
+
+    if not percentiles:
+        stats.pop('percentiles', None)
+    elif instance.simple_type == 'number' and 'percentiles' not in stats:
+        return None
+
+    return stats
+
+
+def get_precomputed_distribution(instance):
+    "Returns the precomputed distribution of `instance` or None."
+    aggregate = get_field_aggregate(instance)
+
+    if aggregate is None or not aggregate.distribution:
+        return None
+
+    return json.loads(aggregate.distribution)
@@ -0,0 +1,427 @@
+"""Content-addressed construction and collection of composite contexts.
+
+Filters such as genomic ranges, gene lists and sample cohorts are expanded
+into trees of composite DataContext objects which are referenced by id from
+the parent context. Rather than saving each composite as it is built, the
+builder hands out references derived from the hash of the composite's
+canonical json. Once the whole tree is built, `flush` looks up the
+composites that already exist and writes the remaining ones in a single
+transaction.
+"""
+import json
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from django.db import connection, transaction
+from avocado.history.models import Revision
+from avocado.models import DataContext, DataQuery
+from serrano.models import ValueSet, ValueSetItem, RegionSet, Region
+from serrano.regions import REGION_LIST
+from serrano.valuesets import IN_SET
+
+COMPOSITE_KEYWORDS = 'composite'
+
+# Prefix of the name of content-addressed composite contexts
+DIGEST_PREFIX = 'composite:'
+
+
+def composite_language(children, logic):
+    "Returns the combined language of the composite's children."
+    language = children[0]['language']
+
+    for child in children[1:]:
+        if 'Missing' not in language or not child['language']:
+            language += ' ' + logic + ' ' + child['language']
+
+    return language
+
+
+def composite_digest(attrs, model_version_id):
+    "Returns the content address of the composite `attrs`."
+    canonical = json.dumps([model_version_id, attrs], sort_keys=True,
+                           separators=(',', ':'))
+    return DIGEST_PREFIX + hashlib.sha1(canonical).hexdigest()
+
+
+def _allocate_ids(count):
+    "Reserves `count` primary keys of the context table (PostgreSQL only)."
+    cursor = connection.cursor()
+    cursor.execute('SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                   'FROM generate_series(1, %s)',
+                   [DataContext._meta.db_table, 'id', count])
+    return [r[0] for r in cursor.fetchall()]
+
+
+class CompositeContextBuilder(object):
+    """Collects the composite contexts of a context save.
+
+    `add` returns a reference to the composite which is used in place of
+    the id in the json of the parent. Children are always added before
+    their parents, so references are already digests when the parent is
+    hashed and identical sub-trees share a single composite.
+    """
+    def __init__(self, request, model_version_id):
+        self.request = request
+        self.model_version_id = model_version_id
+        self.pending = OrderedDict()
+        self.ids = {}
+
+    def add(self, children, logic):
+        "Adds a composite and returns its reference and language."
+        attrs = {
+            'type': logic,
+            'children': children,
+        }
+
+        ref = composite_digest(attrs, self.model_version_id)
+
+        if ref not in self.pending and ref not in self.ids:
+            self.pending[ref] = attrs
+
+        return ref, composite_language(children, logic)
+
+    def get_owner(self):
+        request = self.request
+
+        if getattr(request, 'user', None) and request.user.is_authenticated():
+            return {'user': request.user}
+
+        if request.session.session_key:
+            return {'session_key': request.session.session_key}
+
+    def resolve(self, attrs):
+        "Returns a copy of `attrs` with composite references replaced by ids."
+        if isinstance(attrs, dict):
+            resolved = {}
+
+            for key, value in attrs.items():
+                if key == 'composite' and value in self.ids:
+                    resolved[key] = self.ids[value]
+                else:
+                    resolved[key] = self.resolve(value)
+
+            return resolved
+
+        if isinstance(attrs, list):
+            return [self.resolve(value) for value in attrs]
+
+        return attrs
+
+    def flush(self):
+        """Saves the pending composites that do not exist yet.
+
+        This takes one query to find existing composites and, on
+        PostgreSQL, one to reserve ids and one bulk insert. Other backends
+        save the composites one at a time, in the same transaction.
+        """
+        if not self.pending:
+            return self.ids
+
+        owner = self.get_owner()
+        refs = list(self.pending)
+
+        if owner:
+            queryset = DataContext.objects.filter(
+                model_version_id=self.model_version_id,
+                keywords=COMPOSITE_KEYWORDS,
+                name__in=refs, **owner)
+
+            # Existing composites are touched before they are read so the
+            # collector, which only deletes composites that are still
+            # stale, does not delete them before the parent is saved.
+            queryset.update(modified=datetime.now())
+
+            # If a composite was recreated, the newest one is used
+            existing = dict(queryset.order_by('pk').values_list('name', 'id'))
+
+            # A composite is only reused if the composites it references
+            # still exist; refs are ordered children first.
+            for ref in refs:
+                if ref in existing and all(
+                        child in self.ids
+                        for child in composite_refs(self.pending[ref])):
+                    self.ids[ref] = existing[ref]
+
+        missing = [ref for ref in refs if ref not in self.ids]
+
+        if missing:
+            with transaction.commit_on_success():
+                self._create(missing, owner or {})
+
+        self.pending.clear()
+
+        return self.ids
+
+    def _create(self, refs, owner):
+        def build(ref, **kwargs):
+            return DataContext(name=ref,
+                               keywords=COMPOSITE_KEYWORDS,
+                               model_version_id=self.model_version_id,
+                               json=self.resolve(self.pending[ref]),
+                               **dict(owner, **kwargs))
+
+        if connection.vendor == 'postgresql':
+            # All ids are known upfront, so parents can reference their
+            # children before either is inserted.
+            self.ids.update(zip(refs, _allocate_ids(len(refs))))
+            DataContext.objects.bulk_create([build(ref, id=self.ids[ref])
+                                             for ref in refs])
+        else:
+            # Pending composites are ordered children first
+            for ref in refs:
+                instance = build(ref)
+                instance.save()
+                self.ids[ref] = instance.pk
+
+
+def composite_refs(attrs, refs=None):
+    "Returns the set of composite references in the builder `attrs`."
+    if refs is None:
+        refs = set()
+
+    if isinstance(attrs, dict):
+        for key, value in attrs.items():
+            if key == 'composite' and isinstance(value, basestring):
+                refs.add(value)
+            else:
+                composite_refs(value, refs)
+    elif isinstance(attrs, list):
+        for value in attrs:
+            composite_refs(value, refs)
+
+    return refs
+
+
+def _load_json(value):
+    # Depending on the field implementation, values() may return the raw
+    # serialized json
+    if isinstance(value, basestring):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return None
+    return value
+
+
+def referenced_composites(attrs, refs=None):
+    "Returns the set of composite ids referenced in the context json `attrs`."
+    if refs is None:
+        refs = set()
+
+    if isinstance(attrs, dict):
+        for key, value in attrs.items():
+            if key == 'composite':
+                try:
+                    refs.add(int(value))
+                except (TypeError, ValueError):
+                    pass
+            else:
+                referenced_composites(value, refs)
+    elif isinstance(attrs, list):
+        for value in attrs:
+            referenced_composites(value, refs)
+
+    return refs
+
+
+def referenced_sets(attrs, refs):
+    """Adds the ids of the value and region sets referenced in the context
+    json `attrs` to `refs`, a dict of sets keyed by filter operator.
+    """
+    if isinstance(attrs, dict):
+        if attrs.get('operator') in refs:
+            try:
+                refs[attrs['operator']].add(int(attrs.get('value')))
+            except (TypeError, ValueError):
+                pass
+
+        for value in attrs.values():
+            referenced_sets(value, refs)
+    elif isinstance(attrs, list):
+        for value in attrs:
+            referenced_sets(value, refs)
+
+    return refs
+
+
+def composites():
+    return DataContext.objects.filter(keywords__contains=COMPOSITE_KEYWORDS)
+
+
+def _revision_json(model, key):
+    """Yields the `key` json of the stored revisions of `model`, skipping
+    revisions of composites.
+    """
+    for data in Revision.objects.get_for_model(model)\
+            .values_list('data', flat=True).iterator():
+        data = _load_json(data)
+
+        if not isinstance(data, dict):
+            continue
+
+        if COMPOSITE_KEYWORDS in (data.get('keywords') or ''):
+            continue
+
+        yield _load_json(data.get(key))
+
+
+def _root_json():
+    """Yields the json of all non-composite contexts, the contexts of
+    queries and the revisions of both kept by `avocado.history`.
+    """
+    roots = DataContext.objects.exclude(keywords__contains=COMPOSITE_KEYWORDS)
+
+    for attrs in roots.values_list('json', flat=True).iterator():
+        yield _load_json(attrs)
+
+    for attrs in DataQuery.objects.values_list('context_json', flat=True)\
+            .iterator():
+        yield _load_json(attrs)
+
+    for attrs in _revision_json(DataContext, 'json'):
+        yield attrs
+
+    for attrs in _revision_json(DataQuery, 'context_json'):
+        yield attrs
+
+
+def find_reachable_composites(batch_size=1000, since=None, sets=None):
+    """Returns the ids of composites reachable from a live context tree.
+
+    The roots are all non-composite contexts, the contexts of queries, the
+    revisions of both kept by `avocado.history` (so reverting to a revision
+    never refers to a deleted composite) and, if `since` is given,
+    composites modified since then. Composites referenced by reachable
+    composites are followed level by level, loading `batch_size`
+    composites at a time.
+
+    If `sets` is given, the ids of the value and region sets referenced by
+    the roots and reachable composites are added to it, as done by
+    `referenced_sets`.
+    """
+    reachable = set()
+    frontier = set()
+
+    if since is not None:
+        frontier.update(composites().filter(modified__gte=since)
+                        .values_list('pk', flat=True))
+
+    for attrs in _root_json():
+        referenced_composites(attrs, frontier)
+
+        if sets is not None:
+            referenced_sets(attrs, sets)
+
+    while frontier:
+        reachable |= frontier
+        ids = list(frontier)
+        frontier = set()
+
+        for i in xrange(0, len(ids), batch_size):
+            for attrs in composites().filter(pk__in=ids[i:i + batch_size])\
+                    .values_list('json', flat=True):
+                attrs = _load_json(attrs)
+                referenced_composites(attrs, frontier)
+
+                if sets is not None:
+                    referenced_sets(attrs, sets)
+
+        frontier -= reachable
+
+    return reachable
+
+
+def collect_composites(grace=timedelta(hours=1), batch_size=1000,
+                       max_batches=None, dry_run=False):
+    """Deletes composites that are not reachable from a live context tree.
+
+    Composites modified within the `grace` period, and the composites they
+    reference, are kept since they may belong to a context that is still
+    being saved. Deletes are done in batches of `batch_size` and, if
+    `max_batches` is set, stop after that many batches so large backlogs
+    can be collected incrementally.
+
+    Returns a tuple of the number of deleted composites and the bytes of
+    json reclaimed.
+    """
+    cutoff = datetime.now() - grace
+    reachable = find_reachable_composites(batch_size, since=cutoff)
+
+    # Composites are created children first, so deleting in descending pk
+    # order deletes parents before their children. A partial collection
+    # never leaves a parent whose children are gone.
+    candidates = composites().filter(modified__lt=cutoff)\
+        .values_list('pk', flat=True).order_by('-pk')
+
+    orphans = [pk for pk in candidates.iterator() if pk not in reachable]
+
+    deleted = 0
+    reclaimed = 0
+
+    for batch, i in enumerate(xrange(0, len(orphans), batch_size)):
+        if max_batches is not None and batch >= max_batches:
+            break
+
+        # Composites reused since the scan have been touched and are kept
+        queryset = DataContext.objects.filter(
+            pk__in=orphans[i:i + batch_size], modified__lt=cutoff)
+
+        with transaction.commit_on_success():
+            rows = list(queryset.values_list('pk', 'json'))
+
+            for pk, attrs in rows:
+                if attrs is not None:
+                    if not isinstance(attrs, basestring):
+                        attrs = json.dumps(attrs)
+                    reclaimed += len(attrs)
+
+            if not dry_run:
+                DataContext.objects.filter(
+                    pk__in=[row[0] for row in rows],
+                    modified__lt=cutoff).delete()
+
+        deleted += len(rows)
+
+    return deleted, reclaimed
+
+
+def collect_sets(grace=timedelta(hours=1), batch_size=1000, dry_run=False):
+    """Deletes value sets and region sets that are not referenced by a
+    live context tree.
+
+    References are found the same way as reachable composites. Sets created
+    within the `grace` period are kept since the context referencing them
+    may still be being saved. A set is shared by digest, so a context
+    saved with an existing set after the scan could lose it; `grace`
+    should be longer than the time it takes to save a context.
+
+    Returns a tuple of the number of deleted value sets and region sets.
+    """
+    cutoff = datetime.now() - grace
+    sets = {IN_SET: set(), REGION_LIST: set()}
+    find_reachable_composites(batch_size, since=cutoff, sets=sets)
+
+    deleted = []
+
+    models = ((ValueSet, ValueSetItem, 'value_set__in', IN_SET),
+              (RegionSet, Region, 'region_set__in', REGION_LIST))
+
+    for model, item_model, lookup, operator in models:
+        candidates = model.objects.filter(created__lt=cutoff)\
+            .values_list('pk', flat=True)
+        orphans = [pk for pk in candidates.iterator()
+                   if pk not in sets[operator]]
+
+        if not dry_run:
+            for i in xrange(0, len(orphans), batch_size):
+                ids = orphans[i:i + batch_size]
+
+                # The items are deleted with one statement rather than
+                # being loaded by the cascade of the sets.
+                with transaction.commit_on_success():
+                    item_model.objects.filter(**{lookup: ids}).delete()
+                    model.objects.filter(pk__in=ids).delete()
+
+        deleted.append(len(orphans))
+
+    return tuple(deleted)
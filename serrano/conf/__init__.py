@@ -121,10 +121,45 @@ class Objectset(Dependency):
             return False
 
 
+class Zstandard(Dependency):
+    """zstandard provides bindings to the Zstandard compression library which
+    compresses faster and better than gzip.
+
+    Install by doing `pip install zstandard`. Exports can then be requested
+    with `compress=zstd`.
+    """
+
+    name = 'zstandard'
+
+    def test_install(self):
+        try:
+            import zstandard  # noqa
+        except ImportError:
+            return False
+
+
+class Numpy(Dependency):
+    """NumPy provides fast array operations for numerical computing.
+
+    Install by doing `pip install numpy`. Distributions of numeric fields
+    can then be clustered with `backend=numpy`.
+    """
+
+    name = 'numpy'
+
+    def test_install(self):
+        try:
+            import numpy  # noqa
+        except ImportError:
+            return False
+
+
 # Keep track of the officially supported apps and libraries used for various
 # features.
 OPTIONAL_DEPS = {
     'objectset': Objectset(),
+    'zstandard': Zstandard(),
+    'numpy': Numpy(),
 }
 
 
@@ -61,6 +61,12 @@ OBJECT_SETS = ()
 # metadata, but incurs an overhead.
 CHECK_ORPHANED_FIELDS = True
 
+# Integer of seconds the resolved model version data is cached for across
+# requests. The cached data is invalidated whenever the model version or its
+# series is saved or deleted, so this only bounds staleness for changes made
+# outside of the ORM.
+MODEL_VERSION_CACHE_TIMEOUT = 60 * 60
+
 # Export cookie settings. The template is required to take one positional
 # parameter, the export type, to distinguish itself from other exporter
 # cookies. The data is simply a value that is set by the server to denote
@@ -68,6 +74,119 @@ CHECK_ORPHANED_FIELDS = True
 EXPORT_COOKIE_NAME_TEMPLATE = 'export-type-{0}'
 EXPORT_COOKIE_DATA = 'complete'
 
+# Directory the files of background export jobs are written to. If not set,
+# a `serrano-exports` directory in the system temporary directory is used.
+EXPORT_JOB_ROOT = None
+
+# Integer of background export jobs that are run concurrently per process.
+# Jobs submitted beyond this limit wait in a queue.
+EXPORT_JOB_WORKERS = 2
+
+# Integer of seconds a pending or running export job may go without progress
+# before it is considered lost, e.g. because the process running it was
+# restarted. Lost jobs are marked as failed.
+EXPORT_JOB_STALE_TIMEOUT = 60 * 60
+
+# Integer of seconds finished export jobs and their files are kept. Set to
+# None to keep them until they are deleted.
+EXPORT_JOB_TIMEOUT = 60 * 60 * 24
+
+# Directory of the export result cache. Unpaged exports are cached on disk
+# keyed by a fingerprint of the context, view, export type and data version
+# so identical exports are served from the file. If not set, a
+# `serrano-export-cache` directory in the system temporary directory is used.
+EXPORT_CACHE_ROOT = None
+
+# Integer of bytes the export result cache may use. The least recently used
+# exports are removed once the limit is exceeded. The cache is disabled by
+# default. Cached exports are only shared by requests of the same user or
+# session, but query processors that filter by anything else derived from
+# the request should not be combined with the cache.
+EXPORT_CACHE_MAX_SIZE = 0
+
+# Name of the response header used to offload serving cached export files
+# to the web server, e.g. 'X-Sendfile' (Apache, lighttpd) or
+# 'X-Accel-Redirect' (nginx). If not set, the file is streamed by Django.
+EXPORT_SENDFILE_HEADER = None
+
+# URL prefix the cache file name is appended to for the sendfile header,
+# e.g. '/protected/exports/' for an internal nginx location aliased to
+# EXPORT_CACHE_ROOT. If not set, the absolute file path is used.
+EXPORT_SENDFILE_PREFIX = None
+
+# Integer compression level (1-9) used for gzip compressed exports. Lower
+# levels compress faster at the expense of larger files.
+EXPORT_GZIP_LEVEL = 6
+
+# If true, exports are compressed with gzip for clients that send a
+# matching Accept-Encoding header. The response is sent with a
+# Content-Encoding header, so the attachment itself is not compressed.
+# Compressed attachments can be requested with the `compress` parameter
+# regardless of this setting.
+EXPORT_ACCEPT_ENCODING = False
+
+# Integer of worker threads used by parallel exports, each with its own
+# database connection. Parallel exports are requested with the `parallel`
+# parameter of the exporter or of a submitted export job and are
+# partitioned by chromosome. Defaults to the number of CPUs if not set. Set
+# to 0 to disable parallel exports.
+EXPORT_PARALLEL_WORKERS = None
+
+# Dict of the export types that can be exported in parallel to the number
+# of header lines each partition starts with. Only line-oriented formats
+# can be partitioned since the partitions are concatenated.
+EXPORT_PARALLEL_TYPES = {
+    'csv': 1,
+}
+
+# If true, the count of a context is computed by a background worker pool
+# rather than while saving the context. The context is returned with
+# `sync: false` and the count is written back once computed; the context
+# stats endpoint can be polled for it. A newer edit to the context
+# supersedes (and on PostgreSQL cancels) a count that is still running.
+ASYNC_CONTEXT_COUNT = False
+
+# Integer of context counts that are computed concurrently per process when
+# ASYNC_CONTEXT_COUNT is enabled.
+CONTEXT_COUNT_WORKERS = 2
+
+# Integer of values above which a pasted value list (e.g. a gene list) is
+# stored as a server-side value set and referenced by id from the context
+# instead of being inlined in the context json and the query. Set to None
+# to always inline the values.
+VALUE_SET_MIN_SIZE = 100
+
+# Integer of seconds the value list of a field is cached. Lists are also
+# invalidated when the data_modified timestamp of the field changes. Set to
+# 0 to disable caching of value lists.
+FIELD_VALUES_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Integer of values above which the value list of a field is not cached,
+# e.g. to stay below the item size limit of the cache backend. Set to None
+# to cache lists of any length.
+FIELD_VALUES_CACHE_MAX_LENGTH = 50000
+
+# Integer of field value search indexes kept in memory per process. Indexes
+# are built the first time a field is searched and the least recently used
+# are discarded. Set to 0 to search the database instead.
+FIELD_SEARCH_INDEX_SIZE = 20
+
+# Integer of distinct values above which a field is searched in the database
+# rather than with an in-memory index. Set to None to index fields of any
+# size.
+FIELD_SEARCH_INDEX_MAX_LENGTH = 50000
+
+# Integer of values or labels validated per query when a list is posted to
+# the field values endpoint. Lists longer than this are streamed back one
+# chunk at a time.
+FIELD_VALIDATE_CHUNK_SIZE = 1000
+
+# Name of the backend used to cluster and find outliers of numeric field
+# distributions when the request does not specify one. 'python' uses the
+# avocado implementation and 'numpy' a vectorized implementation which
+# requires NumPy to be installed; if it is not, 'python' is used.
+DISTRIBUTION_BACKEND = 'python'
+
 # Provides a method for determining whether a field supports stats or not. By
 # default, stats are not supported on searchable fields. When this method
 # returns True, the stats URL will be included in the _links collection as
@@ -0,0 +1,144 @@
+"""Background computation of context counts.
+
+Counting a context on a large project table can take much longer than the
+request that saves it. When `ASYNC_CONTEXT_COUNT` is enabled, the count is
+computed by a worker pool and written back to the context once done. Each
+scheduled count is identified by a token stored in the shared cache; a
+newer edit replaces the token which supersedes the running count and, on
+PostgreSQL, cancels its in-flight query.
+"""
+import uuid
+import logging
+from datetime import datetime
+from django.core.cache import cache
+from django.db import connection, DatabaseError
+from avocado.models import DataContext
+from avocado.query import pipeline
+from serrano.conf import settings
+from serrano.workers import get_pool
+from serrano.exports import job_request
+from serrano.resources.base import get_count
+
+log = logging.getLogger(__name__)
+
+COUNT_TOKEN_KEY = 'serrano:context_count:{0}:token'
+COUNT_BACKEND_KEY = 'serrano:context_count:{0}:backend'
+
+# Upper bound on the time a count token is kept in the cache
+COUNT_TOKEN_TIMEOUT = 60 * 60
+
+
+def count_context(instance, queryset, model_type):
+    "Returns the distinct count of `instance` applied to `queryset`."
+    if model_type == 'project':
+        return get_count(instance.apply(queryset=queryset, distinct=False))
+    return instance.apply(queryset=queryset).distinct().count()
+
+
+def count_pending(context_id):
+    "Returns True if a count is scheduled or running for the context."
+    return cache.get(COUNT_TOKEN_KEY.format(context_id)) is not None
+
+
+def _cancel_backend(context_id):
+    backend = cache.get(COUNT_BACKEND_KEY.format(context_id))
+
+    if not backend or connection.vendor != 'postgresql':
+        return
+
+    token, pid = backend
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_cancel_backend(%s)', [pid])
+    except DatabaseError:
+        log.warning('Could not cancel count for context {0}'
+                    .format(context_id))
+
+
+def schedule_context_count(context_id, model_version, processor, tree,
+                           user_id=None, session_key=None):
+    """Schedules the count of the context on the worker pool.
+
+    Any count of the context that is still scheduled or running is
+    superseded. The count is run with the request of the user or session
+    the context belongs to.
+    """
+    token = uuid.uuid4().hex
+    cache.set(COUNT_TOKEN_KEY.format(context_id), token, COUNT_TOKEN_TIMEOUT)
+    _cancel_backend(context_id)
+
+    pool = get_pool('count', settings.CONTEXT_COUNT_WORKERS)
+    pool.submit(run_context_count, context_id, token, model_version,
+                processor, tree, user_id=user_id, session_key=session_key)
+
+    return token
+
+
+def _is_current(context_id, token):
+    return cache.get(COUNT_TOKEN_KEY.format(context_id)) == token
+
+
+def _clear_token(context_id, token):
+    if _is_current(context_id, token):
+        cache.delete(COUNT_TOKEN_KEY.format(context_id))
+
+
+def run_context_count(context_id, token, model_version, processor, tree,
+                      user_id=None, session_key=None):
+    "Counts the context unless the count has been superseded."
+    if not _is_current(context_id, token):
+        return
+
+    try:
+        instance = DataContext.objects.get(pk=context_id)
+    except DataContext.DoesNotExist:
+        _clear_token(context_id, token)
+        return
+
+    backend_key = COUNT_BACKEND_KEY.format(context_id)
+
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_backend_pid()')
+        cache.set(backend_key, (token, cursor.fetchone()[0]),
+                  COUNT_TOKEN_TIMEOUT)
+
+    count_start = datetime.now()
+
+    try:
+        QueryProcessor = pipeline.query_processors[processor]
+        request = job_request(user_id, session_key)
+        queryset = QueryProcessor(tree=tree).get_queryset(request=request)
+        count = count_context(instance, queryset, model_version['model_type'])
+    except DatabaseError:
+        # Cancelled by a newer edit
+        if not _is_current(context_id, token):
+            return
+
+        # Allow the count to be rescheduled
+        cache.delete(COUNT_TOKEN_KEY.format(context_id))
+        raise
+    finally:
+        backend = cache.get(backend_key)
+        if backend and backend[0] == token:
+            cache.delete(backend_key)
+
+    if not _is_current(context_id, token):
+        return
+
+    try:
+        attrs = DataContext.objects.get(pk=context_id).json
+    except DataContext.DoesNotExist:
+        _clear_token(context_id, token)
+        return
+
+    if attrs:
+        attrs['sync'] = True
+
+    # Only save the count if the context was not changed during the count.
+    # The conditional update also skips edits made since the read above.
+    DataContext.objects.filter(pk=context_id, modified__lte=count_start)\
+        .update(count=count, json=attrs)
+
+    _clear_token(context_id, token)
@@ -0,0 +1,689 @@
+"""Building and running exports outside of the request/response cycle.
+
+Export jobs are submitted through the exporter resource and run by a local
+worker pool. The result is written to a file under `EXPORT_JOB_ROOT` which
+is then served by the job download endpoint.
+"""
+import os
+import json
+import errno
+import hashlib
+import logging
+import zlib
+import shutil
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from datetime import datetime, timedelta
+from django.conf import settings as django_settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.db import connections
+from django.http import HttpRequest
+from django.utils.importlib import import_module
+from avocado.export import registry as exporters
+from avocado.models import DataContext, DataView
+from avocado.query import pipeline
+from serrano.conf import settings, dep_supported, raise_dep_error
+from serrano.metadata import get_metadata
+from serrano.models import ExportJob
+from serrano.workers import get_pool
+from serrano.resources.base import get_count, get_model_version_data, \
+    drop_order_only_columns
+from serrano.resources.pagination import REGION_RECORD_TYPES
+
+log = logging.getLogger(__name__)
+
+# Number of rows written between progress updates of a job
+PROGRESS_INTERVAL = 5000
+
+# Size of the chunks read from a finished export file
+CHUNK_SIZE = 64 * 1024
+
+# Supported compressions of export files with their file extension and
+# content type.
+COMPRESSIONS = {
+    'gzip': ('gz', 'application/gzip'),
+    'zstd': ('zst', 'application/zstd'),
+}
+
+
+def order_export_queryset(queryset, model_version):
+    "Applies the deterministic export ordering for the model version."
+    if model_version['model_type'] == 'project':
+        queryset.query.order_by = []
+        queryset.query.distinct = False
+    elif model_version['record_type'] in REGION_RECORD_TYPES:
+        queryset.query.order_by = queryset.query.order_by + \
+            ['chr', 'pos_start', 'pos_stop']
+        for key in model_version['keys']:
+            queryset.query.order_by.append(key['symbol'])
+    elif not model_version['record_type'] == 'sample':
+        queryset.query.order_by = queryset.query.order_by + \
+            ['chr', 'pos_start', 'pos_stop', 'ref_alts']
+
+    return queryset
+
+
+def job_request(user_id=None, session_key=None):
+    """Returns a request of the user or session an export was submitted by.
+
+    Exports run outside of a request are given this request so query
+    processors and exporters see the same user and session as they would
+    have in the request.
+    """
+    request = HttpRequest()
+
+    if user_id is not None:
+        request.user = User.objects.get(pk=user_id)
+    else:
+        request.user = AnonymousUser()
+
+    engine = import_module(django_settings.SESSION_ENGINE)
+    request.session = engine.SessionStore(session_key)
+
+    return request
+
+
+def build_export(model_version, context_json, view_json, processor,
+                 export_type, request=None):
+    """Builds the processor, queryset and exporter of a whole export.
+
+    This is used to run exports outside of a request, such as export jobs
+    and the partitions of a parallel export, with the `request` returned
+    by `job_request`.
+    """
+    context = DataContext(json=context_json)
+    view = DataView(json=view_json)
+
+    QueryProcessor = pipeline.query_processors[processor]
+    processor = QueryProcessor(context=context,
+                               view=view,
+                               tree=model_version['model_name'],
+                               include_pk=False)
+
+    queryset = processor.get_queryset(request=request)
+    queryset.query.distinct = True
+    order_export_queryset(queryset, model_version)
+    drop_order_only_columns(queryset, view.parse(), model_version['id'])
+
+    exporter = processor.get_exporter(exporters[export_type])
+
+    return processor, queryset, exporter
+
+
+def get_export_filename(model_version, exporter):
+    return '{0} - {1}.{2}'.format(model_version['series_name'],
+                                  datetime.now().strftime('%Y-%m-%d'),
+                                  exporter.file_extension)
+
+
+def write_export(exporter, iterable, fileobj, model_version, request=None):
+    """Writes the exported `iterable` to `fileobj`.
+
+    Exporters that provide a generator are consumed chunk by chunk rather
+    than buffering the output.
+    """
+    kwargs = {
+        'request': request,
+        'model_version_id': model_version['id'],
+        'model_type': model_version['model_type'],
+    }
+
+    generator = getattr(exporter, 'generator', None)
+
+    if callable(generator):
+        for chunk in generator(iterable, **kwargs):
+            fileobj.write(chunk)
+    else:
+        exporter.write(iterable, fileobj, **kwargs)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # Created concurrently by another worker
+        if e.errno != errno.EEXIST:
+            raise
+
+    return path
+
+
+def get_compressor(encoding):
+    "Returns an incremental compressor object for `encoding`."
+    if encoding == 'gzip':
+        # The window bits offset produces the gzip header and trailer
+        return zlib.compressobj(settings.EXPORT_GZIP_LEVEL, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+
+    if encoding == 'zstd':
+        if not dep_supported('zstandard'):
+            raise_dep_error('zstandard')
+
+        import zstandard
+        return zstandard.ZstdCompressor().compressobj()
+
+    raise ValueError('Unsupported compression: {0}'.format(encoding))
+
+
+def compress_chunks(chunks, encoding):
+    """Yields the compressed `chunks`.
+
+    Chunks are compressed incrementally so the memory used is bounded by
+    the compressor's window rather than the size of the export.
+    """
+    compressor = get_compressor(encoding)
+
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+
+        data = compressor.compress(chunk)
+
+        if data:
+            yield data
+
+    data = compressor.flush()
+
+    if data:
+        yield data
+
+
+def get_job_root():
+    "Returns the directory export job files are written to."
+    root = settings.EXPORT_JOB_ROOT or \
+        os.path.join(tempfile.gettempdir(), 'serrano-exports')
+
+    if not os.path.isdir(root):
+        _makedirs(root)
+
+    return root
+
+
+class JobDeleted(Exception):
+    "Raised when an export job is deleted while it is running."
+
+
+def _touch_job(job_id, **kwargs):
+    # Progress updates also mark the job as alive
+    if not ExportJob.objects.filter(pk=job_id).update(
+            modified=datetime.now(), **kwargs):
+        raise JobDeleted
+
+
+def _count_rows(iterable, job_id):
+    count = 0
+
+    for row in iterable:
+        count += 1
+
+        if count % PROGRESS_INTERVAL == 0:
+            _touch_job(job_id, rows=count)
+
+        yield row
+
+    _touch_job(job_id, rows=count)
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def run_export_job(job_id):
+    "Runs the pending export job `job_id` and writes the result to disk."
+    updated = ExportJob.objects.filter(pk=job_id, status=ExportJob.PENDING)\
+        .update(status=ExportJob.RUNNING, modified=datetime.now())
+
+    # Already picked up or removed
+    if not updated:
+        return
+
+    try:
+        job = ExportJob.objects.get(pk=job_id)
+    except ExportJob.DoesNotExist:
+        return
+
+    path = None
+
+    try:
+        model_version = get_model_version_data(job.model_version_id)
+        context_json = json.loads(job.context_json or '{}')
+        view_json = json.loads(job.view_json or '{}')
+        request = job_request(job.user_id, job.session_key)
+
+        processor, queryset, exporter = build_export(
+            model_version, context_json, view_json, job.processor,
+            job.export_type, request=request)
+
+        total = get_count(queryset)
+
+        ExportJob.objects.filter(pk=job.pk).update(
+            total=total,
+            filename=get_export_filename(model_version, exporter),
+            modified=datetime.now())
+
+        path = os.path.join(get_job_root(), '{0}.{1}'.format(
+            job.pk, exporter.file_extension))
+
+        # The ordering of the view is checked before the export ordering
+        # is applied.
+        parallel = job.parallel and parallel_export_supported(
+            job.export_type, model_version,
+            processor.get_queryset(request=request))
+
+        # Written to a temporary name first so a partial file is never
+        # served as a finished export.
+        with open(path + '.part', 'wb') as fileobj:
+            if parallel:
+                # Rows are written by the partition threads, so progress
+                # is reported per partition.
+                chunks = parallel_export(
+                    model_version, context_json, view_json, job.processor,
+                    job.export_type, get_partitions(queryset),
+                    user_id=job.user_id, session_key=job.session_key,
+                    progress=lambda done: _touch_job(job.pk))
+
+                for chunk in chunks:
+                    fileobj.write(chunk)
+
+                _touch_job(job.pk, rows=total)
+            else:
+                iterable = _count_rows(processor.get_iterable(
+                    request=request, queryset=queryset), job.pk)
+
+                write_export(exporter, iterable, fileobj, model_version,
+                             request=request)
+
+        os.rename(path + '.part', path)
+
+        updated = ExportJob.objects.filter(pk=job.pk).update(
+            status=ExportJob.DONE,
+            path=path,
+            size=os.path.getsize(path),
+            finished=datetime.now())
+
+        # Deleted while running, so nothing references the file
+        if not updated:
+            _remove_file(path)
+    except JobDeleted:
+        _remove_file(path + '.part')
+    except Exception as e:
+        log.exception('Export job {0} failed'.format(job.pk))
+
+        if path:
+            _remove_file(path + '.part')
+
+        ExportJob.objects.filter(pk=job.pk).update(
+            status=ExportJob.FAILED,
+            error=unicode(e),
+            finished=datetime.now())
+
+
+def delete_export_job(job):
+    """Deletes `job` and its file. A running job notices the deletion and
+    removes its own file.
+    """
+    if job.path:
+        _remove_file(job.path)
+
+    job.delete()
+
+
+def maintain_export_jobs():
+    """Marks lost jobs as failed and deletes expired jobs with their files.
+
+    Jobs run in the threads of the process that accepted them, so jobs of
+    a process that was restarted are never finished. They are detected by
+    the lack of progress for EXPORT_JOB_STALE_TIMEOUT seconds.
+    """
+    now = datetime.now()
+
+    if settings.EXPORT_JOB_STALE_TIMEOUT:
+        cutoff = now - timedelta(seconds=settings.EXPORT_JOB_STALE_TIMEOUT)
+
+        ExportJob.objects.filter(
+            status__in=(ExportJob.PENDING, ExportJob.RUNNING),
+            modified__lt=cutoff).update(status=ExportJob.FAILED,
+                                        error='Export was interrupted',
+                                        finished=now)
+
+    if settings.EXPORT_JOB_TIMEOUT:
+        cutoff = now - timedelta(seconds=settings.EXPORT_JOB_TIMEOUT)
+
+        for job in ExportJob.objects.filter(finished__lt=cutoff):
+            delete_export_job(job)
+
+
+def enqueue_export_job(job):
+    "Queues `job` on the export worker pool."
+    pool = get_pool('export', settings.EXPORT_JOB_WORKERS)
+    pool.submit(run_export_job, job.pk)
+
+
+def read_file(path, start=0, length=None):
+    "Yields the contents of `path` from `start` for up to `length` bytes."
+    with open(path, 'rb') as fileobj:
+        fileobj.seek(start)
+
+        while length is None or length > 0:
+            size = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length)
+            chunk = fileobj.read(size)
+
+            if not chunk:
+                break
+
+            if length is not None:
+                length -= len(chunk)
+
+            yield chunk
+
+
+def parse_range(header, size):
+    """Parses a single byte range of a Range header.
+
+    Returns a (start, stop) tuple with an inclusive stop, None if the header
+    is absent or not a single byte range (the whole file is served), or
+    raises ValueError if the range cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+
+    spec = header[len('bytes='):].strip()
+
+    # Multiple ranges are not supported, fallback to the whole file
+    if ',' in spec or '-' not in spec:
+        return None
+
+    start, stop = spec.split('-', 1)
+
+    try:
+        start = int(start) if start else None
+        stop = int(stop) if stop else None
+    except ValueError:
+        return None
+
+    if start is None:
+        # Suffix range, e.g. the last 500 bytes
+        if not stop:
+            raise ValueError('Range not satisfiable')
+        return max(0, size - stop), size - 1
+
+    if stop is None:
+        stop = size - 1
+
+    if start >= size or stop < start:
+        raise ValueError('Range not satisfiable')
+
+    return start, min(stop, size - 1)
+
+
+def get_cache_root():
+    "Returns the directory of the export result cache."
+    root = settings.EXPORT_CACHE_ROOT or \
+        os.path.join(tempfile.gettempdir(), 'serrano-export-cache')
+
+    if not os.path.isdir(root):
+        _makedirs(root)
+
+    return root
+
+
+def export_owner(request):
+    "Returns the user or session the exports of `request` are cached for."
+    if getattr(request, 'user', None) and request.user.is_authenticated():
+        return 'user:{0}'.format(request.user.pk)
+
+    if getattr(request, 'session', None) and request.session.session_key:
+        return 'session:{0}'.format(request.session.session_key)
+
+
+def export_fingerprint(context_json, view_json, export_type, processor,
+                       model_version_id, owner=None):
+    """Returns the cache fingerprint of an export.
+
+    Exports of the same model version with equivalent contexts and views
+    produce the same file, so the fingerprint is derived from the normalized
+    json of both, the export type and processor, and the data version
+    (the last time data of the model version was modified). Since query
+    processors may filter by the requesting user, the `owner` of the
+    request is included as well.
+    """
+    data_modified = get_metadata(model_version_id).data_modified
+
+    components = {
+        'context': context_json or {},
+        'view': view_json or {},
+        'export_type': export_type,
+        'processor': processor,
+        'model_version': model_version_id,
+        'owner': owner,
+        'data_version': data_modified.isoformat() if data_modified else None,
+    }
+
+    canonical = json.dumps(components, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical).hexdigest()
+
+
+def _cache_path(fingerprint, extension):
+    return os.path.join(get_cache_root(),
+                        '{0}.{1}'.format(fingerprint, extension))
+
+
+def get_cached_export(fingerprint, extension):
+    "Returns the path of the cached export or None if it is not cached."
+    if not settings.EXPORT_CACHE_MAX_SIZE:
+        return
+
+    path = _cache_path(fingerprint, extension)
+
+    try:
+        # Mark as recently used for eviction
+        os.utime(path, None)
+    except OSError:
+        return
+
+    return path
+
+
+def _store_export(tmp_path, fingerprint, extension):
+    os.rename(tmp_path, _cache_path(fingerprint, extension))
+    evict_exports()
+
+
+def cache_export(chunks, fingerprint, extension):
+    """Yields `chunks` while writing them to the cache.
+
+    The file is only added to the cache once all chunks have been written,
+    so an export interrupted by the client is discarded.
+    """
+    if not settings.EXPORT_CACHE_MAX_SIZE:
+        for chunk in chunks:
+            yield chunk
+        return
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=get_cache_root())
+    complete = False
+
+    try:
+        with os.fdopen(fd, 'wb') as fileobj:
+            for chunk in chunks:
+                fileobj.write(chunk)
+                yield chunk
+
+        complete = True
+        _store_export(tmp_path, fingerprint, extension)
+    finally:
+        if not complete and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def store_export(content, fingerprint, extension):
+    "Adds the exported `content` to the cache."
+    if not settings.EXPORT_CACHE_MAX_SIZE:
+        return
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.part', dir=get_cache_root())
+
+    with os.fdopen(fd, 'wb') as fileobj:
+        fileobj.write(content)
+
+    _store_export(tmp_path, fingerprint, extension)
+
+
+def evict_exports(max_size=None):
+    """Removes the least recently used exports from the cache until its
+    total size is within `max_size` bytes.
+    """
+    if max_size is None:
+        max_size = settings.EXPORT_CACHE_MAX_SIZE
+
+    root = get_cache_root()
+    entries = []
+    total = 0
+
+    for name in os.listdir(root):
+        # Skip files still being written
+        if name.endswith('.part'):
+            continue
+
+        path = os.path.join(root, name)
+
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    reclaimed = 0
+
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+        total -= size
+        reclaimed += size
+
+    return reclaimed
+
+
+def get_parallel_workers():
+    "Returns the number of worker threads of a parallel export."
+    if settings.EXPORT_PARALLEL_WORKERS is None:
+        return multiprocessing.cpu_count()
+    return settings.EXPORT_PARALLEL_WORKERS
+
+
+def parallel_export_supported(export_type, model_version, queryset):
+    """Returns True if the export can be partitioned by chromosome.
+
+    The partitions are concatenated, so this applies to line-oriented
+    export types of genomic tables where the view does not impose its own
+    ordering ahead of the chromosome.
+    """
+    return bool(get_parallel_workers() and
+                export_type in settings.EXPORT_PARALLEL_TYPES and
+                model_version['model_type'] != 'project' and
+                model_version['record_type'] != 'sample' and
+                not queryset.query.order_by)
+
+
+def get_partitions(queryset):
+    "Returns the chromosomes of `queryset` in the order of the database."
+    return list(queryset.order_by('chr').values_list('chr', flat=True)
+                .distinct())
+
+
+def _export_partition(args):
+    model_version, context_json, view_json, processor, export_type, \
+        chromosome, directory, user_id, session_key = args
+
+    try:
+        request = job_request(user_id, session_key)
+
+        processor, queryset, exporter = build_export(
+            model_version, context_json, view_json, processor, export_type,
+            request=request)
+
+        queryset = queryset.filter(chr=chromosome)
+        iterable = processor.get_iterable(request=request,
+                                          queryset=queryset)
+
+        fd, path = tempfile.mkstemp(dir=directory)
+
+        with os.fdopen(fd, 'wb') as fileobj:
+            write_export(exporter, iterable, fileobj, model_version,
+                         request=request)
+    finally:
+        # Each worker thread opens its own database connection which must
+        # not be left open between partitions.
+        for connection in connections.all():
+            connection.close()
+
+    return path
+
+
+def _read_partition(path, skip_lines=0):
+    with open(path, 'rb') as fileobj:
+        for i in xrange(skip_lines):
+            fileobj.readline()
+
+        while True:
+            chunk = fileobj.read(CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            yield chunk
+
+
+def parallel_export(model_version, context_json, view_json, processor,
+                    export_type, partitions, user_id=None, session_key=None,
+                    progress=None):
+    """Exports the partitions on a pool of worker threads.
+
+    Each chromosome is exported by a worker thread, on its own database
+    connection, into a temporary file as the user or session the export
+    was submitted by. The files are yielded in the order of `partitions` as
+    they complete, with the header lines of all but the first partition
+    removed. `progress` is called with the number of partitions yielded so
+    far.
+
+    Threads are used rather than processes since forking the
+    multi-threaded web process can deadlock on locks held by other threads.
+    The partitions mostly wait on their queries, which run concurrently.
+    """
+    header_lines = settings.EXPORT_PARALLEL_TYPES[export_type]
+    directory = tempfile.mkdtemp(prefix='serrano-partitions-')
+
+    tasks = [(model_version, context_json, view_json, processor, export_type,
+              chromosome, directory, user_id, session_key)
+             for chromosome in partitions]
+
+    pool = ThreadPool(min(get_parallel_workers(), len(tasks)) or 1)
+
+    try:
+        for i, path in enumerate(pool.imap(_export_partition, tasks)):
+            for chunk in _read_partition(path, header_lines if i else 0):
+                yield chunk
+
+            os.remove(path)
+
+            if progress is not None:
+                progress(i + 1)
+
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        shutil.rmtree(directory, ignore_errors=True)
@@ -8,12 +8,14 @@ from django.contrib.sites.models import get_current_site
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.core.validators import validate_email
+from django.db import transaction
 from django.db.models import Q
 from avocado.models import DataContext, DataView, DataQuery
 from avocado.query import pipeline
 from serrano import utils
 from serrano.conf import settings
 from serrano.resources.base import extract_model_version, get_count
+from serrano.counts import count_context, schedule_context_count
 import datetime
 import traceback
 
@@ -25,7 +27,7 @@ SHARED_QUERY_EMAIL_BODY = 'View the query at {query_url}'
 
 def set_sync(json, sync):
     if json:
-        json['sync'] = True
+        json['sync'] = sync
     return json    
 
 class ContextForm(forms.ModelForm):
@@ -88,24 +90,42 @@ class ContextForm(forms.ModelForm):
 
         instance.json = self.json
 
-        if commit:            
-            instance.save()
+        # The count is computed in the background and written back to the
+        # context, so the context is saved as not in sync until then.
+        async_count = bool(commit and update_count and
+                           self.count_needs_update and
+                           settings.ASYNC_CONTEXT_COUNT)
+
+        if async_count:
+            instance.json = set_sync(instance.json, False)
+            instance.count = None
+
+            # The context must be committed before a worker thread reads it
+            with transaction.commit_on_success():
+                instance.save()
+
+            schedule_context_count(instance.pk, model_version,
+                                   self.processor, self.tree,
+                                   user_id=instance.user_id,
+                                   session_key=instance.session_key)
+            self.count_needs_update = False
+            return instance
 
         # Only recalculated count if conditions exist. This is to
         # prevent re-counting the entire dataset. An alternative
         # solution may be desirable such as pre-computing and
         # caching the count ahead of time.
         
+        if commit:
+            instance.save()
+
         instance.json = set_sync(instance.json, True)
         if update_count:
             count_start = datetime.datetime.now()
 
             if self.count_needs_update:
-                if model_version['model_type']=='project':
-                    apply_query = instance.apply(queryset=queryset, distinct=False)
-                    count = get_count(apply_query)
-                else:
-                    count = instance.apply(queryset=queryset).distinct().count()
+                count = count_context(instance, queryset,
+                                      model_version['model_type'])
                 self.count_needs_update = False
             else:
                 count = None
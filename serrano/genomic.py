@@ -0,0 +1,229 @@
+"""Hierarchical (UCSC-style) binning of genomic intervals.
+
+Every record is assigned the smallest bin that fully contains it. Bins form
+five levels of 128kb, 1Mb, 8Mb, 64Mb and 512Mb. A region overlaps only
+records in the bins overlapping the region at each level, which is a
+handful of contiguous bin ranges. Combined with an index on (chr, bin), a
+region filter touches a small part of the table regardless of its size.
+
+Intervals are 0-based and half-open, as stored in the pos_start and
+pos_stop columns. Records loaded after the bins were indexed have no bin
+until `index_bins` is run again, so region filters also match records
+with a NULL bin.
+"""
+import time
+from django.db import connection, transaction
+
+# Offsets of the first bin of each level, from the smallest bins to the
+# single bin spanning the whole 512Mb range.
+BIN_OFFSETS = (512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0)
+
+# Size of the smallest bins (2^17 = 128kb) and the shift between levels
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+# Positions beyond this are not supported by the binning scheme
+MAX_POSITION = 1 << (BIN_FIRST_SHIFT + BIN_NEXT_SHIFT *
+                     (len(BIN_OFFSETS) - 1))
+
+
+def _bounds(start, end):
+    # Zero-length intervals (e.g. insertions) are binned at their position
+    if end <= start:
+        end = start + 1
+
+    if start < 0 or end > MAX_POSITION:
+        raise ValueError('Interval {0}-{1} out of range'.format(start, end))
+
+    return start >> BIN_FIRST_SHIFT, (end - 1) >> BIN_FIRST_SHIFT
+
+
+def bin_from_range(start, end):
+    "Returns the smallest bin fully containing the interval."
+    start_bin, end_bin = _bounds(start, end)
+
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+
+    raise ValueError('Interval {0}-{1} out of range'.format(start, end))
+
+
+def overlapping_bin_ranges(start, end):
+    """Returns the inclusive (first, last) bin ranges of each level that
+    may contain records overlapping the interval.
+    """
+    start_bin, end_bin = _bounds(start, min(end, MAX_POSITION))
+    ranges = []
+
+    for offset in BIN_OFFSETS:
+        ranges.append((offset + start_bin, offset + end_bin))
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+
+    return ranges
+
+
+def bin_sql(start_column='pos_start', stop_column='pos_stop'):
+    "Returns a portable SQL expression computing the bin of each record."
+    end = ('(CASE WHEN {1} > {0} THEN {1} ELSE {0} + 1 END - 1)'
+           .format(start_column, stop_column))
+
+    clauses = []
+    shift = BIN_FIRST_SHIFT
+
+    for offset in BIN_OFFSETS[:-1]:
+        clauses.append('WHEN ({0} >> {1}) = ({2} >> {1}) THEN {3} + ({0} >> {1})'
+                       .format(start_column, shift, end, offset))
+        shift += BIN_NEXT_SHIFT
+
+    return 'CASE {0} ELSE {1} END'.format(' '.join(clauses), BIN_OFFSETS[-1])
+
+
+def bin_range_sql(start, end, column='bin'):
+    "Returns the SQL predicate of the bins overlapping the interval."
+    clauses = ['{0} BETWEEN {1} AND {2}'.format(column, first, last)
+               for first, last in overlapping_bin_ranges(start, end)]
+    clauses.append('{0} IS NULL'.format(column))
+    return '(' + ' OR '.join(clauses) + ')'
+
+
+def bin_range_children(field_id, concept_id, start, end):
+    "Returns the context children of the bins overlapping the interval."
+    children = []
+
+    for first, last in overlapping_bin_ranges(start, end):
+        children.append({
+            'concept': concept_id,
+            'field': field_id,
+            'operator': 'range',
+            'value': [first, last],
+            'language': 'Bin in range',
+            'required': False,
+        })
+
+    children.append({
+        'concept': concept_id,
+        'field': field_id,
+        'operator': 'isnull',
+        'value': True,
+        'language': 'Bin is not indexed',
+        'required': False,
+    })
+
+    return children
+
+
+# Name of the field registered for the bin column of a record table
+BIN_FIELD_NAME = 'Bin'
+
+
+def get_interval_fields(model_version_id):
+    """Returns the chromosome, start and stop DataFields of the record
+    table of a model version.
+    """
+    # Imported here since this module is loaded by the translators which
+    # avocado discovers while its models are being loaded.
+    from avocado.models import DataField
+
+    fields = dict((f.name, f) for f in DataField.objects.filter(
+        model_version_id=model_version_id,
+        name__in=('Chromosome', 'Chr', 'Pos Start', 'Pos Stop',
+                  'Start', 'Stop')))
+
+    if 'Pos Start' in fields:
+        names = ('Chromosome', 'Pos Start', 'Pos Stop')
+    else:
+        names = ('Chr' if 'Chr' in fields else 'Chromosome', 'Start', 'Stop')
+
+    if not all(name in fields for name in names):
+        raise ValueError('Model version {0} has no genomic coordinate fields'
+                         .format(model_version_id))
+
+    return [fields[name] for name in names]
+
+
+def index_bins(model_version_id, column='bin'):
+    """Adds, populates and indexes the bin column of the record table of a
+    model version and registers it as a DataField.
+
+    Returns the name of the table. This is safe to run again, e.g. after
+    records are loaded, and recomputes the bin of every record.
+    """
+    from avocado.models import DataField
+
+    chr_field, start_field, stop_field = get_interval_fields(model_version_id)
+    table = start_field.model._meta.db_table
+    qn = connection.ops.quote_name
+
+    cursor = connection.cursor()
+    columns = [c[0] for c in connection.introspection
+               .get_table_description(cursor, table)]
+
+    with transaction.commit_on_success():
+        if column not in columns:
+            cursor.execute('ALTER TABLE {0} ADD COLUMN {1} integer'
+                           .format(qn(table), qn(column)))
+
+        cursor.execute('UPDATE {0} SET {1} = {2}'.format(
+            qn(table), qn(column),
+            bin_sql(qn(start_field.field.column), qn(stop_field.field.column))))
+
+        # The index is created with the column, so a rerun only updates bins
+        if column not in columns:
+            cursor.execute('CREATE INDEX {0} ON {1} ({2}, {3})'.format(
+                qn('{0}_{1}_{2}'.format(table, chr_field.field.column,
+                                        column)),
+                qn(table), qn(chr_field.field.column), qn(column)))
+
+        DataField.objects.get_or_create(
+            model_version_id=model_version_id, name=BIN_FIELD_NAME,
+            defaults={
+                'app_name': start_field.app_name,
+                'model_name': start_field.model_name,
+                'field_name': column,
+                'published': False,
+            })
+
+    return table
+
+
+def benchmark_region(model_version_id, chromosome, start, end, repeat=3,
+                     column='bin'):
+    """Times the count of records overlapping a region with and without the
+    bin predicate.
+
+    Returns a tuple of the count and the best time in seconds of the plain
+    overlap query and the binned query.
+    """
+    chr_field, start_field, stop_field = get_interval_fields(model_version_id)
+    table = start_field.model._meta.db_table
+    qn = connection.ops.quote_name
+
+    overlap = 'SELECT COUNT(*) FROM {0} WHERE {1} = %s AND {2} < %s AND {3} > %s'\
+        .format(qn(table), qn(chr_field.field.column),
+                qn(start_field.field.column), qn(stop_field.field.column))
+    binned = overlap + ' AND ' + bin_range_sql(start, end, qn(column))
+    params = [chromosome, end, start]
+
+    cursor = connection.cursor()
+    timings = []
+
+    for sql in (overlap, binned):
+        best = None
+
+        for i in xrange(max(1, repeat)):
+            t0 = time.time()
+            cursor.execute(sql, params)
+            count = cursor.fetchone()[0]
+            elapsed = time.time() - t0
+
+            if best is None or elapsed < best:
+                best = elapsed
+
+        timings.append(best)
+
+    return count, timings[0], timings[1]
@@ -0,0 +1,161 @@
+"""Vectorized clustering and outlier detection for field distributions.
+
+This is a NumPy implementation of the `weighted_counts` and
+`find_outliers` functions of `avocado.stats.kmeans` which loop over the
+observations in Python. Clustering uses mini-batch k-means weighted by the
+count of each observation, so its cost is bounded by the batch size and
+number of iterations rather than the number of observations.
+
+NumPy is an optional dependency; callers must check
+`dep_supported('numpy')` before importing this module.
+"""
+import numpy as np
+
+# Default threshold of the z-score and multiplier of the interquartile
+# range beyond which an observation is an outlier.
+ZSCORE_THRESHOLD = 3.0
+IQR_MULTIPLIER = 1.5
+
+OUTLIER_METHODS = ('zscore', 'iqr')
+
+# Rows of the distance matrix computed at once when assigning clusters
+ASSIGN_CHUNK_SIZE = 10000
+
+
+def find_outliers(obs, method='zscore'):
+    """Returns a boolean mask of the observations that are outliers in any
+    dimension.
+
+    The 'zscore' method flags observations more than ZSCORE_THRESHOLD
+    standard deviations from the mean. The 'iqr' method flags those more
+    than IQR_MULTIPLIER interquartile ranges outside the quartiles.
+    """
+    obs = np.asarray(obs, dtype=float)
+
+    if not len(obs):
+        return np.zeros(0, dtype=bool)
+
+    if method == 'iqr':
+        q1, q3 = np.percentile(obs, [25, 75], axis=0)
+        spread = IQR_MULTIPLIER * (q3 - q1)
+        mask = (obs < q1 - spread) | (obs > q3 + spread)
+    elif method == 'zscore':
+        std = obs.std(axis=0)
+        std[std == 0] = 1
+        mask = np.abs(obs - obs.mean(axis=0)) / std > ZSCORE_THRESHOLD
+    else:
+        raise ValueError('Unknown outlier method: {0}'.format(method))
+
+    return mask.any(axis=1)
+
+
+def assign(obs, centroids):
+    "Returns the index of the closest centroid of each observation."
+    labels = np.empty(len(obs), dtype=int)
+    norms = (centroids ** 2).sum(axis=1)
+
+    for i in xrange(0, len(obs), ASSIGN_CHUNK_SIZE):
+        chunk = obs[i:i + ASSIGN_CHUNK_SIZE]
+        # Squared distances up to the per-row constant |x|^2
+        distances = norms - 2 * chunk.dot(centroids.T)
+        labels[i:i + ASSIGN_CHUNK_SIZE] = distances.argmin(axis=1)
+
+    return labels
+
+
+def init_centroids(obs, weights, k, rng):
+    """Chooses the initial centroids with weighted k-means++: each is drawn
+    with probability relative to its weight times its squared distance to
+    the closest centroid chosen so far.
+    """
+    centroids = [obs[rng.choice(len(obs), p=weights / weights.sum())]]
+    distances = ((obs - centroids[0]) ** 2).sum(axis=1)
+
+    for _ in xrange(1, k):
+        p = weights * distances
+
+        # All remaining observations coincide with a centroid
+        if not p.sum():
+            break
+
+        centroid = obs[rng.choice(len(obs), p=p / p.sum())]
+        centroids.append(centroid)
+        distances = np.minimum(distances,
+                               ((obs - centroid) ** 2).sum(axis=1))
+
+    return np.array(centroids)
+
+
+def kmeans(obs, weights, k, batch_size=1000, iterations=50, seed=0):
+    """Mini-batch k-means of `obs` weighted by `weights`.
+
+    Returns the centroids and the label of each observation. The seed is
+    fixed so the same distribution is always clustered the same way.
+    """
+    rng = np.random.RandomState(seed)
+    n = len(obs)
+    k = max(1, min(k, n))
+
+    centroids = init_centroids(obs, weights, k, rng)
+    totals = np.zeros(len(centroids))
+
+    for _ in xrange(iterations):
+        if n > batch_size:
+            idx = rng.choice(n, batch_size, replace=False)
+            batch, batch_weights = obs[idx], weights[idx]
+        else:
+            batch, batch_weights = obs, weights
+
+        labels = assign(batch, centroids)
+
+        for c in np.unique(labels):
+            mask = labels == c
+            w = batch_weights[mask]
+            totals[c] += w.sum()
+
+            # Per-centroid learning rate decays with the weight seen so far
+            rate = w.sum() / totals[c]
+            mean = np.average(batch[mask], axis=0, weights=w)
+            centroids[c] += rate * (mean - centroids[c])
+
+    return centroids, assign(obs, centroids)
+
+
+def default_k(n):
+    return max(1, int(np.sqrt(n / 2.0)))
+
+
+def weighted_counts(obs, counts, k=None, method='zscore'):
+    """Clusters the observations and returns the centroids with the summed
+    counts of their observations, and the outliers.
+
+    Outliers are removed before clustering. Both are returned as lists of
+    dicts with `values` and `count` like the distribution points.
+    """
+    obs = np.asarray(obs, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+
+    mask = find_outliers(obs, method)
+    outliers = [{'values': obs[i].tolist(), 'count': int(counts[i])}
+                for i in np.flatnonzero(mask)]
+
+    obs, counts = obs[~mask], counts[~mask]
+
+    if not len(obs):
+        return [], outliers
+
+    # Cluster in standardized space so dimensions of different scales
+    # contribute equally
+    mean = obs.mean(axis=0)
+    std = obs.std(axis=0)
+    std[std == 0] = 1
+
+    centroids, labels = kmeans((obs - mean) / std, counts,
+                               k or default_k(len(obs)))
+    weights = np.bincount(labels, weights=counts, minlength=len(centroids))
+    centroids = centroids * std + mean
+
+    points = [{'values': centroids[i].tolist(), 'count': int(weights[i])}
+              for i in xrange(len(centroids)) if weights[i]]
+
+    return points, outliers
@@ -0,0 +1,50 @@
+from datetime import timedelta
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from serrano.composites import collect_composites, collect_sets
+
+
+class Command(BaseCommand):
+    """Deletes composite contexts, value sets and region sets that are no
+    longer referenced by any context or query.
+
+    Run periodically (e.g. from cron) to keep the context table from
+    growing without bound. Use --max-batches to collect a large backlog
+    incrementally over several runs.
+    """
+    help = 'Deletes orphaned composite contexts, value sets and region sets'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--grace', type='int', default=60,
+                    help='Minutes a composite or set is kept after its '
+                         'last modification regardless of being referenced'),
+        make_option('--batch-size', type='int', default=1000,
+                    help='Number of composites or sets deleted per batch'),
+        make_option('--max-batches', type='int', default=None,
+                    help='Maximum number of batches deleted in this run'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Report the orphaned composites and sets without '
+                         'deleting them'),
+    )
+
+    def handle(self, **options):
+        deleted, reclaimed = collect_composites(
+            grace=timedelta(minutes=options['grace']),
+            batch_size=options['batch_size'],
+            max_batches=options['max_batches'],
+            dry_run=options['dry_run'])
+
+        verb = 'Found' if options['dry_run'] else 'Deleted'
+
+        self.stdout.write('{0} {1} orphaned composite contexts, '
+                          '{2:.1f} KB of json reclaimed'
+                          .format(verb, deleted, reclaimed / 1024.0))
+
+        # Sets are collected once the composites referencing them are gone
+        value_sets, region_sets = collect_sets(
+            grace=timedelta(minutes=options['grace']),
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run'])
+
+        self.stdout.write('{0} {1} orphaned value sets and {2} orphaned '
+                          'region sets'.format(verb, value_sets, region_sets))
@@ -0,0 +1,67 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from serrano.genomic import index_bins, benchmark_region
+
+
+def parse_region(region):
+    "Parses a 1-based, inclusive chr:start-stop region."
+    try:
+        chromosome, pos = region.replace('chr', '').replace(',', '')\
+            .split(':')
+        start, stop = [int(value) for value in pos.split('-')]
+    except ValueError:
+        raise CommandError('Invalid region {0}, expected chr:start-stop'
+                           .format(region))
+
+    return chromosome, start - 1, stop
+
+
+class Command(BaseCommand):
+    """Adds a UCSC-style bin column to the record table of each model
+    version so genomic region filters can use the (chr, bin) index rather
+    than scanning every record of the chromosome.
+
+    Use --benchmark to compare the plain overlap query with the binned
+    query on one or more regions.
+    """
+    args = '<model_version_id model_version_id ...>'
+    help = 'Adds and populates the genomic bin column of record tables'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--benchmark', action='append', default=[],
+                    metavar='REGION',
+                    help='Region (chr:start-stop) to time the overlap and '
+                         'binned queries on; may be given more than once'),
+        make_option('--repeat', type='int', default=3,
+                    help='Number of times each benchmark query is run'),
+        make_option('--no-index', action='store_false', dest='index',
+                    default=True,
+                    help='Only run the benchmarks'),
+    )
+
+    def handle(self, *model_version_ids, **options):
+        if not model_version_ids:
+            raise CommandError('At least one model version id is required')
+
+        regions = [parse_region(r) for r in options['benchmark']]
+
+        for model_version_id in model_version_ids:
+            try:
+                model_version_id = int(model_version_id)
+
+                if options['index']:
+                    table = index_bins(model_version_id)
+                    self.stdout.write('Indexed bins of {0}'.format(table))
+
+                for chromosome, start, stop in regions:
+                    count, overlap, binned = benchmark_region(
+                        model_version_id, chromosome, start, stop,
+                        repeat=options['repeat'])
+
+                    self.stdout.write(
+                        '{0}:{1}-{2}: {3} records, overlap {4:.1f} ms, '
+                        'binned {5:.1f} ms'.format(
+                            chromosome, start + 1, stop, count,
+                            overlap * 1000, binned * 1000))
+            except ValueError as e:
+                raise CommandError(str(e))
@@ -0,0 +1,43 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from ceviche.models import ModelVersion
+from serrano.aggregates import precompute_model_version
+from serrano.resources.field.dist import MAXIMUM_OBSERVATIONS
+
+
+class Command(BaseCommand):
+    """Stores the stats and value counts of the fields of each model
+    version so context-unaware stats and distribution requests do not scan
+    the table.
+
+    This should be run after each data load. Aggregates of fields whose
+    data was modified since they were computed are ignored until the
+    command is run again.
+    """
+    args = '<model_version_id model_version_id ...>'
+    help = 'Precomputes the stats and distributions of fields'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-values', type='int', default=MAXIMUM_OBSERVATIONS,
+                    help='Largest number of distinct values of a field for '
+                         'which value counts are stored'),
+    )
+
+    def handle(self, *model_version_ids, **options):
+        if not model_version_ids:
+            raise CommandError('At least one model version id is required')
+
+        for model_version_id in model_version_ids:
+            try:
+                model_version = ModelVersion.objects\
+                    .get(pk=int(model_version_id))
+            except (ValueError, ModelVersion.DoesNotExist):
+                raise CommandError('Model version {0} does not exist'
+                                   .format(model_version_id))
+
+            count = precompute_model_version(
+                model_version.pk, model_version.model_name,
+                max_values=options['max_values'])
+
+            self.stdout.write('Precomputed aggregates of {0} fields of {1}'
+                              .format(count, model_version.model_name))
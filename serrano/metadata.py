@@ -0,0 +1,180 @@
+"""In-process snapshots of the concept and field metadata of a model version.
+
+Building a preview, pruning view columns or translating a genomic filter
+requires the same handful of concept and field attributes on every request.
+A snapshot loads these once per model version and is kept in worker memory.
+
+Snapshots are versioned by a generation counter stored in the shared cache.
+Any change to a DataField, DataConcept, DataConceptField or DataCategory
+increments the counter which causes every worker to rebuild its snapshots on
+the next lookup.
+"""
+import json
+import sys
+import time
+import threading
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from avocado.core.cache.model import NEVER_EXPIRE
+from avocado.models import DataField, DataConcept, DataConceptField, \
+    DataCategory
+
+__all__ = ('get_metadata', 'invalidate_metadata')
+
+GENERATION_KEY = 'serrano:metadata:generation'
+
+_snapshots = {}
+_lock = threading.Lock()
+
+
+def _initial_generation():
+    # The counter is seeded with the current time so a generation that is
+    # lost (e.g. memcached restart) never repeats an earlier value.
+    return int(time.time() * 1000)
+
+
+def get_generation():
+    "Returns the current metadata generation from the shared cache."
+    generation = cache.get(GENERATION_KEY)
+
+    if generation is None:
+        cache.add(GENERATION_KEY, _initial_generation(), NEVER_EXPIRE)
+        generation = cache.get(GENERATION_KEY)
+
+    return generation
+
+
+def invalidate_metadata():
+    """Increments the metadata generation.
+
+    This is called automatically when metadata rows are saved or deleted,
+    but must be called explicitly after bulk updates (e.g. data loads that
+    use `QuerySet.update`) since those do not send signals.
+    """
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, _initial_generation(), NEVER_EXPIRE)
+
+
+class MetadataSnapshot(object):
+    """Concept and field metadata of a single model version.
+
+    `concepts` maps concept ids to a dict of the concept's attributes
+    along with the type, allowed values and url template of its primary
+    (first) field. `fields` maps field ids to a dict of field attributes
+    and `field_ids` maps field names to ids.
+    """
+    def __init__(self, model_version_id, generation):
+        self.model_version_id = model_version_id
+        self.generation = generation
+
+        self.concepts = {}
+        self.default_concepts = []
+        self.fields = {}
+        self.field_ids = {}
+        self.field_concepts = {}
+        self.data_modified = None
+
+        # Scratch space for structures derived from this snapshot, such as
+        # compiled preview formatters. It is discarded with the snapshot.
+        self.derived = {}
+
+        self._load()
+
+    def _load(self):
+        for f in DataField.objects.filter(
+                model_version_id=self.model_version_id):
+            url_template = None
+
+            if f.keywords:
+                try:
+                    url_template = json.loads(f.keywords).get('urlTemplate')
+                except (ValueError, AttributeError):
+                    pass
+
+            self.fields[f.id] = {
+                'id': f.id,
+                'name': f.name,
+                'type': f.type,
+                'field_name': f.field_name,
+                'model_name': f.model_name,
+                'allowed_values': f.allowed_values,
+                'url_template': url_template,
+                'data_modified': f.data_modified,
+            }
+            self.field_ids[f.name] = f.id
+
+            if f.data_modified and (self.data_modified is None or
+                                    f.data_modified > self.data_modified):
+                self.data_modified = f.data_modified
+
+        concept_fields = {}
+
+        for concept_id, field_id in DataConceptField.objects\
+                .filter(concept__model_version_id=self.model_version_id)\
+                .order_by('concept', 'order', 'id')\
+                .values_list('concept_id', 'field_id'):
+            concept_fields.setdefault(concept_id, []).append(field_id)
+            self.field_concepts.setdefault(field_id, concept_id)
+
+        for c in DataConcept.objects.filter(
+                model_version_id=self.model_version_id).order_by('order'):
+            field_ids = concept_fields.get(c.id, [])
+            field = self.fields.get(field_ids[0], {}) if field_ids else {}
+
+            self.concepts[c.id] = {
+                'id': c.id,
+                'name': c.name,
+                'order': c.order or sys.maxint,
+                'published': c.published,
+                'is_default': c.is_default,
+                'model_type': c.model_type,
+                'fields': field_ids,
+                'type': field.get('type'),
+                'allowed_values': field.get('allowed_values'),
+                'url_template': field.get('url_template'),
+                'model_name': field.get('model_name'),
+            }
+
+            if c.published and c.is_default:
+                self.default_concepts.append(c.id)
+
+    def get_type_map(self):
+        "Returns a dict of concept ids to the type of their primary field."
+        return dict((pk, c['type']) for pk, c in self.concepts.items())
+
+    def find_field(self, **attrs):
+        "Returns the first field dict matching all of `attrs`."
+        for field in self.fields.values():
+            if all(field.get(k) == v for k, v in attrs.items()):
+                return field
+
+
+def get_metadata(model_version_id):
+    "Returns the current metadata snapshot for `model_version_id`."
+    generation = get_generation()
+    snapshot = _snapshots.get(model_version_id)
+
+    if snapshot is None or snapshot.generation != generation:
+        with _lock:
+            snapshot = _snapshots.get(model_version_id)
+
+            if snapshot is None or snapshot.generation != generation:
+                snapshot = MetadataSnapshot(model_version_id, generation)
+                _snapshots[model_version_id] = snapshot
+
+    return snapshot
+
+
+def _metadata_changed(sender, **kwargs):
+    invalidate_metadata()
+
+
+for _model in (DataField, DataConcept, DataConceptField, DataCategory):
+    post_save.connect(_metadata_changed, sender=_model,
+                      dispatch_uid='serrano-metadata-save-{0}'.format(
+                          _model.__name__))
+    post_delete.connect(_metadata_changed, sender=_model,
+                        dispatch_uid='serrano-metadata-delete-{0}'.format(
+                            _model.__name__))
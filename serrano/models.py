@@ -36,3 +36,136 @@ class ApiToken(models.Model):
         if not self.token:
             self.token = generate_random_token(32, test=unique_token)
         return super(ApiToken, self).save(*args, **kwargs)
+
+
+class ExportJob(models.Model):
+    """An export that runs in the background and is written to local disk.
+
+    The context and view are captured when the job is submitted so the
+    export is not affected by later changes to the session objects.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    user = models.ForeignKey(User, null=True, blank=True)
+    session_key = models.CharField(max_length=40, null=True, blank=True)
+
+    model_version_id = models.IntegerField()
+    export_type = models.CharField(max_length=50)
+    processor = models.CharField(max_length=100, default='default')
+    context_json = models.TextField(blank=True)
+    view_json = models.TextField(blank=True)
+    parallel = models.BooleanField(default=False)
+
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+                              default=PENDING)
+    rows = models.IntegerField(default=0)
+    total = models.IntegerField(null=True, blank=True)
+    filename = models.CharField(max_length=255, blank=True)
+    path = models.CharField(max_length=255, blank=True)
+    size = models.BigIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta(object):
+        ordering = ('-created',)
+
+    def __unicode__(self):
+        return u'{0} export #{1} ({2})'.format(self.export_type, self.pk,
+                                                self.status)
+
+    @property
+    def progress(self):
+        "Returns the fraction of rows written or None if unknown."
+        if self.status == self.DONE:
+            return 1.0
+        if self.total:
+            return min(1.0, float(self.rows) / self.total)
+
+
+class RegionSet(models.Model):
+    """A list of genomic regions used by region-list context filters.
+
+    Regions are stored sorted and merged so records are matched with one
+    indexed lookup rather than a clause per region. Sets are addressed by
+    the digest of their merged regions, so submitting the same panel again
+    reuses the stored set.
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    count = models.IntegerField(default=0)
+    # Length of the longest region which bounds the index range scanned
+    # per record.
+    max_length = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'{0} regions'.format(self.count)
+
+
+class Region(models.Model):
+    "A 0-based, half-open genomic interval of a region set."
+    region_set = models.ForeignKey(RegionSet, related_name='regions')
+    chr = models.CharField(max_length=20)
+    start = models.IntegerField()
+    stop = models.IntegerField()
+
+    class Meta(object):
+        index_together = (('region_set', 'chr', 'start'),)
+        ordering = ('region_set', 'chr', 'start')
+
+
+class ValueSet(models.Model):
+    """A list of distinct values used by large `in` filters, e.g. gene lists.
+
+    Sets are addressed by the digest of their sorted values, so the same
+    list submitted by any user is stored once.
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    count = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __unicode__(self):
+        return u'{0} values'.format(self.count)
+
+
+class ValueSetItem(models.Model):
+    value_set = models.ForeignKey(ValueSet, related_name='items')
+    value = models.CharField(max_length=255)
+
+    class Meta(object):
+        index_together = (('value_set', 'value'),)
+        ordering = ('value_set', 'id')
+
+
+class FieldAggregate(models.Model):
+    """Precomputed statistics and value counts of a field over all records.
+
+    Context-unaware stats and distribution requests are the same for every
+    user, so they are computed once per data load by the
+    `precompute_field_aggregates` command and served from here. An
+    aggregate is only used while the field's `data_modified` is unchanged.
+    """
+    field_id = models.IntegerField(unique=True)
+    model_version_id = models.IntegerField(null=True, db_index=True)
+    data_modified = models.DateTimeField(null=True)
+    # JSON encoded stats and distribution responses, the distribution is
+    # empty for fields whose value counts are not precomputed.
+    stats = models.TextField(blank=True)
+    distribution = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u'Aggregates of field {0}'.format(self.field_id)
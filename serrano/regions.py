@@ -0,0 +1,172 @@
+"""Region-list filters over genomic coordinates.
+
+A region list (e.g. the BED file of an exome panel) is parsed, sorted and
+merged into a `RegionSet`. Records are then matched with a single EXISTS
+subquery against the stored regions instead of a composite with a clause
+per region. Since merged regions do not overlap, only regions starting at
+most `max_length` before the record can overlap it, which bounds the index
+range scanned per record.
+"""
+import json
+import hashlib
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from serrano.genomic import get_interval_fields
+from serrano.models import RegionSet, Region
+
+REGION_LIST = 'region-list'
+
+# Number of regions inserted per statement
+REGION_BATCH_SIZE = 1000
+
+
+def normalize_chromosome(value):
+    value = value.strip()
+
+    if value[:3].lower() == 'chr':
+        value = value[3:]
+
+    return value
+
+
+def parse_regions(text):
+    """Parses regions from BED or chr:start-stop lines.
+
+    BED lines are 0-based and half-open and only the first three columns
+    are used. chr:start-stop lines are 1-based and inclusive, as entered
+    for a single region. Blank, comment, track and browser lines are
+    skipped. Returns a list of 0-based, half-open (chr, start, stop)
+    tuples.
+    """
+    regions = []
+
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+
+        if not line or line.startswith(('#', 'track', 'browser')):
+            continue
+
+        try:
+            toks = line.split()
+
+            if len(toks) >= 3:
+                chromosome, start, stop = toks[0], int(toks[1]), int(toks[2])
+            else:
+                chromosome, pos = line.replace(',', '').split(':')
+                start, stop = [int(value) for value in pos.split('-')]
+                start -= 1
+        except ValueError:
+            raise ValueError('Invalid region on line {0}'.format(lineno))
+
+        if start < 0 or stop < start:
+            raise ValueError('Invalid region on line {0}'.format(lineno))
+
+        regions.append((normalize_chromosome(chromosome), start, stop))
+
+    return regions
+
+
+def merge_regions(regions):
+    "Returns the regions sorted with overlapping and adjacent ones merged."
+    merged = []
+
+    for chromosome, start, stop in sorted(regions):
+        if merged and merged[-1][0] == chromosome and start <= merged[-1][2]:
+            if stop > merged[-1][2]:
+                merged[-1] = (chromosome, merged[-1][1], stop)
+        else:
+            merged.append((chromosome, start, stop))
+
+    return merged
+
+
+def regions_digest(regions):
+    return hashlib.sha1(json.dumps(regions, separators=(',', ':')))\
+        .hexdigest()
+
+
+def get_region_set(regions):
+    "Returns the region set of `regions`, creating it if necessary."
+    merged = merge_regions(regions)
+    digest = regions_digest(merged)
+
+    try:
+        return RegionSet.objects.get(digest=digest)
+    except RegionSet.DoesNotExist:
+        pass
+
+    max_length = max([stop - start for _, start, stop in merged] or [0])
+
+    try:
+        with transaction.commit_on_success():
+            region_set = RegionSet(digest=digest, count=len(merged),
+                                   max_length=max_length)
+            region_set.save()
+
+            Region.objects.bulk_create(
+                [Region(region_set=region_set, chr=chromosome, start=start,
+                        stop=stop)
+                 for chromosome, start, stop in merged],
+                batch_size=REGION_BATCH_SIZE)
+    except IntegrityError:
+        # Created concurrently by another request
+        return RegionSet.objects.get(digest=digest)
+
+    return region_set
+
+
+class RegionSetSubquery(object):
+    """Subquery of the primary keys of records overlapping any region of a
+    region set.
+
+    The record table is given its own alias so the EXISTS clause is bound
+    to the rows of the subquery regardless of how the outer query aliases
+    the same table.
+    """
+    alias = 'rec'
+
+    def __init__(self, region_set, model, chr_column, start_column,
+                 stop_column):
+        self.region_set = region_set
+        self.model = model
+        self.chr_column = chr_column
+        self.start_column = start_column
+        self.stop_column = stop_column
+
+    def prepare(self):
+        return self
+
+    def _as_sql(self, connection):
+        qn = connection.ops.quote_name
+
+        sql = ('SELECT {rec}.{pk} FROM {table} {rec} WHERE EXISTS ('
+               'SELECT 1 FROM {regions} r '
+               'WHERE r.region_set_id = %s AND r.chr = {rec}.{chr} '
+               'AND r.start >= {rec}.{start} - %s '
+               'AND r.start < {rec}.{stop} AND r.stop > {rec}.{start})')\
+            .format(rec=qn(self.alias),
+                    pk=qn(self.model._meta.pk.column),
+                    table=qn(self.model._meta.db_table),
+                    regions=qn(Region._meta.db_table),
+                    chr=qn(self.chr_column),
+                    start=qn(self.start_column),
+                    stop=qn(self.stop_column))
+
+        return sql, (self.region_set.pk, self.region_set.max_length)
+
+
+def region_set_condition(region_set, model_version_id, tree):
+    """Returns the condition matching records of the model version that
+    overlap any region of `region_set`.
+    """
+    chr_field, start_field, stop_field = get_interval_fields(model_version_id)
+    model = start_field.model
+
+    subquery = RegionSetSubquery(region_set, model, chr_field.field.column,
+                                 start_field.field.column,
+                                 stop_field.field.column)
+
+    lookup = tree.query_string_for_field(model._meta.pk, operator='in',
+                                         model=model)
+
+    return Q(**{lookup: subquery})
@@ -1,6 +1,8 @@
 import functools
 from datetime import datetime
 from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.http import HttpResponse, StreamingHttpResponse
 from restlib2.params import Parametizer
 from restlib2.resources import Resource
@@ -8,9 +10,9 @@ from avocado.models import DataContext, DataView, DataQuery, DataField, DataConc
 from ceviche.models import ModelSeries, ModelVersion
 from serrano.conf import settings
 from django.contrib.auth import authenticate, login
+from ..metadata import get_metadata
 from ..tokens import get_request_token
 from .. import cors
-import sys
 import urllib
 import json
 from django.db.models.sql.constants import JoinInfo
@@ -20,6 +22,8 @@ __all__ = ('BaseResource', 'ThrottledResource')
 
 SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
 
+MODEL_VERSION_CACHE_KEY = 'serrano:model_version:{0}:{1}:{2}:{3}'
+
 def get_count(queryset):
     query = queryset.query
     has_where = bool(query.where.children)
@@ -104,30 +108,181 @@ def url_from_template(value, template):
 
 
 def prune_view_columns(view, model_version_id):
-    # get required concept objects
-    order = {c.id:c.order for c in DataConcept.objects.filter(published=True)}
-    for key in order:
-        if not order[key]:
-            order[key] = sys.maxint
+    metadata = get_metadata(model_version_id)
 
     if 'columns' not in view.json:
-        concepts = [c.id for c in DataConcept.objects.filter(published=True, is_default=True)]
-        view.json['columns'] = []
-        for concept_id in concepts:
-            view.json["columns"].append(concept_id)
-
-    column_list = []
-    for c in view.json['columns']:
-        concept = DataConcept.objects.get(id=c)
-        if concept.model_version_id==model_version_id:
-            column_list.append(c)
+        view.json['columns'] = list(metadata.default_concepts)
 
-    view.json['columns'] = column_list
+    view.json['columns'] = [c for c in view.json['columns']
+                            if c in metadata.concepts]
 
     return view   
 
+
+def order_only_facets(view_node):
+    "Returns the facets of the view that are used for ordering only."
+    return [f for f in view_node.facets if not f.get('visible', True)]
+
+
+def order_only_columns(view_node, model_version_id):
+    """Returns the (table, column) pairs of the ordering-only facets of the
+    view which are not also columns of a visible concept.
+    """
+    hidden = set(f['concept'] for f in order_only_facets(view_node))
+
+    if not hidden:
+        return set()
+
+    visible = set(c.id for c in view_node.get_concepts_for_select())
+    metadata = get_metadata(model_version_id)
+
+    def columns(concept_ids):
+        cols = set()
+        for pk in concept_ids:
+            concept = metadata.concepts.get(pk)
+            if not concept:
+                continue
+            for field_id in concept['fields']:
+                field = metadata.fields[field_id]
+                cols.add((field['model_name'], field['field_name']))
+        return cols
+
+    return columns(hidden - visible) - columns(visible)
+
+
+def _select_column(query, select):
+    alias, column = select[0], select[1]
+    join = query.alias_map.get(alias)
+    return (join.table_name if join else alias), column
+
+
+def drop_order_only_columns(queryset, view_node, model_version_id):
+    """Removes the columns of ordering-only facets from the select list.
+
+    The columns remain referenced by the ORDER BY clause, but are no longer
+    part of the projected rows. Columns shared with a visible concept are
+    kept.
+
+    DISTINCT queries require the ORDER BY columns to be selected, which
+    Django does by adding them after the projected columns and stripping
+    them from the rows. Rows are then distinct by the hidden columns as
+    well, like they were while the columns were projected.
+    """
+    dropped = order_only_columns(view_node, model_version_id)
+
+    if not dropped:
+        return queryset
+
+    query = queryset.query
+    keep = [_select_column(query, s) not in dropped for s in query.select]
+
+    if len(query.select_fields) == len(query.select):
+        query.select_fields = [f for f, k in zip(query.select_fields, keep)
+                               if k]
+    query.select = [s for s, k in zip(query.select, keep) if k]
+
+    return queryset
+
+
+def requires_unbounded_read(queryset, view_node, model_version_id,
+                            limit=None, offset=None):
+    """Returns True if `limit` and `offset` cannot be applied by the query.
+
+    Rows of a DISTINCT query that still projects the columns of
+    ordering-only facets may only differ by those hidden columns and are
+    collapsed by the exporter, so there is no guarantee how many rows are
+    needed for `limit` output rows. Once the columns are dropped (see
+    `drop_order_only_columns`) the rows are output as read and the bounds
+    are pushed down.
+    """
+    if limit is None and not offset:
+        return False
+
+    if not queryset.query.distinct:
+        return False
+
+    hidden = order_only_columns(view_node, model_version_id)
+    query = queryset.query
+
+    return any(_select_column(query, s) in hidden for s in query.select)
+
+
+def _model_version_data(model_version):
+    "Returns the plain dict representation of a `ModelVersion` instance."
+    series = model_version.series
+
+    data = dict((f.attname, getattr(model_version, f.attname))
+                for f in model_version._meta.fields)
+    data['model_type'] = series.model_type
+    data['record_type'] = series.record_type
+    data['series_name'] = series.name
+    data['keys'] = series.aux_data.get("keys", [])
+
+    return data
+
+
+def _resolve_model_version(series_id, version, model_type, record_type):
+    """Resolves the model version data for the series components.
+
+    The resolved data is cached across requests since the same handful of
+    model versions are looked up by every request for a given page.
+    """
+    key = MODEL_VERSION_CACHE_KEY.format(series_id, version, model_type,
+                                         record_type)
+    data = cache.get(key)
+
+    if data is None:
+        model_version = ModelVersion.objects.select_related('series')\
+            .get(series__id=series_id, version=version,
+                 series__model_type=model_type,
+                 series__record_type=record_type)
+
+        data = _model_version_data(model_version)
+        cache.set(key, data, settings.MODEL_VERSION_CACHE_TIMEOUT)
+
+    return data
+
+
+def get_model_version_data(model_version_id):
+    "Returns the model version data for `model_version_id`."
+    model_version = ModelVersion.objects.select_related('series')\
+        .get(pk=model_version_id)
+    return _model_version_data(model_version)
+
+
+def invalidate_model_version(model_version):
+    "Removes the cached data for `model_version` from the shared cache."
+    series = model_version.series
+    cache.delete(MODEL_VERSION_CACHE_KEY.format(
+        series.id, model_version.version, series.model_type,
+        series.record_type))
+
+
+@receiver(post_save, sender=ModelVersion)
+@receiver(post_delete, sender=ModelVersion)
+def model_version_changed(sender, instance, **kwargs):
+    invalidate_model_version(instance)
+
+
+@receiver(post_save, sender=ModelSeries)
+@receiver(post_delete, sender=ModelSeries)
+def model_series_changed(sender, instance, **kwargs):
+    for model_version in ModelVersion.objects.filter(series=instance):
+        invalidate_model_version(model_version)
+
+
 def extract_model_version(request):
-    
+    """Returns the model version data referenced by the request.
+
+    The model version is derived from PATH_INFO or the referring page. The
+    result is memoized on the request since many code paths resolve it
+    several times over the course of a single request.
+    """
+    data = getattr(request, '_model_version', None)
+
+    if data is not None:
+        return data
+
     url_components = []
 
     if 'PATH_INFO' in request.META: url_components = request.META['PATH_INFO'].split('/')
@@ -142,16 +297,12 @@ def extract_model_version(request):
     series_version = int(url_components[len(url_components)-3])
     series_id = int(url_components[len(url_components)-4].split('-')[0])
     model_type, record_type = url_components[len(url_components)-5].split('_')
-    model_version = ModelVersion.objects.get(series__id=series_id, version=series_version, series__model_type=model_type, series__record_type=record_type)
-    record_type = model_version.series.record_type
-        
-    model_version_data = model_version.__dict__   
-    model_version_data['model_type']  = model_version.series.model_type
-    model_version_data['record_type'] = record_type
-    model_version_data['series_name'] = model_version.series.name
-    model_version_data['keys'] = model_version.series.aux_data.get("keys", [])
 
-    return model_version_data
+    data = _resolve_model_version(series_id, series_version, model_type,
+                                  record_type)
+    request._model_version = data
+
+    return data
 
 
 def page_type(request):
@@ -161,7 +312,12 @@ def page_type(request):
     elif 'results' in url_components: return 'results'
     else: return 'other'
 
-def map_concepts_to_models():
+def map_concepts_to_models(model_version_id=None):
+    if model_version_id is not None:
+        metadata = get_metadata(model_version_id)
+        return dict((pk, c['model_name'])
+                    for pk, c in metadata.concepts.items())
+
     query = ("select avocado_datafield.id, conceptfield.concept_id, avocado_datafield.model_name from (select * from "
     "avocado_dataconcept inner join avocado_dataconceptfield on avocado_dataconcept.id=avocado_dataconceptfield.concept_id) "
     "as conceptfield left outer join avocado_datafield on avocado_datafield.id=conceptfield.field_id;")
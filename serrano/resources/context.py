@@ -3,17 +3,24 @@ import logging
 from datetime import datetime
 from django.conf.urls import patterns, url
 from django.core.urlresolvers import reverse
-from django.db import connection
 from django.views.decorators.cache import never_cache
 from restlib2.http import codes
 from restlib2.params import Parametizer, StrParam
 from preserialize.serialize import serialize
 from modeltree.tree import trees
 from avocado.events import usage
-from avocado.models import DataContext, DataConcept, DataField
+from avocado.models import DataContext
 from avocado.query import pipeline
-from ceviche.models import ModelVersion
+from serrano.composites import COMPOSITE_KEYWORDS, CompositeContextBuilder
+from serrano.conf import settings
+from serrano.counts import count_pending, schedule_context_count
 from serrano.forms import ContextForm
+from serrano.genomic import BIN_FIELD_NAME, MAX_POSITION, bin_range_children, \
+    bin_range_sql
+from serrano.metadata import get_metadata
+from serrano.models import RegionSet, ValueSet
+from serrano.regions import REGION_LIST, parse_regions, get_region_set
+from serrano.valuesets import IN_SET, get_value_set
 from .base import ThrottledResource, extract_model_version
 from .history import RevisionsResource, ObjectRevisionsResource, \
     ObjectRevisionResource
@@ -24,24 +31,21 @@ import json
 
 log = logging.getLogger(__name__)
 
-def get_all_samples(model_version_id):
-    cursor = connection.cursor()
-    model_version = ModelVersion.objects.get(id=model_version_id)
-    entity_table = model_version.model_name + '_entity'
-    query = ('SELECT ' + entity_table + '."samples" '
-             'FROM ' + entity_table + ', sample_record_schema '
-             'WHERE ' + entity_table + '.samples=sample_record_schema.id;');
-    cursor.execute(query)
-    samples = [r[0] for r in cursor.fetchall()]
-    return samples
+ALL_SAMPLES = '_all_'
+
+def build_sample_child(concept, sample, sample_field):
+    min_size = settings.VALUE_SET_MIN_SIZE
+    if min_size is not None and len(sample) > min_size:
+        # Large cohorts are applied as a semi-join against a shared value set
+        value_set = get_value_set(sample)
+        return {'concept':concept, 'language':'Sample', 'required':False, 'value':value_set.pk, 'field':sample_field['id'], 'operator':IN_SET}
+    return {'concept':concept, 'language':'Sample', 'required':False, 'value':sample, 'field':sample_field['id'], 'operator':'in'}
 
 # pulls the sample info from the child if it exists
 # then constructs a composite query with both the sample and query field 
 def pull_samples(child, model_version_id, context_resource, request, processor, tree):
-    try:
-        sample_field = DataField.objects.get(model_version_id=model_version_id, field_name='samples', type='Sample')
-    except:
-        sample_field = None
+    sample_field = get_metadata(model_version_id).find_field(
+        field_name='samples', type='Sample')
 
     concept = child['concept']
     if type(child['value'])==list:
@@ -52,8 +56,11 @@ def pull_samples(child, model_version_id, context_resource, request, processor,
 
         if type(sample_json)==dict and 'samples' in sample_json:
             sample = sample_json['samples']
-            if '_all_' in sample:
-                sample = get_all_samples(model_version_id)
+            # Every record belongs to one of the project's samples so the
+            # whole cohort does not constrain the query.
+            all_samples = ALL_SAMPLES in sample
+            if all_samples:
+                sample = [ALL_SAMPLES]
             child['value'] = child['value'][1]
             new_child = child
             if(sample):
@@ -62,8 +69,11 @@ def pull_samples(child, model_version_id, context_resource, request, processor,
                     child = { 'composite': composite_id, 'field':child['field'], 'concept':child['concept'], 
                                   'language':language, 'operator':child['operator'], 'value':child['value']}
 
-                sample_child  = {'concept':concept, 'language':'Sample', 'required':False, 'value':sample, 'field':sample_field.id, 'operator':'in'}
-                and_id = save_composite_context(request, [sample_child, child], 'and', processor, tree)[0]
+                if all_samples:
+                    and_id = save_composite_context(request, [child], 'and', processor, tree)[0]
+                else:
+                    sample_child = build_sample_child(concept, sample, sample_field)
+                    and_id = save_composite_context(request, [sample_child, child], 'and', processor, tree)[0]
 
                 if sample_json['cohort']=='custom cohort':
                     if len(sample) <= 4:
@@ -93,6 +103,7 @@ def remove_quotes(value):
 def build_composite_contexts(context, req, child, processor, tree):
     children = []
     logic = 'or'
+    metadata = get_metadata(extract_model_version(req)['id'])
 
     for i, op in enumerate(child['operator']):
         newchild = child.copy()
@@ -101,7 +112,7 @@ def build_composite_contexts(context, req, child, processor, tree):
 
         field_id = newchild.get('field', '')
         if field_id:
-            data_type = DataField.objects.get(id=field_id).type
+            data_type = metadata.fields[int(field_id)]['type']
             if data_type=='Boolean' and type(newchild['value'])==list:
                 newchild['value'].remove('Missing')
 
@@ -116,6 +127,12 @@ def build_composite_contexts(context, req, child, processor, tree):
     return save_composite_context(req, children, logic, processor, tree)
 
 def save_composite_context(req, children, logic, processor, tree):
+    # Within update_children the composite is collected by the request's
+    # builder and a reference is returned in place of the id.
+    builder = getattr(req, 'composite_builder', None)
+    if builder is not None:
+        return builder.add(children, logic)
+
     if req:
         request = copy.copy(req)
         request.data['json']['type'] = logic
@@ -142,16 +159,24 @@ def get_chromosomes_between(chr1, chr2):
     return chromosomes[start+1:stop] 
 
 def build_gene_list_contexts(context, req, child, processor, tree, model_version_id):
-    field = DataField.objects.get(id=child['field'])
-    
-    concept_query = ("select avocado_dataconceptfield.id, avocado_dataconcept.id as cid from avocado_dataconcept, avocado_dataconceptfield where "        
-                     "avocado_dataconcept.id=avocado_dataconceptfield.concept_id and avocado_dataconceptfield.field_id=" + str(field.id) + ";")
-
-    concept = [c.cid for c in DataConcept.objects.raw(concept_query)][0]
+    metadata = get_metadata(model_version_id)
+    field = metadata.fields[int(child['field'])]
+    concept = metadata.field_concepts[field['id']]
 
     language = 'Gene name matches ' + child['value'][1] + '. '
-    values = child['value'][0].replace(' ', ',').replace(';', ',').replace('\n', ',').split(',')
-    values = [v.strip() for v in values if v.strip()]
+    value_set = None
+    if isinstance(child['value'][0], (int, long)):
+        # Reference to a list stored by a previous save
+        value_set = ValueSet.objects.get(pk=child['value'][0])
+        values = list(value_set.items.values_list('value', flat=True)[:5])
+    else:
+        values = child['value'][0].replace(' ', ',').replace(';', ',').replace('\n', ',').split(',')
+        values = [v.strip() for v in values if v.strip()]
+        min_size = settings.VALUE_SET_MIN_SIZE
+        if min_size is not None and len(values) > min_size:
+            value_set = get_value_set(values)
+            # Only the reference is kept in the context, not the pasted list
+            child['value'] = [value_set.pk] + list(child['value'][1:])
     shown_values = values
     if len(values)>4:
         shown_values = values[0:4] + ['...']
@@ -161,12 +186,32 @@ def build_gene_list_contexts(context, req, child, processor, tree, model_version
     else:
         language += 'Includes: ' + ', '.join(shown_values)
 
-    query = {'concept':concept, 'language':language, 'required':False, 'value':values, 'field':field.id, 'operator':'in'}
+    if value_set:
+        query = {'concept':concept, 'language':language, 'required':False, 'value':value_set.pk, 'field':field['id'], 'operator':IN_SET}
+    else:
+        query = {'concept':concept, 'language':language, 'required':False, 'value':values, 'field':field['id'], 'operator':'in'}
     return save_composite_context(req, [query], 'and', processor, tree)[0], language 
 
+def build_bin_child(request, fields, concept, start, stop, processor, tree):
+    # Narrows a region to the records of the overlapping bins, which lets
+    # the database use the (chr, bin) index. Only model versions indexed
+    # with the index_genomic_bins command have a bin field.
+    if BIN_FIELD_NAME not in fields:
+        return None, None
+
+    # Regions beyond the binning scheme are left to the coordinate children
+    try:
+        children = bin_range_children(fields[BIN_FIELD_NAME], concept, start, stop)
+    except ValueError:
+        return None, None
+
+    bin_id = save_composite_context(request, children, 'or', processor, tree)[0]
+    bin_child = {'concept':concept, 'language':'Bin overlaps region', 'composite':bin_id}
+    return bin_child, bin_range_sql(start, stop)
+
 def build_genomic_query(coordinates, model_version_id, tree, request=None, processor=None):
-    field_query = ("select * from avocado_datafield where model_version_id='" + str(model_version_id) + "' and name in ('Pos Start', 'Pos Stop', 'Chromosome', 'Start', 'Stop', 'Chr');")
-    fields = {f.name:f.id for f in DataField.objects.raw(field_query)}
+    metadata = get_metadata(model_version_id)
+    fields = metadata.field_ids
     language = 'Coordinate overlaps with region ' + coordinates
     coordinates = coordinates.replace('Chr', '').replace('chr', '').replace(',', '')
     
@@ -182,10 +227,7 @@ def build_genomic_query(coordinates, model_version_id, tree, request=None, proce
         start_field = {'id':fields['Start'], 'name':'Start', 'symbol':'pos_start'}
         stop_field  = {'id':fields['Stop'], 'name':'Stop', 'symbol':'pos_stop'}
 
-    concept_query = ("select avocado_dataconceptfield.id, avocado_dataconcept.id as cid from avocado_dataconcept, avocado_dataconceptfield where "        
-                     "avocado_dataconcept.id=avocado_dataconceptfield.concept_id and avocado_dataconceptfield.field_id=" + str(stop_field['id']) + ";")
-
-    concept = [c.cid for c in DataConcept.objects.raw(concept_query)][0]
+    concept = metadata.field_concepts[stop_field['id']]
 
     if ':' not in coordinates:
         if '-' in coordinates:
@@ -233,16 +275,29 @@ def build_genomic_query(coordinates, model_version_id, tree, request=None, proce
             and_child  = {'concept':concept, 'language':'Start is in range or Stop is in range', 'composite':and_id}
             or_query  = '(' + start_query + ' OR ' + stop_query + ')'
             sql_query = '(' + or_query + ' AND ' + chr_query + ')'
-            
+            children = [chr_child, and_child]
+
+            bin_child, bin_query = build_bin_child(request, fields, concept, start, stop, processor, tree)
+            if bin_child:
+                children.append(bin_child)
+                sql_query = '(' + or_query + ' AND ' + chr_query + ' AND ' + bin_query + ')'
+
             # (segment2Start == segment2Stop) && ((segment2Start == segment1Start) || (segment2Start == segment1Stop)) 
-            context_query = save_composite_context(request, [chr_child, and_child], 'and', processor, tree)[0]
+            context_query = save_composite_context(request, children, 'and', processor, tree)[0]
         else:
             # if stop was not specified then do an exact query
             start_child = {'concept':concept, 'language':'Start in range', 'required':False, 'enabled':True, 
                        'value':start, 'field':start_field['id'], 'operator':'exact'}
             start_query = start_field['symbol'] + ' = ' + str(start)
             sql_query = '(' + start_query + ' AND ' + chr_query + ')'
-            context_query = save_composite_context(request, [chr_child, start_child], 'and', processor, tree)[0]
+            children = [chr_child, start_child]
+
+            bin_child, bin_query = build_bin_child(request, fields, concept, start, start + 1, processor, tree)
+            if bin_child:
+                children.append(bin_child)
+                sql_query = '(' + start_query + ' AND ' + chr_query + ' AND ' + bin_query + ')'
+
+            context_query = save_composite_context(request, children, 'and', processor, tree)[0]
     elif coordinates.count(':')==2:
         chr1 = coordinates.split(':')[0].strip()
         chr2 = coordinates.split('-')[1].split(':')[0].strip()
@@ -257,6 +312,9 @@ def build_genomic_query(coordinates, model_version_id, tree, request=None, proce
         first_or_query = '(' + first_start_query + ' OR ' + first_stop_query + ')'
         first_chr_query = "chr = '" + chr1 + "'"
         first_and_query = '(' + first_or_query + ' AND ' + first_chr_query + ')'
+        first_bin_child, first_bin_query = build_bin_child(request, fields, concept, int(start), MAX_POSITION, processor, tree)
+        if first_bin_child:
+            first_and_query = '(' + first_or_query + ' AND ' + first_chr_query + ' AND ' + first_bin_query + ')'
         clauses.append(first_and_query)
 
         # construct context for condition ((variant.stop>query.start or variant.start>query.start) and variant.chr=query.chr1)
@@ -267,7 +325,10 @@ def build_genomic_query(coordinates, model_version_id, tree, request=None, proce
         first_or_id = save_composite_context(request, [first_start_child, first_stop_child], 'or', processor, tree)[0]
         first_or_child  = {'concept':concept, 'language':'Start is in range or Stop is in range', 'composite':first_or_id}
         first_chr_child = {'concept':concept, 'language':'Chromosome equals', 'required':False, 'value':chr1, 'field':chr_field['id'], 'operator':'exact'}
-        first_and_id = save_composite_context(request, [first_chr_child, first_or_child], 'and', processor, tree)[0]
+        first_children = [first_chr_child, first_or_child]
+        if first_bin_child:
+            first_children.append(first_bin_child)
+        first_and_id = save_composite_context(request, first_children, 'and', processor, tree)[0]
         first_and_child = {'concept':concept, 'language':'Start or Stop is in first chromosome range', 'composite':first_and_id}
         contexts.append(first_and_child)
 
@@ -284,6 +345,9 @@ def build_genomic_query(coordinates, model_version_id, tree, request=None, proce
         last_or_query    = '(' + last_start_query + ' OR ' + last_stop_query + ')'
         last_chr_query = "chr = '" + chr2 + "'"
         last_and_query = '(' + last_or_query + ' AND ' + last_chr_query + ')'
+        last_bin_child, last_bin_query = build_bin_child(request, fields, concept, 0, int(stop), processor, tree)
+        if last_bin_child:
+            last_and_query = '(' + last_or_query + ' AND ' + last_chr_query + ' AND ' + last_bin_query + ')'
         clauses.append(last_and_query)
         sql_query = '(' + ' OR '.join(clauses) + ')'
 
@@ -295,7 +359,10 @@ def build_genomic_query(coordinates, model_version_id, tree, request=None, proce
         last_or_id = save_composite_context(request, [last_start_child, last_stop_child], 'or', processor, tree)[0]
         last_or_child   = {'concept':concept, 'language':'Start is in range or Stop is in range', 'composite':last_or_id}
         last_chr_child  = {'concept':concept, 'language':'Chromosome equals', 'required':False, 'value':chr2, 'field':chr_field['id'], 'operator':'exact'}
-        last_and_id = save_composite_context(request, [last_chr_child, last_or_child], 'and', processor, tree)[0]
+        last_children = [last_chr_child, last_or_child]
+        if last_bin_child:
+            last_children.append(last_bin_child)
+        last_and_id = save_composite_context(request, last_children, 'and', processor, tree)[0]
         last_and_child = {'concept':concept, 'language':'Start or Stop is in last chromosome range', 'composite':last_and_id}
         contexts.append(last_and_child)
         context_query = save_composite_context(request, contexts, 'or', processor, tree)[0]
@@ -306,6 +373,28 @@ def build_genomic_contexts(context, req, child, processor, tree, model_version_i
     context_query, sql_query, language = build_genomic_query(child['value'], model_version_id, tree, request=req, processor=processor)
     return context_query, language
     
+def get_region_list_set(value):
+    # The value is either the id of an uploaded region set or the regions
+    if isinstance(value, (int, long)) or \
+            (isinstance(value, basestring) and value.strip().isdigit()):
+        return RegionSet.objects.get(pk=int(value))
+    if isinstance(value, list):
+        value = '\n'.join(value)
+    return get_region_set(parse_regions(value))
+
+def build_region_list_contexts(context, req, child, processor, tree, model_version_id):
+    fields = get_metadata(model_version_id).field_ids
+    chr_id = fields['Chromosome'] if 'Chromosome' in fields else fields['Chr']
+    concept = get_metadata(model_version_id).field_concepts[chr_id]
+
+    region_set = get_region_list_set(child['value'])
+    # Only the reference is kept in the context, not the pasted regions
+    child['value'] = region_set.pk
+
+    language = 'Coordinate overlaps with {0} regions'.format(region_set.count)
+    query = {'concept':concept, 'language':language, 'required':False, 'value':region_set.pk, 'field':chr_id, 'operator':REGION_LIST}
+    return save_composite_context(req, [query], 'and', processor, tree)[0], language
+
 def gen_id(s):
     #use hash to generate id
     md5 =  hashlib.md5()
@@ -337,6 +426,7 @@ def context_posthook(instance, data, request, tree):
 
 def update_children(context_resource, model_version_id, model_type, request, processor, tree):
     if 'json' in request.data and request.data['json']:
+        request.composite_builder = CompositeContextBuilder(request, model_version_id)
         newchildren = []
         for child in request.data['json']['children']:
             if model_type=='project':
@@ -354,6 +444,8 @@ def update_children(context_resource, model_version_id, model_type, request, pro
             child = pull_samples(child, model_version_id, context_resource, request, processor, tree)
             if child.get('operator')=='genomic-coordinate':
                 composite_id, language = build_genomic_contexts(context_resource, request, child, processor, tree, model_version_id)
+            elif child.get('operator')==REGION_LIST:
+                composite_id, language = build_region_list_contexts(context_resource, request, child, processor, tree, model_version_id)
             elif child.get('operator')=='match-list':
                 composite_id, language = build_gene_list_contexts(context_resource, request, child, processor, tree, model_version_id)
             elif type(child.get('operator')) is list and 'composite' not in child:
@@ -371,6 +463,13 @@ def update_children(context_resource, model_version_id, model_type, request, pro
         request.data['json']['children'] = newchildren
         request.data['json']['type'] = 'and' 
 
+        # Write all new composites at once and replace their references
+        # with the ids.
+        builder = request.composite_builder
+        del request.composite_builder
+        builder.flush()
+        request.data['json'] = builder.resolve(request.data['json'])
+
     return request
 
 
@@ -453,9 +552,10 @@ class ContextBase(ThrottledResource):
 class ContextsResource(ContextBase):
     "Resource of contexts"
     def get(self, request):
-        queryset = self.get_queryset(request)
+        # Composites are only referenced from within other contexts
+        queryset = self.get_queryset(request)\
+            .exclude(keywords__contains=COMPOSITE_KEYWORDS)
 
-        
         # Only create a default if a session exists
         if request.session.session_key:
             queryset = list(queryset)
@@ -468,9 +568,7 @@ class ContextsResource(ContextBase):
         model_version = extract_model_version(request)
         schema_tree = model_version['model_name']
 
-        prep = [q for q in self.prepare(request, queryset, tree=schema_tree) if 'composite' not in q['keywords'] ]
-
-        return prep
+        return self.prepare(request, queryset, tree=schema_tree)
 
     def post(self, request):
         params = self.get_params(request)
@@ -560,6 +658,26 @@ class ContextStatsResource(ContextBase):
     def get(self, request, **kwargs):
         instance = self.get_object(request, **kwargs)
 
+        if settings.ASYNC_CONTEXT_COUNT:
+            # Counts are written back by the background worker. If no count
+            # is stored or pending, one is scheduled now.
+            if instance.count is None and not count_pending(instance.pk):
+                params = self.get_params(request)
+                model_version = extract_model_version(request)
+                schedule_context_count(instance.pk, model_version,
+                                       params['processor'],
+                                       model_version['model_name'],
+                                       user_id=instance.user_id,
+                                       session_key=instance.session_key)
+
+            sync = instance.count is not None and \
+                bool((instance.json or {}).get('sync', True))
+
+            return {
+                'count': instance.count,
+                'sync': sync,
+            }
+
         count = instance.apply().distinct().count()
 
         return {
@@ -567,9 +685,51 @@ class ContextStatsResource(ContextBase):
         }
 
 
+class RegionSetsResource(ContextBase):
+    """Creates region sets from uploaded BED files or pasted regions.
+
+    The returned id can be used as the value of a region-list filter so
+    large panels are only sent and parsed once.
+    """
+    def post(self, request):
+        upload = request.FILES.get('file')
+
+        if upload:
+            text = upload.read()
+        else:
+            text = (request.data or {}).get('regions') or ''
+
+        try:
+            regions = parse_regions(text)
+        except ValueError as e:
+            data = {
+                'message': str(e),
+            }
+            return self.render(request, data,
+                               status=codes.unprocessable_entity)
+
+        if not regions:
+            data = {
+                'message': 'No regions specified',
+            }
+            return self.render(request, data,
+                               status=codes.unprocessable_entity)
+
+        region_set = get_region_set(regions)
+
+        data = {
+            'id': region_set.pk,
+            'count': region_set.count,
+            'submitted': len(regions),
+        }
+
+        return self.render(request, data, status=codes.created)
+
+
 single_resource = never_cache(ContextResource())
 stats_resource = never_cache(ContextStatsResource())
 active_resource = never_cache(ContextsResource())
+regions_resource = never_cache(RegionSetsResource())
 revisions_resource = never_cache(RevisionsResource(
     object_model=DataContext, object_model_template=templates.Context,
     object_model_base_uri='serrano:contexts'))
@@ -593,6 +753,9 @@ urlpatterns = patterns(
     url(r'^(?P<pk>\d+)/stats/$', stats_resource,  name='stats'),
     url(r'^session/stats/$', stats_resource, {'session': True}, name='stats'),
 
+    # Region sets for region-list filters
+    url(r'^regions/$', regions_resource, name='regions'),
+
     # Revision related endpoints
     url(r'^revisions/$', revisions_resource, name='revisions'),
     url(r'^(?P<pk>\d+)/revisions/$', revisions_for_object_resource,
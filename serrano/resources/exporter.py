@@ -1,15 +1,29 @@
-from datetime import datetime
+import os
+import json
+from django.db import transaction
 from django.http import HttpResponse, Http404, StreamingHttpResponse
 from django.conf.urls import patterns, url
 from django.core.urlresolvers import reverse
 from django.shortcuts import render
-from restlib2.params import Parametizer, IntParam, StrParam
+from restlib2.http import codes
+from restlib2.params import Parametizer, IntParam, StrParam, BoolParam
 from avocado.export import registry as exporters
 from avocado.query import pipeline
 from avocado.events import usage
 from ..conf import settings
+from ..conf import dep_supported
+from ..exports import COMPRESSIONS, order_export_queryset, \
+    get_export_filename, enqueue_export_job, delete_export_job, \
+    maintain_export_jobs, parse_range, read_file, \
+    export_fingerprint, export_owner, get_cached_export, cache_export, \
+    store_export, compress_chunks, parallel_export_supported, get_partitions, \
+    parallel_export
+from ..models import ExportJob
 from . import API_VERSION
-from .base import BaseResource, extract_model_version, prune_view_columns
+from .base import BaseResource, extract_model_version, prune_view_columns, \
+    drop_order_only_columns, requires_unbounded_read
+from .pagination import CURSOR_HEADER, get_keyset, decode_cursor, seek, \
+    get_next_cursor
 
 # Single list of all registered exporters
 EXPORT_TYPES = zip(*exporters.choices)[0]
@@ -39,9 +53,68 @@ class ExporterRootResource(BaseResource):
         return resp
 
 
+def file_response(path, sendfile=True):
+    """Returns a response serving the file at `path`.
+
+    If a sendfile header is configured, the file is served by the web
+    server rather than being streamed by the application.
+    """
+    if sendfile and settings.EXPORT_SENDFILE_HEADER:
+        if settings.EXPORT_SENDFILE_PREFIX:
+            location = settings.EXPORT_SENDFILE_PREFIX.rstrip('/') + '/' + \
+                os.path.basename(path)
+        else:
+            location = path
+
+        resp = HttpResponse()
+        resp[settings.EXPORT_SENDFILE_HEADER] = location
+    else:
+        resp = StreamingHttpResponse(read_file(path))
+        resp['Content-Length'] = str(os.path.getsize(path))
+
+    return resp
+
+
+def get_export_encoding(request, compress=None):
+    """Returns the compression of the export and whether it applies to the
+    attachment itself.
+
+    An explicit `compress` parameter produces a compressed attachment (e.g.
+    a .gz file). Otherwise gzip is negotiated as the transfer encoding from
+    the Accept-Encoding header if enabled. ValueError is raised for
+    unsupported compressions.
+    """
+    if compress:
+        compress = compress.lower()
+
+        if compress in ('1', 'true'):
+            compress = 'gzip'
+
+        if compress not in COMPRESSIONS:
+            raise ValueError('Unsupported compression')
+
+        if compress == 'zstd' and not dep_supported('zstandard'):
+            raise ValueError('zstd compression is not available')
+
+        return compress, True
+
+    if settings.EXPORT_ACCEPT_ENCODING:
+        accept = request.META.get('HTTP_ACCEPT_ENCODING', '')
+        encodings = [e.split(';')[0].strip() for e in accept.split(',')]
+
+        if 'gzip' in encodings:
+            return 'gzip', False
+
+    return None, False
+
+
 class ExporterParametizer(Parametizer):
     limit = IntParam(20)
     processor = StrParam('default', choices=pipeline.query_processors)
+    cursor = BoolParam(False)
+    after = StrParam()
+    compress = StrParam()
+    parallel = BoolParam(False)
 
 class ExporterResource(BaseResource):
     cache_max_age = 0
@@ -89,8 +162,42 @@ class ExporterResource(BaseResource):
             # When no page or range is specified, the limit does not apply.
             limit = None
 
-        QueryProcessor = pipeline.query_processors[params['processor']]
         view =  prune_view_columns(view, model_version['id'])
+
+        try:
+            encoding, attachment = get_export_encoding(
+                request, params.get('compress'))
+        except ValueError as e:
+            return self.render(request, {'message': unicode(e)},
+                               status=codes.unprocessable_entity)
+
+        # Whole exports are served from the result cache when an identical
+        # export has been produced for the current data.
+        fingerprint = None
+        extension = exporters[export_type].file_extension
+
+        owner = export_owner(request)
+
+        if not page and owner and \
+                not (params.get('cursor') or params.get('after')):
+            fingerprint = export_fingerprint(context.json, view.json,
+                                             export_type, params['processor'],
+                                             model_version['id'],
+                                             owner=owner)
+            path = get_cached_export(fingerprint, extension)
+
+            if path:
+                # The web server cannot compress the file on the fly
+                resp = file_response(path, sendfile=not encoding)
+                filename = get_export_filename(model_version,
+                                               exporters[export_type])
+
+                return self._prepare_response(request, resp, export_type,
+                                              filename, partial=False,
+                                              cached=True, encoding=encoding,
+                                              attachment=attachment)
+
+        QueryProcessor = pipeline.query_processors[params['processor']]
         processor = QueryProcessor(context=context,
                                    view=view,
                                    tree=tree,
@@ -98,31 +205,49 @@ class ExporterResource(BaseResource):
 
         queryset = processor.get_queryset(request=request)
 
+        # Keyset (cursor) mode exports the `limit` rows following the
+        # `after` cursor. It applies only to unpaged exports of tables with
+        # a deterministic key when the view does not impose an ordering.
+        keyset = get_keyset(model_version)
+        after = params.get('after')
+        use_keyset = bool((params.get('cursor') or after) and keyset and
+                          params.get('limit') and not page and
+                          not queryset.query.order_by)
+
+        use_parallel = False
 
         queryset.query.distinct = True
-        if model_version['model_type']=='project':
-            queryset.query.order_by = []
-            queryset.query.distinct = False
-        elif model_version['record_type'] in ['coverageregion', 'region', 'cnv', 'loh']:
-            queryset.query.order_by = queryset.query.order_by + ['chr', 'pos_start', 'pos_stop']
-            for key in model_version["keys"]:
-                queryset.query.order_by.append(key["symbol"])
-        elif not model_version['record_type']=='sample':
-            queryset.query.order_by = queryset.query.order_by + ['chr', 'pos_start', 'pos_stop', 'ref_alts']
+        if use_keyset:
+            limit = params.get('limit')
+            queryset.query.order_by = list(keyset)
+
+            if after:
+                try:
+                    queryset = seek(queryset, keyset, decode_cursor(after))
+                except ValueError:
+                    return self.render(request, {'message': 'Invalid cursor'},
+                                       status=codes.unprocessable_entity)
+        else:
+            # Parallel exports are partitioned by chromosome which is only
+            # possible if the view does not impose its own ordering.
+            use_parallel = bool(params.get('parallel') and not page and
+                                parallel_export_supported(
+                                    export_type, model_version, queryset))
+
+            order_export_queryset(queryset, model_version)
 
         exporter = processor.get_exporter(exporters[export_type])
 
         view_node = view.parse()
 
-        # This is an optimization when concepts are selected for ordering
-        # only. There is not guarantee to how many rows are required to get
-        # the desired `limit` of rows, so the query is unbounded. If all
-        # ordering facets are visible, the limit and offset can be pushed
-        # down to the query.
-        order_only = lambda f: not f.get('visible', True)
+        # Concepts selected for ordering only are kept in the ORDER BY, but
+        # not projected, so the limit and offset are pushed down to the
+        # query.
+        drop_order_only_columns(queryset, view_node, model_version['id'])
 
         generator = getattr(exporter, "generator", None)
-        if filter(order_only, view_node.facets):
+        if requires_unbounded_read(queryset, view_node, model_version['id'],
+                                   limit, offset):
             iterable = processor.get_iterable(request=request,
                                               queryset=queryset)
 
@@ -139,28 +264,86 @@ class ExporterResource(BaseResource):
                                               limit=limit,
                                               offset=offset)
 
-            if callable(generator): 
-                resp = StreamingHttpResponse(exporter.generator(iterable,
+            chunks = None
+
+            if use_parallel:
+                if getattr(request, 'user', None) and \
+                        request.user.is_authenticated():
+                    user_id = request.user.pk
+                else:
+                    user_id = None
+
+                chunks = parallel_export(model_version, context.json,
+                                         view.json, params['processor'],
+                                         export_type, get_partitions(queryset),
+                                         user_id=user_id,
+                                         session_key=request.session.session_key)
+            elif callable(generator): 
+                chunks = exporter.generator(iterable,
                                request=request,
-                               model_version_id=model_version['id'], model_type=model_version['model_type']))
+                               model_version_id=model_version['id'], model_type=model_version['model_type'])
             else:
                 exporter.write(iterable,
                                resp,
                                request=request,
                                model_version_id=model_version['id'], model_type=model_version['model_type'])
 
+                if fingerprint:
+                    store_export(resp.content, fingerprint, extension)
+
+            if chunks is not None:
+                if fingerprint:
+                    chunks = cache_export(chunks, fingerprint, extension)
+
+                resp = StreamingHttpResponse(chunks)
 
-        filename = model_version['series_name'] + ' - ' + datetime.now().strftime('%Y-%m-%d') + '.' + exporter.file_extension
+        filename = get_export_filename(model_version, exporter)
+
+        if use_keyset:
+            next_after = get_next_cursor(queryset, keyset, limit)
+            if next_after:
+                resp[CURSOR_HEADER] = next_after
+
+        return self._prepare_response(request, resp, export_type, filename,
+                                      partial=page is not None or use_keyset,
+                                      encoding=encoding,
+                                      attachment=attachment)
+
+    def _prepare_response(self, request, resp, export_type, filename,
+                          partial, cached=False, encoding=None,
+                          attachment=False):
+        content_type = exporters.get(export_type).content_type
+
+        if encoding:
+            # Streamed content is compressed chunk by chunk as it is sent
+            if resp.streaming:
+                resp.streaming_content = compress_chunks(
+                    resp.streaming_content, encoding)
+            else:
+                resp.content = ''.join(compress_chunks([resp.content],
+                                                       encoding))
+
+            if resp.has_header('Content-Length'):
+                del resp['Content-Length']
+
+            if attachment:
+                extension, content_type = COMPRESSIONS[encoding]
+                filename = '{0}.{1}'.format(filename, extension)
+            else:
+                resp['Content-Encoding'] = encoding
+                resp['Vary'] = 'Accept-Encoding'
 
         cookie_name = settings.EXPORT_COOKIE_NAME_TEMPLATE.format(export_type)
         resp.set_cookie(cookie_name, settings.EXPORT_COOKIE_DATA)
 
         resp['Content-Disposition'] = 'attachment; filename="{0}"'.format(filename)                                 
-        resp['Content-Type'] = exporter.content_type
+        resp['Content-Type'] = content_type
 
         usage.log('export', request=request, data={
             'type': export_type,
-            'partial': page is not None,
+            'partial': partial,
+            'cached': cached,
+            'compress': encoding,
         })
         
         return resp
@@ -185,13 +368,239 @@ class ExporterResource(BaseResource):
     post = get
 
 
+class ExportJobParametizer(Parametizer):
+    processor = StrParam('default', choices=pipeline.query_processors)
+
+
+class ExportJobBase(BaseResource):
+    cache_max_age = 0
+
+    private_cache = True
+
+    parametizer = ExportJobParametizer
+
+    def get_queryset(self, request, **kwargs):
+        "Constructs a QuerySet of export jobs for this user or session."
+        maintain_export_jobs()
+
+        if getattr(request, 'user', None) and request.user.is_authenticated():
+            kwargs['user'] = request.user
+        elif request.session.session_key:
+            kwargs['session_key'] = request.session.session_key
+        else:
+            return ExportJob.objects.none()
+
+        return ExportJob.objects.filter(**kwargs)
+
+    def get_object(self, request, pk=None, **kwargs):
+        if not hasattr(request, 'instance'):
+            try:
+                instance = self.get_queryset(request).get(pk=pk)
+            except ExportJob.DoesNotExist:
+                instance = None
+
+            request.instance = instance
+
+        return request.instance
+
+    def prepare(self, request, instance):
+        uri = request.build_absolute_uri
+
+        data = {
+            'id': instance.pk,
+            'export_type': instance.export_type,
+            'status': instance.status,
+            'rows': instance.rows,
+            'total': instance.total,
+            'progress': instance.progress,
+            'size': instance.size,
+            'filename': instance.filename,
+            'parallel': instance.parallel,
+            'error': instance.error or None,
+            'created': instance.created,
+            'finished': instance.finished,
+            '_links': {
+                'self': {
+                    'href': uri(reverse('serrano:data:export_job',
+                                        kwargs={'pk': instance.pk})),
+                },
+            },
+        }
+
+        if instance.status == ExportJob.DONE:
+            data['_links']['download'] = {
+                'href': uri(reverse('serrano:data:export_job_download',
+                                    kwargs={'pk': instance.pk})),
+            }
+
+        return data
+
+
+class ExportJobsResource(ExportJobBase):
+    "Resource for submitting and listing background export jobs."
+    def get(self, request):
+        return [self.prepare(request, job)
+                for job in self.get_queryset(request)]
+
+    def post(self, request):
+        params = self.get_params(request)
+        export_type = request.data.get('export_type')
+        processor = request.data.get('processor') or params['processor']
+
+        if export_type not in EXPORT_TYPES:
+            data = {
+                'message': 'Unknown export type',
+            }
+            return self.render(request, data,
+                               status=codes.unprocessable_entity)
+
+        if processor not in pipeline.query_processors:
+            data = {
+                'message': 'Unknown query processor',
+            }
+            return self.render(request, data,
+                               status=codes.unprocessable_entity)
+
+        model_version = extract_model_version(request)
+
+        if not model_version:
+            data = {
+                'message': 'The model version could not be determined',
+            }
+            return self.render(request, data,
+                               status=codes.unprocessable_entity)
+
+        # The context and view are captured as they are now since the
+        # session objects may change before the job is run.
+        context = self.get_context(request)
+        view = prune_view_columns(self.get_view(request), model_version['id'])
+
+        # Parallel jobs are partitioned by chromosome if the export
+        # supports it, otherwise they are run as a single export.
+        job = ExportJob(model_version_id=model_version['id'],
+                        export_type=export_type,
+                        processor=processor,
+                        context_json=json.dumps(context.json or {}),
+                        view_json=json.dumps(view.json or {}),
+                        parallel=bool(request.data.get('parallel')))
+
+        if getattr(request, 'user', None) and request.user.is_authenticated():
+            job.user = request.user
+        else:
+            if request.session.session_key is None:
+                request.session.save()
+            job.session_key = request.session.session_key
+
+        # The job must be committed before a worker thread looks it up
+        with transaction.commit_on_success():
+            job.save()
+
+        enqueue_export_job(job)
+        request.session.modified = True
+
+        usage.log('export', request=request, data={
+            'type': export_type,
+            'job': job.pk,
+        })
+
+        return self.render(request, self.prepare(request, job),
+                           status=codes.accepted)
+
+
+class ExportJobResource(ExportJobBase):
+    "Resource for the status of a single export job."
+    def is_not_found(self, request, response, **kwargs):
+        return self.get_object(request, **kwargs) is None
+
+    def get(self, request, **kwargs):
+        return self.prepare(request, self.get_object(request, **kwargs))
+
+    def delete(self, request, **kwargs):
+        delete_export_job(self.get_object(request, **kwargs))
+
+
+class ExportJobDownloadResource(ExportJobBase):
+    """Resource for downloading the file of a finished export job.
+
+    Single byte ranges are supported so interrupted downloads can be
+    resumed.
+    """
+    def is_not_found(self, request, response, **kwargs):
+        instance = self.get_object(request, **kwargs)
+        return instance is None or (instance.status == ExportJob.DONE and
+                                    not os.path.exists(instance.path))
+
+    def get(self, request, **kwargs):
+        instance = self.get_object(request, **kwargs)
+
+        if instance.status != ExportJob.DONE:
+            data = {
+                'message': 'Export is not complete',
+            }
+            return self.render(request, data,
+                               status=codes.unprocessable_entity)
+
+        stat = os.stat(instance.path)
+        size = stat.st_size
+        etag = '"{0}-{1}-{2}"'.format(instance.pk, size, int(stat.st_mtime))
+
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            resp = HttpResponse(status=codes.requested_range_not_satisfiable)
+            resp['Content-Range'] = 'bytes */{0}'.format(size)
+            return resp
+
+        # A conditional range only applies to the same version of the file
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if if_range and if_range != etag:
+            byte_range = None
+
+        if byte_range:
+            start, stop = byte_range
+            length = stop - start + 1
+
+            resp = StreamingHttpResponse(
+                read_file(instance.path, start, length),
+                status=codes.partial_content)
+            resp['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, stop,
+                                                               size)
+        else:
+            length = size
+            resp = StreamingHttpResponse(read_file(instance.path))
+
+        resp['Content-Length'] = str(length)
+        resp['Accept-Ranges'] = 'bytes'
+        resp['ETag'] = etag
+
+        cookie_name = settings.EXPORT_COOKIE_NAME_TEMPLATE.format(
+            instance.export_type)
+        resp.set_cookie(cookie_name, settings.EXPORT_COOKIE_DATA)
+
+        resp['Content-Disposition'] = 'attachment; filename="{0}"'.format(
+            instance.filename)
+        resp['Content-Type'] = exporters.get(instance.export_type).content_type
+
+        return resp
+
+
 exporter_resource = ExporterResource()
 exporter_root_resource = ExporterRootResource()
+export_jobs_resource = ExportJobsResource()
+export_job_resource = ExportJobResource()
+export_job_download_resource = ExportJobDownloadResource()
 
 # Resource endpoints
 urlpatterns = patterns(
     '',
     url(r'^$', exporter_root_resource, name='exporter'),
+
+    # Background export jobs
+    url(r'^jobs/$', export_jobs_resource, name='export_jobs'),
+    url(r'^jobs/(?P<pk>\d+)/$', export_job_resource, name='export_job'),
+    url(r'^jobs/(?P<pk>\d+)/download/$', export_job_download_resource,
+        name='export_job_download'),
+
     url(r'^(?P<export_type>\w+)/$', exporter_resource, name='exporter'),
     url(r'^(?P<export_type>\w+)/(?P<page>\d+)/$', exporter_resource,
         name='exporter'),
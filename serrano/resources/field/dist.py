@@ -1,5 +1,7 @@
 from decimal import Decimal
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Q, Count, Min, Max
+from django.utils.datastructures import SortedDict
 from restlib2.http import codes
 from restlib2.params import Parametizer, StrParam, BoolParam, IntParam
 from modeltree.tree import trees
@@ -7,12 +9,17 @@ from avocado.events import usage
 from avocado.models import DataField
 from avocado.query import pipeline
 from avocado.stats import kmeans
+from serrano.aggregates import get_precomputed_distribution, tree_field
+from serrano.conf import settings, dep_supported
 from .base import FieldBase
 from serrano.resources.base import extract_model_version
 
 MINIMUM_OBSERVATIONS = 500
 MAXIMUM_OBSERVATIONS = 50000
 
+# Upper bound on the number of bins per dimension of binned distributions
+MAXIMUM_BINS = 1000
+
 def is_number(s):
     try:
         float(s)
@@ -28,11 +35,14 @@ def all_numbers(l):
 
 class FieldDistParametizer(Parametizer):
     aware = BoolParam(False)
+    backend = StrParam(choices=('python', 'numpy'))
+    bins = IntParam()
     cluster = BoolParam(True)
     n = IntParam()
     nulls = BoolParam(False)
     processor = StrParam('default', choices=pipeline.query_processors)
     sort = StrParam()
+    outliers = StrParam('zscore', choices=('zscore', 'iqr'))
 
 
 class FieldDistribution(FieldBase):
@@ -40,6 +50,143 @@ class FieldDistribution(FieldBase):
 
     parametizer = FieldDistParametizer
 
+    def cluster_numpy(self, points, length, params):
+        """Clusters the points and finds outliers with the vectorized
+        implementation. Returns the points, outliers and whether the points
+        were clustered.
+        """
+        from serrano import kmeans as np_kmeans
+
+        numeric = []
+        obs = []
+
+        # Prune points with non-numeric values
+        for point in points:
+            try:
+                values = [float(v) for v in point['values']]
+            except (TypeError, ValueError):
+                point['values'] = []
+                continue
+
+            point['values'] = values
+            numeric.append(point)
+            obs.append(values)
+
+        if params['cluster'] and length >= MINIMUM_OBSERVATIONS:
+            counts = [p['count'] for p in numeric]
+            points, outliers = np_kmeans.weighted_counts(
+                obs, counts, params['n'], method=params['outliers'])
+            return points, outliers, True
+
+        mask = np_kmeans.find_outliers(obs, method=params['outliers'])
+        outliers = [p for p, outlier in zip(numeric, mask) if outlier]
+        outlying = set(id(p) for p in outliers)
+
+        return [p for p in points if id(p) not in outlying], outliers, False
+
+    def bin_expression(self, column, low, width, bins):
+        "Returns the SQL and params of the 1-based bin index of `column`."
+        if connection.vendor == 'postgresql':
+            # The maximum falls in the bucket after the last one
+            return ('LEAST(WIDTH_BUCKET({0}, %s, %s, %s), %s)'.format(column),
+                    [low, low + width * bins, bins, bins])
+
+        # Values are at least `low`, so truncating the offset floors it.
+        # SQLite has no FLOOR function.
+        if connection.vendor == 'sqlite':
+            index = 'CAST(({0} - %s) / %s AS INTEGER)'.format(column)
+        else:
+            index = 'FLOOR(({0} - %s) / %s)'.format(column)
+
+        return ('CASE WHEN {0} >= %s THEN %s ELSE {0} + 1 END'.format(index),
+                [low, width, bins, bins, low, width])
+
+    def column_sql(self, queryset, lookup):
+        """Returns the column of `lookup` qualified by the alias of its join
+        in `queryset`.
+
+        The joins of the lookup are reused, so a table joined more than once
+        is referenced by the alias the lookup filters on rather than its
+        name.
+        """
+        query = queryset.values_list(lookup).query
+        compiler = query.get_compiler(queryset.db)
+
+        return compiler.get_columns()[-1]
+
+    def get_binned(self, request, queryset, fields, groupby, bins):
+        """Returns the distribution counted over `bins` equal-width bins per
+        dimension, computed in the database.
+
+        The response size is bounded by the number of bins regardless of
+        the number of distinct values.
+        """
+        bins = max(1, min(bins, MAXIMUM_BINS))
+
+        # Filtering on the fields excludes nulls and joins their tables, so
+        # the columns can be referenced by the aliases of those joins below.
+        for lookup in groupby:
+            queryset = queryset.filter(**{'{0}__isnull'.format(lookup): False})
+
+        bounds = queryset.aggregate(*([Min(lookup) for lookup in groupby] +
+                                      [Max(lookup) for lookup in groupby]))
+
+        select = SortedDict()
+        select_params = []
+        ranges = []
+
+        for i, lookup in enumerate(groupby):
+            low = bounds['{0}__min'.format(lookup)]
+            high = bounds['{0}__max'.format(lookup)]
+
+            if low is None:
+                return {
+                    'data': [],
+                    'outliers': [],
+                    'clustered': False,
+                    'binned': True,
+                    'size': 0,
+                }
+
+            low, high = float(low), float(high)
+            width = (high - low) / bins or 1.0
+            ranges.append((low, width))
+
+            column = self.column_sql(queryset, lookup)
+            sql, params = self.bin_expression(column, low, width, bins)
+            select['bin_{0}'.format(i)] = sql
+            select_params.extend(params)
+
+        names = list(select)
+        pk_name = queryset.model._meta.pk.name
+
+        rows = queryset.extra(select=select, select_params=select_params)\
+            .values(*names).annotate(count=Count(pk_name, distinct=True))\
+            .order_by(*names)
+
+        points = []
+
+        for row in rows:
+            values = []
+            for name, (low, width) in zip(names, ranges):
+                start = low + (int(row[name]) - 1) * width
+                values.append([start, start + width])
+
+            points.append({
+                'values': [v[0] for v in values],
+                'ranges': values,
+                'count': row['count'],
+            })
+
+        return {
+            'data': points,
+            'outliers': [],
+            'clustered': False,
+            'binned': True,
+            'bins': bins,
+            'size': len(points),
+        }
+
     def get(self, request, pk):
         model_version = extract_model_version(request)
 
@@ -48,10 +195,10 @@ class FieldDistribution(FieldBase):
         tree = trees[model_version['model_name']]
 
         opts = tree.root_model._meta
-        tree_field = DataField(pk='{0}:{1}'.format(model_version['model_name'], pk),
-                               app_name=opts.app_label,
-                               model_name=opts.module_name,
-                               field_name=opts.pk.name)
+        pk_field = DataField(pk='{0}:{1}'.format(model_version['model_name'], pk),
+                             app_name=opts.app_label,
+                             model_name=opts.module_name,
+                             field_name=opts.pk.name)
 
         # select avocado_datafield.id, avocado_datafield.name, avocado_datafield.allowed_values from avocado_datafield inner join avocado_datafield_schema_1 on 
         # (avocado_datafield.id = avocado_datafield_schema_1.datafield_id) where avocado_datafield_schema_1.schema1_id=8 and avocado_datafield.name = 'Common?';
@@ -65,6 +212,26 @@ class FieldDistribution(FieldBase):
         else:
             context = None
 
+        # Default context-unaware distributions of enumerable fields are
+        # served from the precomputed aggregates of the field if current.
+        if context is None and params['processor'] == 'default' and \
+                dimensions in ([], [pk]) and not params['bins'] and \
+                not params['nulls']:
+            resp = get_precomputed_distribution(instance)
+
+            if resp is not None:
+                if params['sort'] == 'count':
+                    resp['data'].sort(key=lambda p: -p['count'])
+
+                usage.log('dist', instance=instance, request=request, data={
+                    'size': resp['size'],
+                    'clustered': False,
+                    'aware': False,
+                    'precomputed': True,
+                })
+
+                return resp
+
         QueryProcessor = pipeline.query_processors[params['processor']]
         processor = QueryProcessor(context=context, tree=tree)
 
@@ -88,9 +255,29 @@ class FieldDistribution(FieldBase):
             groupby = [tree.query_string_for_field(instance.field,
                                                    model=instance.model)]
 
+        if params['bins']:
+            if not all([d.simple_type == 'number' for d in fields]):
+                data = {
+                    'message': 'Binning requires numeric fields',
+                }
+                return self.render(request, data,
+                                   status=codes.unprocessable_entity)
+
+            resp = self.get_binned(request, queryset, fields, groupby,
+                                   params['bins'])
+
+            usage.log('dist', instance=instance, request=request, data={
+                'size': resp['size'],
+                'clustered': False,
+                'binned': True,
+                'aware': params['aware'],
+            })
+
+            return resp
+
         # Perform a count aggregation of the tree model grouped by the
         # specified dimensions
-        stats = tree_field.count(*groupby)
+        stats = pk_field.count(*groupby)
 
         # Apply it relative to the queryset
         stats = stats.apply(queryset)
@@ -146,7 +333,13 @@ class FieldDistribution(FieldBase):
 
         # For N-dimensional continuous data, check if clustering should occur
         # to down-sample the data.
-        if all([d.simple_type == 'number' for d in fields]):
+        backend = params['backend'] or settings.DISTRIBUTION_BACKEND
+
+        if all([d.simple_type == 'number' for d in fields]) and \
+                backend == 'numpy' and dep_supported('numpy'):
+            points, outliers, clustered = self.cluster_numpy(
+                points, length, params)
+        elif all([d.simple_type == 'number' for d in fields]):
 
             #cast values to float if nessecary (prune non-numeric values)
             for i in range(0, len(points)):
@@ -198,3 +391,212 @@ class FieldDistribution(FieldBase):
             'outliers': outliers,
             'size': length,
         }
+
+
+class FieldsDistParametizer(Parametizer):
+    aware = BoolParam(False)
+    nulls = BoolParam(False)
+    processor = StrParam('default', choices=pipeline.query_processors)
+    sort = StrParam()
+
+
+class FieldsDistribution(FieldBase):
+    """Batched Field Counts Resource
+
+    Returns the distributions of several dimension sets, each given as a
+    `sets` parameter of comma-separated field pks. On PostgreSQL all sets
+    are counted by a single GROUPING SETS query over the context-applied
+    queryset; other databases run one GROUP BY per set. The counts are not
+    clustered, so this is meant for enumerable fields such as facets.
+    """
+
+    parametizer = FieldsDistParametizer
+
+    def is_not_found(self, request, response, *args, **kwargs):
+        return False
+
+    def supports_grouping_sets(self):
+        # GROUPING SETS and GROUPING() were added in PostgreSQL 9.5
+        return connection.vendor == 'postgresql' and \
+            getattr(connection, 'pg_version', 0) >= 90500
+
+    def count_set(self, tree, queryset, lookups, nulls):
+        "Returns the points of one dimension set with a GROUP BY query."
+        stats = tree_field(tree).count(*lookups).apply(queryset)
+
+        if not nulls:
+            q = Q()
+            for lookup in lookups:
+                q = q | Q(**{lookup: None})
+            stats = stats.exclude(q)
+
+        return list(stats)
+
+    def grouping_sets_sql(self, queryset, pk_name, sets):
+        """Returns the GROUPING SETS query counting the dimension `sets` of
+        `queryset`, its params and the column indexes of each set.
+
+        Sets of the same fields in a different order are grouped once.
+        """
+        qn = connection.ops.quote_name
+
+        lookups = []
+        for set_lookups in sets:
+            for lookup in set_lookups:
+                if lookup not in lookups:
+                    lookups.append(lookup)
+
+        # The lookups are selected with the joins and conditions of the
+        # queryset and aliased in the outer query.
+        sql, params = queryset.order_by()\
+            .values_list(pk_name, *lookups).query.sql_with_params()
+
+        columns = [qn('c{0}'.format(i)) for i in xrange(len(lookups))]
+        indexes = [[lookups.index(lookup) for lookup in set_lookups]
+                   for set_lookups in sets]
+
+        # Duplicate grouping sets would each return their own rows
+        grouping = []
+        for idx in indexes:
+            if frozenset(idx) not in [frozenset(g) for g in grouping]:
+                grouping.append(idx)
+
+        sql = ('SELECT {0}, COUNT(DISTINCT {1}), {2} '
+               'FROM ({3}) AS {4} ({1}, {0}) '
+               'GROUP BY GROUPING SETS ({5})').format(
+            ', '.join(columns),
+            qn('pk'),
+            ', '.join('GROUPING({0})'.format(c) for c in columns),
+            sql,
+            qn('dist'),
+            ', '.join('({0})'.format(', '.join(columns[i] for i in idx))
+                      for idx in grouping))
+
+        return sql, params, indexes
+
+    def map_grouping_rows(self, rows, indexes, nulls):
+        """Returns the points of each dimension set from the `rows` of the
+        GROUPING SETS query, with the values in the order of the set.
+        """
+        n = len(set(sum(indexes, [])))
+        targets = {}
+
+        for j, idx in enumerate(indexes):
+            targets.setdefault(frozenset(idx), []).append(j)
+
+        points = [[] for _ in indexes]
+
+        for row in rows:
+            # GROUPING() is 0 for the columns of the set the row belongs to
+            grouped = frozenset(i for i, g in enumerate(row[n + 1:]) if not g)
+
+            for j in targets.get(grouped, ()):
+                values = [row[i] for i in indexes[j]]
+
+                if not nulls and None in values:
+                    continue
+
+                points[j].append({'values': values, 'count': row[n]})
+
+        return points
+
+    def count_grouping_sets(self, tree, queryset, sets, nulls):
+        """Returns the points of each dimension set, counted by a single
+        GROUPING SETS query.
+        """
+        pk_name = tree.root_model._meta.pk.name
+        sql, params, indexes = self.grouping_sets_sql(queryset, pk_name, sets)
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+        return self.map_grouping_rows(cursor.fetchall(), indexes, nulls)
+
+    def get(self, request):
+        model_version = extract_model_version(request)
+        params = self.get_params(request)
+        tree = trees[model_version['model_name']]
+
+        # Each set is a comma-separated list of field pks
+        set_pks = []
+        for value in request.GET.getlist('sets'):
+            pks = [pk for pk in value.split(',') if pk.isdigit()]
+            if pks:
+                set_pks.append(pks)
+
+        # Ignore fields that dont exist or the user does not have
+        # permission to view.
+        instances = dict((str(f.pk), f) for f in self.get_queryset(request)
+                         .filter(pk__in=sum(set_pks, [])))
+
+        dimensions = []
+        sets = []
+        set_fields = []
+
+        for pks in set_pks:
+            fields = [instances[pk] for pk in pks if pk in instances]
+
+            if fields:
+                dimensions.append([f.pk for f in fields])
+                set_fields.append(fields)
+                sets.append([tree.query_string_for_field(f.field,
+                                                         model=f.model)
+                             for f in fields])
+
+        if not sets:
+            data = {
+                'message': 'At least one dimension set is required',
+            }
+            return self.render(request, data,
+                               status=codes.unprocessable_entity)
+
+        if params['aware']:
+            context = self.get_context(request)
+        else:
+            context = None
+
+        QueryProcessor = pipeline.query_processors[params['processor']]
+        processor = QueryProcessor(context=context, tree=tree)
+        queryset = processor.get_queryset(request=request)
+
+        if self.supports_grouping_sets():
+            points = self.count_grouping_sets(tree, queryset, sets,
+                                              params['nulls'])
+        else:
+            points = [self.count_set(tree, queryset, lookups, params['nulls'])
+                      for lookups in sets]
+
+        resp = []
+
+        for pks, fields, set_points in zip(dimensions, set_fields, points):
+            if len(set_points) > MAXIMUM_OBSERVATIONS:
+                data = {
+                    'message': 'Data too large',
+                }
+                return self.render(request, data,
+                                   status=codes.unprocessable_entity)
+
+            # Same ordering as the distribution of a single set
+            if any([f.enumerable for f in fields]) and \
+                    not params['sort'] == 'count':
+                set_points.sort(key=lambda p: p['values'])
+            else:
+                set_points.sort(key=lambda p: -p['count'])
+
+            resp.append({
+                'dimensions': pks,
+                'data': set_points,
+                'clustered': False,
+                'outliers': [],
+                'size': len(set_points),
+            })
+
+            for instance in fields:
+                usage.log('dist', instance=instance, request=request, data={
+                    'size': len(set_points),
+                    'clustered': False,
+                    'aware': params['aware'],
+                    'batched': True,
+                })
+
+        return resp
@@ -1,8 +1,13 @@
 import logging
+from collections import defaultdict
 from django.core.urlresolvers import reverse
+from restlib2.http import codes
 from restlib2.params import Parametizer, BoolParam, StrParam
 from avocado.events import usage
 from avocado.query import pipeline
+from serrano.aggregates import compute_stats, compute_bulk_stats, \
+    compute_percentiles, get_precomputed_stats
+from serrano.conf import settings
 from .base import FieldBase
 
 
@@ -11,6 +16,7 @@ log = logging.getLogger(__name__)
 
 class FieldStatsParametizer(Parametizer):
     aware = BoolParam(False)
+    percentiles = BoolParam(False)
     processor = StrParam('default', choices=pipeline.query_processors)
 
 
@@ -30,35 +36,22 @@ class FieldStats(FieldBase):
         else:
             context = None
 
-        QueryProcessor = pipeline.query_processors[params['processor']]
-        processor = QueryProcessor(context=context, tree=instance.model)
-        queryset = processor.get_queryset(request=request)
-
-        if instance.simple_type == 'number':
-            # Since the call to max() returns an Aggregator object with the
-            # queryset stored internally, we don't pass the queryset to min()
-            # or avg() like we do when we call max() which is called on the
-            # instance itself not on an Aggregator like min() or avg() are
-            # called on.
-            stats = instance.max(queryset=queryset).min().avg()
-        elif (instance.simple_type == 'date' or
-              instance.simple_type == 'time' or
-              instance.simple_type == 'datetime'):
-            # Since the call to max() returns an Aggregator object with the
-            # queryset stored internally, we don't pass the queryset to min()
-            # like we do when we call max() which is called on the instance
-            # itself not on an Aggregator like min() is called on.
-            stats = instance.max(queryset=queryset).min()
-        else:
-            stats = instance.count(queryset=queryset, distinct=True)
+        # Context-unaware stats are served from the precomputed aggregates
+        # of the field if they are current.
+        resp = None
 
-        if stats is None:
-            resp = {}
-        else:
-            try:
-                resp = next(iter(stats))
-            except StopIteration:
-                resp = {}
+        if context is None and params['processor'] == 'default':
+            resp = get_precomputed_stats(instance, params['percentiles'])
+
+        if resp is None:
+            QueryProcessor = pipeline.query_processors[params['processor']]
+            processor = QueryProcessor(context=context, tree=instance.model)
+            queryset = processor.get_queryset(request=request)
+            resp = compute_stats(instance, queryset)
+
+            # The percentiles take additional sorted reads of the column
+            if params['percentiles'] and instance.simple_type == 'number':
+                resp['percentiles'] = compute_percentiles(instance, queryset)
 
         resp['_links'] = {
             'self': {
@@ -72,3 +65,82 @@ class FieldStats(FieldBase):
 
         usage.log('stats', instance=instance, request=request)
         return resp
+
+
+class FieldsStats(FieldBase):
+    """Bulk Field Stats Resource
+
+    Returns the stats of the fields given by the `fields` parameters keyed
+    by field pk. The stats of fields of the same model are computed with a
+    single query over the (optionally context-applied) table.
+    """
+
+    parametizer = FieldStatsParametizer
+
+    def is_not_found(self, request, response, *args, **kwargs):
+        return False
+
+    def get(self, request):
+        uri = request.build_absolute_uri
+        params = self.get_params(request)
+
+        # Lists are not supported by the parametizer
+        pks = [pk for pk in request.GET.getlist('fields') if pk.isdigit()]
+
+        if not pks:
+            data = {
+                'message': 'At least one field is required',
+            }
+            return self.render(request, data,
+                               status=codes.unprocessable_entity)
+
+        # Ignore fields that do not exist or the user does not have
+        # permission to view.
+        stats_capable = settings.STATS_CAPABLE
+        fields = [f for f in self.get_queryset(request).filter(pk__in=pks)
+                  if not stats_capable or stats_capable(f)]
+
+        if params['aware']:
+            context = self.get_context(request)
+        else:
+            context = None
+
+        resp = {}
+        models = defaultdict(list)
+
+        for instance in fields:
+            stats = None
+
+            if context is None and params['processor'] == 'default':
+                stats = get_precomputed_stats(instance,
+                                              params['percentiles'])
+
+            if stats is None:
+                models[instance.model].append(instance)
+            else:
+                resp[instance.pk] = stats
+
+        QueryProcessor = pipeline.query_processors[params['processor']]
+
+        for model, model_fields in models.items():
+            processor = QueryProcessor(context=context, tree=model)
+            queryset = processor.get_queryset(request=request)
+            resp.update(compute_bulk_stats(model_fields, queryset))
+
+            if params['percentiles']:
+                for instance in model_fields:
+                    if instance.simple_type == 'number':
+                        resp[instance.pk]['percentiles'] = \
+                            compute_percentiles(instance, queryset)
+
+        for instance in fields:
+            resp[instance.pk]['_links'] = {
+                'parent': {
+                    'href': uri(reverse('serrano:field',
+                                        args=[instance.pk])),
+                },
+            }
+
+            usage.log('stats', instance=instance, request=request)
+
+        return resp
@@ -1,14 +1,22 @@
+import time
 import logging
-from django.db.models import Q
+from random import sample as random_sample
+from django.http import StreamingHttpResponse
 from django.core.urlresolvers import reverse
 from django.utils.encoding import smart_unicode
 from restlib2.http import codes
 from restlib2.params import StrParam, IntParam, BoolParam
+from restlib2.serializers import serializers
 from avocado.events import usage
 from avocado.query import pipeline
+from serrano.conf import settings
+from serrano.exports import export_owner
+from serrano.search import get_value_index, peek_value_index, \
+    index_allowed
+from serrano.values import values_cache_key, get_cached_values, \
+    peek_cached_values, sample_values
 from ..pagination import PaginatorResource, PaginatorParametizer
-from .base import FieldBase, extract_model_version
-from avocado.models import DataConcept, DataField;
+from .base import FieldBase
 
 
 log = logging.getLogger(__name__)
@@ -43,15 +51,11 @@ class FieldValues(FieldBase, PaginatorResource):
 
     def get_all_values(self, request, instance, queryset, field_id):
         "Returns all distinct values for this field."
-        result = DataField.objects.get(id=field_id)
-
-        model_version = extract_model_version(request)
-
         results = []
 
         # if a list of allowed values is specified in database, use those
-        if result.allowed_values:
-            for value in sorted(result.allowed_values) + ['Missing']:
+        if instance.allowed_values:
+            for value in sorted(instance.allowed_values) + ['Missing']:
             
                 results.append({
                     'label': value.replace('"', ''),
@@ -63,7 +67,7 @@ class FieldValues(FieldBase, PaginatorResource):
                     'label': label.replace('"', ''),
                     'value': value,
                 })
-            if result.type=='Boolean':
+            if instance.type=='Boolean':
                 results.append({
                     'label': 'Missing',
                     'value': 'Missing',
@@ -71,14 +75,48 @@ class FieldValues(FieldBase, PaginatorResource):
 
         return results
 
-    def get_search_values(self, request, instance, query, queryset):
+    def get_index_items(self, instance, queryset):
+        """Returns the items of the search index of the field.
+
+        If the field has a separate search field, its values are indexed
+        in place of the labels, like the database search.
+        """
+        if not instance.search_field_name:
+            return instance.choices(queryset=queryset)
+
+        value_labels = instance.value_labels(queryset=queryset)
+        rows = queryset.values_list(instance.field_name,
+                                    instance.search_field.name).distinct()
+
+        return [(value, value_labels.get(value, smart_unicode(value)), text)
+                for value, text in rows if text is not None]
+
+    def get_search_values(self, request, instance, query, queryset,
+                          key=None):
         """
         Performs a search on the underlying data for a field.
 
+        If `key` is given, the search uses the in-memory index of the
+        field cached under the key unless the field has too many values.
+
         This method can be overridden to use an alternate search
         implementation.
         """
         results = []
+
+        if key is not None and settings.FIELD_SEARCH_INDEX_SIZE and \
+                index_allowed(key, lambda: queryset.values(
+                    instance.field_name).distinct().count()):
+            index = get_value_index(
+                key, lambda: self.get_index_items(instance, queryset))
+
+            for value, label in index.search(query):
+                results.append({
+                    'label': label,
+                    'value': value,
+                })
+            return results
+
         value_labels = instance.value_labels(queryset=queryset)
 
         for value in instance.search(query, queryset=queryset):
@@ -88,19 +126,54 @@ class FieldValues(FieldBase, PaginatorResource):
             })
         return results
 
-    def get_random_values(self, request, instance, random, queryset):
+    def get_random_values(self, request, instance, random, queryset,
+                          key=None):
         """
         Returns a random set of value/label pairs.
 
         This is useful for pre-populating documents or form fields with
-        example data.
+        example data. Values are sampled from the field's search index if
+        it is in memory or its value list if it is cached, which are drawn
+        uniformly over the distinct values. Otherwise rows at random primary
+        keys are read, which favors common values. A ValueError is raised if
+        the population is smaller than `random`.
+
+        The value lists of fields with allowed values and Boolean fields
+        hold entries that are not in the data, e.g. 'Missing', so they are
+        not sampled.
         """
-        values = instance.random(random, queryset=queryset)
+        index = peek_value_index(key) if key is not None else None
+        cached = None
+
+        if key is not None and index is None and \
+                not instance.allowed_values and instance.type != 'Boolean':
+            cached = peek_cached_values(key)
+
+        if index is not None:
+            pairs = random_sample(zip(index.values, index.labels), random)
+        elif cached is not None:
+            pairs = [(item['value'], item['label'])
+                     for item in random_sample(cached, random)]
+        else:
+            values = sample_values(queryset, instance.field_name, random)
+
+            # Sparse or small populations may need the distinct values
+            if len(values) < random:
+                values = random_sample(instance.values(queryset=queryset),
+                                       random)
+
+            # Resolve the labels of all sampled values at once
+            value_labels = instance.value_labels(queryset=queryset.filter(
+                **{'{0}__in'.format(instance.field_name): values}))
+
+            pairs = [(value, value_labels.get(value, smart_unicode(value)))
+                     for value in values]
+
         results = []
 
-        for value in values:
+        for value, label in pairs:
             results.append({
-                'label': instance.get_label(value, queryset=queryset),
+                'label': label,
                 'value': value,
             })
 
@@ -126,22 +199,31 @@ class FieldValues(FieldBase, PaginatorResource):
             # simply return all the possible values.
             try:
                 return self.get_random_values(
-                    request, instance, params['random'], queryset)
+                    request, instance, params['random'], queryset,
+                    key=values_cache_key(instance, params['processor'],
+                                         context, export_owner(request)))
             except ValueError:
                 return instance.values(queryset=queryset)
 
         page = params['page']
         limit = params['limit']
+        key = values_cache_key(instance, params['processor'], context,
+                               export_owner(request))
 
         # If a query term is supplied, perform the icontains search.
         if params['query']:
             usage.log('values', instance=instance, request=request, data={
                 'query': params['query'],
             })
+            # Indexes are only built for the whole population since each
+            # context would otherwise need its own index.
             values = self.get_search_values(
-                request, instance, params['query'], queryset)
+                request, instance, params['query'], queryset,
+                key=key if context is None else None)
         else:
-            values = self.get_all_values(request, instance, queryset, pk)
+            # The list is cached and pages are sliced from the cached list
+            values = get_cached_values(key, lambda: self.get_all_values(
+                request, instance, queryset, pk))
 
         # No page specified, return everything.
         if page is None:
@@ -168,7 +250,65 @@ class FieldValues(FieldBase, PaginatorResource):
 
         return resp
 
+    def validate_chunk(self, queryset, instance, chunk, index=None):
+        """Validates the values or labels of the data in `chunk`.
+
+        Each datum is augmented in place with `valid` and the missing value
+        or label. If a value index of the field is given, it is used rather
+        than querying the database.
+        """
+        if index is not None:
+            value_labels = index.value_labels
+            label_values = index.label_values
+        else:
+            value_field_name = instance.field_name
+            label_field_name = instance.label_field.name
+
+            values = [d['value'] for d in chunk if 'value' in d]
+            labels = [d['label'] for d in chunk if 'value' not in d]
+
+            value_labels = {}
+            label_values = {}
+
+            if values:
+                value_labels.update(queryset.filter(**{
+                    '{0}__in'.format(value_field_name): values,
+                }))
+
+            if labels:
+                for value, label in queryset.filter(**{
+                        '{0}__in'.format(label_field_name): labels}):
+                    label_values.setdefault(label, value)
+
+        for datum in chunk:
+            if 'value' not in datum:
+                valid = datum['label'] in label_values
+                if valid:
+                    value = label_values[datum['label']]
+                else:
+                    value = datum['label']
+
+                datum['valid'] = valid
+                datum['value'] = value
+            else:
+                valid = datum['value'] in value_labels
+                if valid:
+                    label = value_labels[datum['value']]
+                else:
+                    label = smart_unicode(datum['value'])
+
+                datum['valid'] = valid
+                datum['label'] = label
+
+        return chunk
+
     def post(self, request, pk):
+        """Validates the posted values or labels of the field.
+
+        The validation time is recorded in the `validate` usage log entry
+        which is written once every value is validated, i.e. after the last
+        chunk of streamed responses.
+        """
         instance = self.get_object(request, pk=pk)
         params = self.get_params(request)
 
@@ -184,73 +324,67 @@ class FieldValues(FieldBase, PaginatorResource):
         else:
             array = request.data
 
-        values = []
-        labels = []
-        array_map = {}
-
-        # Separate out the values and labels for the lookup. Track indexes
-        # maintain order of array
-        for i, datum in enumerate(array):
-            # Value takes precedence over label if supplied.
-            if 'value' in datum:
-                array_map[i] = 'value'
-                values.append(datum['value'])
-            elif 'label' in datum:
-                array_map[i] = 'label'
-                labels.append(datum['label'])
-            else:
+        # Value takes precedence over label if supplied.
+        for datum in array:
+            if not isinstance(datum, dict) or \
+                    ('value' not in datum and 'label' not in datum):
                 data = {
                     'message': 'Error parsing value or label'
                 }
                 return self.render(request, data,
                                    status=codes.unprocessable_entity)
 
-        value_field_name = instance.field_name
-        label_field_name = instance.label_field.name
-
         # Note, this return a context-aware or naive queryset depending
         # on params. Get the value and label fields so they can be filled
         # in below.
         queryset = self.get_base_values(request, instance, params)\
-            .values_list(value_field_name, label_field_name)
-
-        lookup = Q()
-
-        # Validate based on the label.
-        if labels:
-            lookup |= Q(**{'{0}__in'.format(label_field_name): labels})
+            .values_list(instance.field_name, instance.label_field.name)
+
+        # Use the search index of the field if one has been built for the
+        # same population.
+        context = self.get_context(request) if params['aware'] else None
+        index = peek_value_index(values_cache_key(instance, 'default',
+                                                  context,
+                                                  export_owner(request)))
+
+        size = max(1, settings.FIELD_VALIDATE_CHUNK_SIZE)
+        chunks = (self.validate_chunk(queryset, instance,
+                                      array[i:i + size], index)
+                  for i in xrange(0, len(array), size))
+
+        start = time.time()
+        accept_type = self.get_accept_type(request)
+
+        # Large lists are validated and written one chunk at a time. Each
+        # chunk is encoded by the serializer of the response, so only JSON
+        # arrays can be written element by element.
+        streamed = len(array) > size and accept_type == 'application/json'
+
+        def log():
+            usage.log('validate', instance=instance, request=request, data={
+                'count': len(array),
+                'time': time.time() - start,
+                'streamed': streamed,
+            })
 
-        if values:
-            lookup |= Q(**{'{0}__in'.format(value_field_name): values})
+        if streamed:
+            def stream():
+                yield '['
 
-        results = queryset.filter(lookup)
+                for i, chunk in enumerate(chunks):
+                    data = serializers.encode(accept_type, chunk)
+                    yield (',' if i else '') + data[1:-1]
 
-        value_labels = dict(results)
-        label_values = dict([(v, k) for k, v in value_labels.items()])
+                yield ']'
 
-        for i, datum in enumerate(array):
-            if array_map[i] == 'label':
-                valid = datum['label'] in label_values
-                if valid:
-                    value = label_values[datum['label']]
-                else:
-                    value = datum['label']
+                log()
 
-                datum['valid'] = valid
-                datum['value'] = value
-            else:
-                valid = datum['value'] in value_labels
-                if valid:
-                    label = value_labels[datum['value']]
-                else:
-                    label = smart_unicode(datum['value'])
+            return StreamingHttpResponse(stream(), content_type=accept_type)
 
-                datum['valid'] = valid
-                datum['label'] = label
+        for chunk in chunks:
+            pass
 
-        usage.log('validate', instance=instance, request=request, data={
-            'count': len(array),
-        })
+        log()
 
         # Return the augmented data.
-        return request.data
+        return self.render(request, request.data)
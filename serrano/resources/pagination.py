@@ -1,4 +1,9 @@
+import base64
+import json
+from django.db import connection
+from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.cache import cache
 from django.core.paginator import Paginator
 from avocado.core.cache import cache_key
@@ -10,6 +15,14 @@ from serrano.resources.base import get_count
 
 __all__ = ('PaginatorResource', 'PaginatorParametizer')
 
+# Record types whose rows are uniquely identified by their coordinates and
+# the series keys
+REGION_RECORD_TYPES = ('coverageregion', 'region', 'cnv', 'loh')
+
+# Response header used to carry the cursor of the next page for responses
+# whose body cannot, e.g. file exports
+CURSOR_HEADER = 'X-Cursor-After'
+
 def _count(s):
     if isinstance(s, QuerySet):
         return get_count(s)
@@ -17,6 +30,141 @@ def _count(s):
     return len(s)
 
 
+def get_keyset(model_version):
+    """Returns the columns that deterministically order the rows of the
+    model version's table or None if the table has no such key.
+
+    Keyset (seek) pagination is only possible for tables with such a key.
+    """
+    if model_version['model_type'] == 'sample':
+        return ['id']
+
+    if model_version['model_type'] == 'project':
+        return None
+
+    if model_version['record_type'] in REGION_RECORD_TYPES:
+        keys = [key['symbol'] for key in model_version['keys']]
+        return ['chr', 'pos_start', 'pos_stop'] + keys
+
+    if model_version['record_type'] == 'variant':
+        return ['chr', 'pos_start', 'pos_stop', 'ref_alts']
+
+
+def encode_cursor(values):
+    "Returns an opaque, url-safe token for the sort key `values`."
+    token = base64.urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder))
+    return token.rstrip('=')
+
+
+def decode_cursor(token):
+    "Returns the sort key values of `token`. Raises ValueError if invalid."
+    token = str(token)
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(
+            token + '=' * (-len(token) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+
+    return values
+
+
+def _key_columns(table, keys):
+    qn = connection.ops.quote_name
+    return ['{0}.{1}'.format(qn(table), qn(key)) for key in keys]
+
+
+def _nullable(opts, key):
+    try:
+        return opts.get_field(key).null
+    except FieldDoesNotExist:
+        return True
+
+
+def seek(queryset, keys, values):
+    """Filters `queryset` to the rows following `values` in `keys` order.
+
+    The comparison is a row value comparison on the key columns of the
+    queryset's table which lets the database seek directly to the position
+    using the index on the key rather than scanning and discarding the
+    preceding rows.
+
+    A row value comparison is never true for NULLs, so if a key column is
+    nullable the comparison is expanded per column and NULLs are placed
+    where the database sorts them.
+    """
+    if len(keys) != len(values):
+        raise ValueError('Invalid cursor')
+
+    opts = queryset.model._meta
+    columns = _key_columns(opts.db_table, keys)
+    nullable = [_nullable(opts, key) for key in keys]
+
+    if not any(nullable) and None not in values:
+        where = '({0}) > ({1})'.format(', '.join(columns),
+                                       ', '.join(['%s'] * len(keys)))
+
+        return queryset.extra(where=[where], params=values)
+
+    # PostgreSQL and Oracle sort NULLs after other values in ascending
+    # order, other databases before them.
+    nulls_last = connection.vendor in ('postgresql', 'oracle')
+
+    terms = []
+    params = []
+    equal = []
+    equal_params = []
+
+    for column, null, value in zip(columns, nullable, values):
+        if value is None:
+            after = None if nulls_last else '{0} IS NOT NULL'.format(column)
+            after_params = []
+        elif null and nulls_last:
+            after = '({0} > %s OR {0} IS NULL)'.format(column)
+            after_params = [value]
+        else:
+            after = '{0} > %s'.format(column)
+            after_params = [value]
+
+        if after is not None:
+            terms.append(' AND '.join(equal + [after]))
+            params.extend(equal_params + after_params)
+
+        if value is None:
+            equal.append('{0} IS NULL'.format(column))
+        else:
+            equal.append('{0} = %s'.format(column))
+            equal_params.append(value)
+
+    # Nothing sorts after a cursor of NULLs
+    where = ' OR '.join('({0})'.format(term) for term in terms) or '1 = 0'
+
+    return queryset.extra(where=[where], params=params)
+
+
+def get_next_cursor(queryset, keys, limit):
+    """Returns the cursor for the page following the first `limit` rows of
+    `queryset` or None if there is no following page.
+    """
+    table = queryset.model._meta.db_table
+
+    query = queryset.query.clone()
+    query.select = [(table, key) for key in keys]
+    query.default_cols = False
+    query.select_related = False
+    query.set_limits(limit - 1, limit)
+
+    # Extra select columns precede the selected columns in each row
+    start = len(query.extra_select)
+    compiler = query.get_compiler(queryset.db)
+
+    for row in compiler.results_iter():
+        return encode_cursor(list(row[start:start + len(keys)]))
+
+
 class PaginatorParametizer(Parametizer):
     page = IntParam(1)
     limit = IntParam(20)
@@ -29,8 +177,10 @@ class PaginatorResource(Resource):
         paginator = Paginator(queryset, per_page=limit)
         paginator.has_limit = bool(limit)
 
-        # Cache count for paginator to prevent redundant calls between requests
-        if settings.DATA_CACHE_ENABLED:
+        # Cache count for paginator to prevent redundant calls between
+        # requests. Lists are counted directly rather than hashing them into
+        # a cache key.
+        if settings.DATA_CACHE_ENABLED and isinstance(queryset, QuerySet):
             key = cache_key('paginator', kwargs={
                 'queryset': queryset
             })
@@ -108,6 +258,45 @@ class PaginatorResource(Resource):
 
         return links
 
+    def get_cursor_links(self, request, path, limit, after, next_after,
+                         extra=None):
+        "Returns the links for a keyset (cursor) paginated response."
+        uri = request.build_absolute_uri
+
+        params = {
+            'limit': str(limit),
+            'cursor': 'true',
+        }
+
+        if extra:
+            for key, value in extra.items():
+                if (key in request.GET and key not in ('page', 'after') and
+                        value is not None and value != ''):
+                    params.setdefault(key, request.GET.get(key))
+
+        def href(token):
+            pairs = dict(params)
+            if token:
+                pairs['after'] = token
+            pairs = sorted(['{0}={1}'.format(k, v) for k, v in pairs.items()])
+            return uri('{0}?{1}'.format(path, '&'.join(pairs)))
+
+        links = {
+            'self': {
+                'href': href(after),
+            },
+            'base': {
+                'href': uri(path),
+            }
+        }
+
+        if next_after:
+            links['next'] = {
+                'href': href(next_after),
+            }
+
+        return links
+
     def get_page_response(self, request, paginator, page):
         return {
             'count': paginator.count,
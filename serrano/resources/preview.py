@@ -2,17 +2,28 @@ try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
+import re
 from django.conf.urls import patterns, url
 from django.core.urlresolvers import reverse
 from django.utils import html
 from avocado.query import pipeline
-from avocado.models import DataField, DataConcept;
 from avocado.export import HTMLExporter
-from restlib2.params import StrParam
-from .base import BaseResource, extract_model_version, url_from_template, get_alias_map
+from restlib2.http import codes
+from restlib2.params import StrParam, BoolParam
+from serrano.metadata import get_metadata
+from .base import BaseResource, extract_model_version, url_from_template, \
+    get_alias_map, drop_order_only_columns, requires_unbounded_read
 from .view import init_views
-from .pagination import PaginatorResource, PaginatorParametizer     
-import json
+from .pagination import PaginatorResource, PaginatorParametizer, \
+    get_keyset, decode_cursor, seek, get_next_cursor
+
+NA_HTML = '<em>n/a</em>'
+
+# Characters stripped from every preview cell
+STRIP_CHARS = re.compile(r'["\'\[\]]')
+
+# Upper bound on the number of formatter plans kept per metadata snapshot
+MAX_FORMATTER_PLANS = 256
 
 def get_facet(facets, concept_id):
     for d in facets:
@@ -21,6 +32,110 @@ def get_facet(facets, concept_id):
     return {} 
 
 
+def _clean(value):
+    return STRIP_CHARS.sub('', value).replace('None', '?')
+
+
+def _finalize(value):
+    if value == 0:
+        return '0'
+    if not value or value == 'null' or value == NA_HTML:
+        return '?'
+    return value
+
+
+def _escape(value):
+    if value != NA_HTML:
+        value = html.escape(value)
+    return _finalize(value)
+
+
+def format_string(value):
+    return _escape(_clean(value))
+
+
+def format_float(value):
+    value = _clean(value)
+    try:
+        value = str(float(value))
+    except ValueError:
+        pass
+    return _escape(value)
+
+
+def format_integer(value):
+    value = _clean(value)
+    try:
+        return _finalize(int(float(value)))
+    except (ValueError, OverflowError):
+        return _escape(value)
+
+
+def format_coordinate(value):
+    # Coordinates are stored 0-based, but displayed 1-based
+    components = _clean(value).split(' ')
+    try:
+        components[1] = str(int(components[1]) + 1)
+    except (IndexError, ValueError):
+        pass
+    return _escape('_'.join(components))
+
+
+def url_formatter(template, formatter):
+    "Wraps `formatter` to render values as links when the template applies."
+    def format_url(value):
+        urls = url_from_template(value, template)
+        if not urls:
+            return formatter(value)
+
+        links = []
+        for value, url in urls.iteritems():
+            links.append('<a target="_blank" href="' + url + '">' + value + '</a>')
+        return _finalize(', '.join(links))
+    return format_url
+
+
+def get_cell_formatters(header, type_map):
+    """Returns a list of cell formatters, one for each column in `header`.
+
+    The formatter for a column is decided once from the column's concept
+    type and url template, so rows only need to be passed through the
+    formatters rather than inspecting the header for every cell.
+    """
+    formatters = []
+
+    for h in header:
+        if h['name'] == 'Genomic Coordinate':
+            formatter = format_coordinate
+        else:
+            data_type = type_map.get(h['id']) or 'String'
+
+            if data_type.startswith('Float'):
+                formatter = format_float
+            elif data_type.startswith('Integer'):
+                formatter = format_integer
+            else:
+                formatter = format_string
+
+        if h.get('url_temp'):
+            formatter = url_formatter(h['url_temp'], formatter)
+
+        formatters.append(formatter)
+
+    return formatters
+
+
+def get_formatter_plan(metadata, header):
+    "Returns the cached cell formatters of `header` for the snapshot."
+    plans = metadata.derived.setdefault('formatter_plans', {})
+    key = tuple((h['id'], h['name']) for h in header)
+
+    if key not in plans:
+        if len(plans) >= MAX_FORMATTER_PLANS:
+            plans.clear()
+        plans[key] = get_cell_formatters(header, metadata.get_type_map())
+
+    return plans[key]
 
 
 
@@ -33,6 +148,8 @@ def select_includes_schemas(select):
 
 class PreviewParametizer(PaginatorParametizer):
     processor = StrParam('default', choices=pipeline.query_processors)
+    cursor = BoolParam(False)
+    after = StrParam()
 
 class PreviewResource(BaseResource, PaginatorResource):
     """Resource for *previewing* data prior to exporting.
@@ -49,12 +166,8 @@ class PreviewResource(BaseResource, PaginatorResource):
         # extract schema id and get list of concepts allowed by the schema 
         model_version = extract_model_version(request)
 
-        valid_concepts = [c.id for c in DataConcept.objects.filter(model_version_id=model_version['id'])]
-
-        # extract map of allowed values and type for each concept
-        field_query = ("select avocado_dataconceptfield.concept_id, avocado_datafield.id, avocado_datafield.allowed_values, avocado_datafield.type from " 
-        "avocado_dataconceptfield inner join avocado_datafield on avocado_dataconceptfield.field_id=avocado_datafield.id;")
-        type_map = {c.concept_id:c.type for c in DataConcept.objects.raw(field_query)}
+        metadata = get_metadata(model_version['id'])
+        valid_concepts = metadata.concepts
 
         
         view = self.get_view(request)
@@ -84,8 +197,28 @@ class PreviewResource(BaseResource, PaginatorResource):
 
         queryset.query.alias_map = get_alias_map(model_version['model_name'], queryset.query.alias_map) 
 
+        # Keyset (cursor) pagination is opt-in and only possible when the
+        # table has a deterministic key and the view does not impose its
+        # own ordering.
+        keyset = get_keyset(model_version)
+        after = params.get('after')
+        use_keyset = bool((params.get('cursor') or after) and keyset and
+                          limit and not queryset.query.order_by)
+
+        if use_keyset and after:
+            try:
+                after_values = decode_cursor(after)
+            except ValueError:
+                data = {
+                    'message': 'Invalid cursor',
+                }
+                return self.render(request, data,
+                                   status=codes.unprocessable_entity)
+
         # an ordering must be specified to ensure that paginator queries don't produce duplicates
-        if model_version['model_type']=='sample':
+        if use_keyset:
+            queryset.query.order_by = list(keyset)
+        elif model_version['model_type']=='sample':
             # only samples do not have genomic information
             queryset.query.order_by = queryset.query.order_by + ['id']
         elif model_version['model_type']=='project':
@@ -98,8 +231,25 @@ class PreviewResource(BaseResource, PaginatorResource):
         # Get paginator and page
         queryset.query.select = [s for s in queryset.query.select if s[0] in queryset.query.alias_map]
         paginator = self.get_paginator(queryset, limit=limit)
-        page = paginator.page(page)
-        offset = max(0, page.start_index() - 1)
+
+        if use_keyset:
+            # The position is determined by the cursor rather than an
+            # offset, so the count and page are based on the first page.
+            page = paginator.page(1)
+            offset = 0
+
+            if after:
+                try:
+                    queryset = seek(queryset, keyset, after_values)
+                except ValueError:
+                    data = {
+                        'message': 'Invalid cursor',
+                    }
+                    return self.render(request, data,
+                                       status=codes.unprocessable_entity)
+        else:
+            page = paginator.page(page)
+            offset = max(0, page.start_index() - 1)
         view_node = view.parse()
 
         # Build up the header keys.
@@ -125,13 +275,11 @@ class PreviewResource(BaseResource, PaginatorResource):
         valid_indices = [i for i,h in enumerate(header) if h['id'] in valid_concepts]  
         header = [h for h in header if h['id'] in valid_concepts]
 
-        # get the related datafields
+        # get the url templates of the related datafields
         for h in header:
-            field_query = 'select * from avocado_datafield where id = ANY(select field_id from avocado_dataconceptfield where concept_id=' + str(h['id']) + ');'
-            related_field = DataField.objects.raw(field_query)[0]
-            if related_field.keywords:
-                keywords = json.loads(related_field.keywords)
-                h['url_temp'] = keywords['urlTemplate']
+            url_template = valid_concepts[h['id']]['url_template']
+            if url_template:
+                h['url_temp'] = url_template
         
         # Prepare an HTMLExporter
         exporter = processor.get_exporter(HTMLExporter)
@@ -143,13 +291,6 @@ class PreviewResource(BaseResource, PaginatorResource):
         # an explicit limit of None
         limit = limit or None
 
-        # This is an optimization when concepts are selected for ordering
-        # only. There is not guarantee to how many rows are required to get
-        # the desired `limit` of rows, so the query is unbounded. If all
-        # ordering facets are visible, the limit and offset can be pushed
-        # down to the query.
-        order_only = lambda f: not f.get('visible', True)
-
         # queryset spits out values of type Variant1
         queryset.query.distinct = False
 
@@ -158,7 +299,13 @@ class PreviewResource(BaseResource, PaginatorResource):
         if (variant_table, '_id') not in queryset.query.select and 'project' in model_version['record_type']:        
             queryset.query.select.append((variant_table, '_id'))
 
-        if filter(order_only, view_node.facets):
+        # Concepts selected for ordering only are kept in the ORDER BY, but
+        # not projected, so the limit and offset are pushed down to the
+        # query.
+        drop_order_only_columns(queryset, view_node, model_version['id'])
+
+        if requires_unbounded_read(queryset, view_node, model_version['id'],
+                                   limit, offset):
             iterable = processor.get_iterable(request=request,
                                               queryset=queryset)
 
@@ -176,6 +323,9 @@ class PreviewResource(BaseResource, PaginatorResource):
         
         row_count = 0
         header = [{'id':'_id', 'name':'_id'}] + header
+        formatters = get_formatter_plan(metadata, header)
+        valid_indices = set(valid_indices)
+
         for row in exported:
             row_count += 1
             pk = None
@@ -187,42 +337,8 @@ class PreviewResource(BaseResource, PaginatorResource):
                         pk = output[pk_name]
                     else:
                         values.extend(output.values())
-            
-                 
-            for i in range(0, len(values)):
-                urls = url_from_template(values[i], header[i].get('url_temp', None))
-                values[i] = values[i].replace('"', '').replace("'", '').replace('[', '').replace(']', '')
-                values[i] = values[i].replace('None', '?')
-                if header[i]['name']=='Genomic Coordinate':                    
-                    components = values[i].split(' ')
-                    components[1] = str(int(components[1]) + 1)
-                    values[i] = ' '.join(components)
-                    values[i] = values[i].replace(' ', '_')
-                else:
-                    if type_map.get(header[i]['id'], 'String').startswith('Float'):
-                        try:
-                            values[i] = str(float(values[i]))
-                        except ValueError:
-                            values[i] = str(values[i])
-                    if type_map.get(header[i]['id'], 'String').startswith('Integer'):
-                        try:
-                            values[i] = int(float(values[i]))
-                        except ValueError:
-                            values[i] = str(values[i])
-
-                if isinstance(values[i], basestring) and values[i] != '<em>n/a</em>':
-                    values[i] = html.escape(values[i])
-
-                if urls:
-                    links = []
-                    for value, url in urls.iteritems():
-                        links.append('<a target="_blank" href="' + url + '">' + value + '</a>')
-                    values[i] = ', '.join(links)
-                
-                if values[i]==0:
-                    values[i] = '0'
-                elif not values[i] or values[i]=='null' or values[i]=='<em>n/a</em>': 
-                    values[i] = '?'
+
+            values = [f(v) for f, v in zip(formatters, values)]
 
             objects.append({
                 'pk': pk,
@@ -238,7 +354,14 @@ class PreviewResource(BaseResource, PaginatorResource):
         resp = self.get_page_response(request, paginator, page)
 
         path = reverse('serrano:data:preview')
-        links = self.get_page_links(request, path, page, extra=params)
+
+        if use_keyset:
+            next_after = get_next_cursor(queryset, keyset, limit)
+            links = self.get_cursor_links(request, path, limit, after,
+                                          next_after, extra=params)
+            resp['after'] = next_after
+        else:
+            links = self.get_page_links(request, path, page, extra=params)
 
         resp.update({
             'keys': header,
@@ -0,0 +1,194 @@
+"""In-memory search indexes over the value labels of fields.
+
+Autocomplete on large catalog fields (e.g. genes or transcripts) runs a
+search on every keystroke. Rather than an icontains scan of the table per
+request, each process builds a `ValueIndex` of the field's labels, or of
+its search field if it has one, the first time it is searched and keeps the
+most recently used indexes. The indexes are keyed like the cached value
+lists, so they are rebuilt when the field's data_modified changes.
+
+Only context-unaware searches of fields with a bounded number of values are
+indexed; other searches query the database.
+"""
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from django.core.cache import cache
+from django.utils.encoding import smart_unicode
+from serrano.conf import settings
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+class ValueIndex(object):
+    """Prefix and substring index of the labels of a value list.
+
+    Prefix matches are found by bisecting the sorted texts. Substring
+    matches of three or more characters intersect the posting lists of the
+    query's trigrams and only the remaining candidates are compared.
+    Shorter substrings are matched by scanning the texts.
+
+    Each item is a (value, label) pair, or a (value, label, text) triple if
+    a separate search text is indexed in place of the label. A value may
+    have several search texts.
+    """
+    def __init__(self, items):
+        self.values = []
+        self.labels = []
+        self.value_labels = {}
+        self.label_values = {}
+
+        # Indexed texts and the position of the value of each text
+        self.texts = []
+        self.owners = []
+
+        positions = {}
+
+        for item in items:
+            value, label = item[0], smart_unicode(item[1])
+            text = smart_unicode(item[2]) if len(item) > 2 else label
+
+            if value not in positions:
+                positions[value] = len(self.values)
+                self.values.append(value)
+                self.labels.append(label)
+                self.value_labels[value] = label
+                self.label_values.setdefault(label, value)
+
+            self.texts.append(text)
+            self.owners.append(positions[value])
+
+        self.folded = [t.lower() for t in self.texts]
+        self.sorted = sorted((text, i) for i, text in enumerate(self.folded))
+        self.keys = [k for k, _ in self.sorted]
+
+        self.postings = {}
+
+        for i, text in enumerate(self.folded):
+            for gram in trigrams(text):
+                self.postings.setdefault(gram, []).append(i)
+
+    def __len__(self):
+        return len(self.values)
+
+    def prefix(self, query):
+        "Returns the positions of texts starting with `query`."
+        query = query.lower()
+        positions = []
+
+        for i in xrange(bisect_left(self.keys, query), len(self.keys)):
+            if not self.keys[i].startswith(query):
+                break
+            positions.append(self.sorted[i][1])
+
+        return positions
+
+    def contains(self, query):
+        "Returns the positions of texts containing `query`, in order."
+        query = query.lower()
+
+        if len(query) < 3:
+            return [i for i, text in enumerate(self.folded) if query in text]
+
+        postings = [self.postings.get(gram, ()) for gram in trigrams(query)]
+        postings.sort(key=len)
+
+        candidates = set(postings[0])
+
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+
+            if not candidates:
+                break
+
+        return [i for i in sorted(candidates) if query in self.folded[i]]
+
+    def search(self, query, limit=None):
+        """Returns the value/label pairs whose text contains `query`.
+
+        Texts starting with the query are ranked first. If `limit` is
+        given, only the top `limit` matches are returned.
+        """
+        owners = []
+        seen = set()
+
+        def add(positions):
+            for i in positions:
+                owner = self.owners[i]
+
+                if owner not in seen:
+                    seen.add(owner)
+                    owners.append(owner)
+
+        add(self.prefix(query))
+
+        if limit is None or len(owners) < limit:
+            add(self.contains(query))
+
+        if limit is not None:
+            owners = owners[:limit]
+
+        return [(self.values[i], self.labels[i]) for i in owners]
+
+
+def index_allowed(key, count):
+    """Returns True if the values cached under `key` may be indexed.
+
+    `count` is called to get the number of distinct values, which is
+    cached like the value lists. Fields with more than
+    FIELD_SEARCH_INDEX_MAX_LENGTH values are searched in the database so
+    the memory used per process stays bounded.
+    """
+    max_length = settings.FIELD_SEARCH_INDEX_MAX_LENGTH
+
+    if max_length is None:
+        return True
+
+    size_key = key + ':size'
+    size = cache.get(size_key)
+
+    if size is None:
+        size = count()
+        cache.set(size_key, size, settings.FIELD_VALUES_CACHE_TIMEOUT)
+
+    return size <= max_length
+
+
+def get_value_index(key, build):
+    """Returns the index cached under `key`, creating it from the items
+    returned by `build` if necessary.
+
+    Only the FIELD_SEARCH_INDEX_SIZE most recently used indexes are kept.
+    """
+    with _lock:
+        index = _indexes.pop(key, None)
+
+        if index is not None:
+            _indexes[key] = index
+            return index
+
+    index = ValueIndex(build())
+
+    with _lock:
+        _indexes[key] = index
+
+        while len(_indexes) > settings.FIELD_SEARCH_INDEX_SIZE:
+            _indexes.popitem(last=False)
+
+    return index
+
+
+def peek_value_index(key):
+    "Returns the index cached under `key` or None, without building it."
+    with _lock:
+        return _indexes.get(key)
+
+
+def clear_value_indexes():
+    with _lock:
+        _indexes.clear()
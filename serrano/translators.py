@@ -0,0 +1,77 @@
+from avocado.query.translators import Translator, registry
+from serrano.models import RegionSet, ValueSet
+from serrano.regions import REGION_LIST, region_set_condition
+from serrano.valuesets import IN_SET, value_set_condition
+
+
+class SerranoTranslator(Translator):
+    """Adds the operators of serrano-specific filters to the default
+    translator. Conditions with any other operator are translated as usual.
+    """
+    def _get_set(self, field, operator, value):
+        model = RegionSet if operator == REGION_LIST else ValueSet
+
+        try:
+            return model.objects.get(pk=int(value))
+        except (TypeError, ValueError, model.DoesNotExist):
+            raise ValueError('Invalid {0} for field {1}'
+                             .format(model._meta.verbose_name, field))
+
+    def _set_condition(self, field, operator, value, tree):
+        instance = self._get_set(field, operator, value)
+
+        if operator == REGION_LIST:
+            return region_set_condition(instance, field.model_version_id,
+                                        tree)
+
+        return value_set_condition(instance, field, tree)
+
+    def validate(self, field, operator, value, tree, **context):
+        if operator in (REGION_LIST, IN_SET):
+            self._get_set(field, operator, value)
+            return operator, value
+
+        return super(SerranoTranslator, self).validate(
+            field, operator, value, tree, **context)
+
+    def translate(self, field, roperator, rvalue, tree, **context):
+        if roperator not in (REGION_LIST, IN_SET):
+            return super(SerranoTranslator, self).translate(
+                field, roperator, rvalue, tree, **context)
+
+        return {
+            'id': field.pk,
+            'operator': roperator,
+            'value': rvalue,
+            'cleaned_data': {
+                'operator': roperator,
+                'value': int(rvalue),
+            },
+            'query_modifiers': {
+                'condition': self._set_condition(field, roperator,
+                                                 rvalue, tree),
+                'annotations': None,
+                'extra': None,
+            }
+        }
+
+    def language(self, field, operator, value, **context):
+        if operator not in (REGION_LIST, IN_SET):
+            return super(SerranoTranslator, self).language(
+                field, operator, value, **context)
+
+        instance = self._get_set(field, operator, value)
+
+        if operator == REGION_LIST:
+            text = u'Coordinate overlaps with {0}'.format(instance)
+        else:
+            text = u'{0} is in a list of {1}'.format(field, instance)
+
+        return {
+            'id': field.pk,
+            'operator': operator,
+            'language': text,
+        }
+
+
+registry.register(SerranoTranslator, default=True)
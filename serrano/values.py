@@ -0,0 +1,117 @@
+"""Cached value lists of fields.
+
+Listing the values of a field is a DISTINCT scan over its column, which is
+slow on large tables and repeated every time a filter is opened. The
+value/label list is cached per field, query processor and, for
+context-aware lists, context and owner (the user or session the processor
+scoped the list to). Keys include the field's `data_modified` so
+loading new data invalidates the lists without an explicit flush.
+
+Random example values are drawn from an in-memory index or cached value
+list of the field if there is one, otherwise by seeking random primary keys.
+"""
+import json
+import random
+import hashlib
+from django.core.cache import cache
+from django.db.models import Min, Max
+from serrano.conf import settings
+
+VALUES_CACHE_KEY = 'serrano:field_values:{0}:{1}:{2}:{3}:{4}'
+
+
+def context_fingerprint(context):
+    "Returns a digest of the filters of `context` or '' if there is none."
+    if context is None or not context.json:
+        return ''
+
+    canonical = json.dumps(context.json, sort_keys=True,
+                           separators=(',', ':'))
+    return hashlib.sha1(canonical).hexdigest()
+
+
+def values_cache_key(instance, processor='default', context=None,
+                     owner=None):
+    """Returns the cache key of the value list of the field `instance`.
+
+    Query processors may filter by the requesting user, so context-aware
+    lists are also keyed by the `owner` of the request, as returned by
+    `serrano.exports.export_owner`.
+    """
+    data_modified = instance.data_modified.isoformat() \
+        if instance.data_modified else ''
+
+    if context is None or not context.json:
+        owner = None
+
+    return VALUES_CACHE_KEY.format(instance.pk, data_modified, processor,
+                                   context_fingerprint(context), owner or '')
+
+
+def get_cached_values(key, build):
+    """Returns the value list cached under `key`, calling `build` to create
+    it if it is not cached.
+
+    Lists longer than FIELD_VALUES_CACHE_MAX_LENGTH are not cached.
+    """
+    if settings.FIELD_VALUES_CACHE_TIMEOUT == 0:
+        return build()
+
+    values = cache.get(key)
+
+    if values is None:
+        values = build()
+        max_length = settings.FIELD_VALUES_CACHE_MAX_LENGTH
+
+        if max_length is None or len(values) <= max_length:
+            cache.set(key, values, settings.FIELD_VALUES_CACHE_TIMEOUT)
+
+    return values
+
+
+def peek_cached_values(key):
+    "Returns the value list cached under `key` or None, without building it."
+    if settings.FIELD_VALUES_CACHE_TIMEOUT == 0:
+        return None
+
+    return cache.get(key)
+
+
+def sample_values(queryset, field_name, size, attempts=3):
+    """Returns up to `size` distinct random values of `field_name`.
+
+    Rather than sorting the table randomly, random primary keys are drawn
+    between the smallest and largest key and the first row at or after
+    each is read, which is an index seek per draw. At most `attempts` draws
+    are made per requested value, so fewer values are returned for small
+    or sparse populations.
+
+    The draws are of rows, not distinct values: a value is drawn in
+    proportion to its number of rows and to the key gaps preceding them, so
+    common values are over-represented and rare values may not be drawn at
+    all. Prefer sampling a cached value list or index when there is one.
+    """
+    pk = queryset.model._meta.pk
+    bounds = queryset.aggregate(low=Min(pk.name), high=Max(pk.name))
+
+    if bounds['low'] is None or not isinstance(bounds['low'], (int, long)):
+        return []
+
+    queryset = queryset.exclude(**{'{0}__isnull'.format(field_name): True})\
+        .order_by(pk.name).values_list(field_name, flat=True)
+
+    values = []
+    seen = set()
+
+    for i in xrange(size * attempts):
+        key = random.randint(bounds['low'], bounds['high'])
+        rows = list(queryset.filter(**{'{0}__gte'.format(pk.name): key})[:1])
+
+        if rows and rows[0] not in seen:
+            seen.add(rows[0])
+            values.append(rows[0])
+
+            if len(values) == size:
+                break
+
+    return values
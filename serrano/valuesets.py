@@ -0,0 +1,91 @@
+"""Server-side value sets for large `in` filters.
+
+Pasting thousands of values (e.g. a gene panel) into an `in` filter
+inlines every value in the saved context json and in the query. Instead,
+the values are stored once as a `ValueSet` shared by all users, the
+context references the set by id and the filter is applied as a semi-join
+against the indexed set items.
+"""
+import json
+import hashlib
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from serrano.models import ValueSet, ValueSetItem
+
+IN_SET = 'in-set'
+
+# Number of values inserted per statement
+VALUE_BATCH_SIZE = 1000
+
+INTEGER_TYPES = ('AutoField', 'IntegerField', 'BigIntegerField',
+                 'SmallIntegerField', 'PositiveIntegerField',
+                 'PositiveSmallIntegerField')
+
+
+def unique_values(values):
+    "Returns the distinct values in the order they were first given."
+    seen = set()
+    unique = []
+
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            unique.append(value)
+
+    return unique
+
+
+def values_digest(values):
+    return hashlib.sha1(json.dumps(sorted(values), separators=(',', ':')))\
+        .hexdigest()
+
+
+def get_value_set(values):
+    "Returns the value set of `values`, creating it if necessary."
+    values = unique_values([unicode(value) for value in values])
+    digest = values_digest(values)
+
+    try:
+        return ValueSet.objects.get(digest=digest)
+    except ValueSet.DoesNotExist:
+        pass
+
+    try:
+        with transaction.commit_on_success():
+            value_set = ValueSet(digest=digest, count=len(values))
+            value_set.save()
+
+            ValueSetItem.objects.bulk_create(
+                [ValueSetItem(value_set=value_set, value=value)
+                 for value in values],
+                batch_size=VALUE_BATCH_SIZE)
+    except IntegrityError:
+        # Created concurrently by another request
+        return ValueSet.objects.get(digest=digest)
+
+    return value_set
+
+
+def value_set_condition(value_set, field, tree):
+    """Returns the condition matching records whose `field` value is in
+    `value_set`.
+    """
+    subquery = ValueSetItem.objects.filter(value_set=value_set)
+    model_field = field.field
+
+    if model_field.rel:
+        model_field = model_field.rel.get_related_field()
+
+    # Values are stored as text, so they are cast for integer columns such
+    # as sample ids.
+    if model_field.get_internal_type() in INTEGER_TYPES:
+        subquery = subquery.extra(
+            select={'int_value': 'CAST(value AS INTEGER)'})\
+            .values('int_value')
+    else:
+        subquery = subquery.values('value')
+
+    lookup = tree.query_string_for_field(field.field, operator='in',
+                                         model=field.model)
+
+    return Q(**{lookup: subquery})
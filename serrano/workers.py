@@ -0,0 +1,75 @@
+"""Bounded pools of background worker threads.
+
+Work that is too long-running for a request (e.g. exporting a whole table)
+is submitted to a named pool. Each pool starts its threads lazily and runs
+at most `size` tasks concurrently; further tasks wait in the queue.
+"""
+import logging
+import threading
+from Queue import Queue
+from django.db import connections
+
+log = logging.getLogger(__name__)
+
+_pools = {}
+_lock = threading.Lock()
+
+
+class WorkerPool(object):
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(1, int(size))
+        self.queue = Queue()
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(
+                    target=self._work,
+                    name='serrano-{0}-{1}'.format(self.name,
+                                                  len(self.threads)))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                log.exception('Task in the {0} worker pool failed'
+                              .format(self.name))
+            finally:
+                # Each thread holds its own database connection which must
+                # not be left open between tasks.
+                for connection in connections.all():
+                    connection.close()
+
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        "Queues `func` to be called with `args` and `kwargs`."
+        self._start()
+        self.queue.put((func, args, kwargs))
+
+    def join(self):
+        "Blocks until all queued tasks are done."
+        self.queue.join()
+
+
+def get_pool(name, size):
+    "Returns the worker pool named `name`, creating it if necessary."
+    pool = _pools.get(name)
+
+    if pool is None:
+        with _lock:
+            pool = _pools.get(name)
+
+            if pool is None:
+                pool = _pools[name] = WorkerPool(name, size)
+
+    return pool
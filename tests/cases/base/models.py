@@ -0,0 +1,9 @@
+from django.db import models
+
+
+class Variant(models.Model):
+    "Record with 0-based, half-open genomic coordinates."
+    chr = models.CharField(max_length=20)
+    start = models.IntegerField()
+    stop = models.IntegerField()
+    gene = models.CharField(max_length=20, blank=True)
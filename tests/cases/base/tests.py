@@ -1,11 +1,32 @@
 import time
+import random
+from datetime import datetime, timedelta
+from django.db import connection
 from django.test import TestCase
+from django.utils.unittest import skipUnless
 from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from django.contrib.sessions.backends.file import SessionStore
+from django.http import HttpRequest
+from django.contrib.contenttypes.models import ContentType
 from restlib2.http import codes
+from avocado.history.models import Revision
+from avocado.models import DataContext, DataField
+from serrano.conf import dep_supported
+from serrano.composites import CompositeContextBuilder, collect_composites, \
+    collect_sets
+from serrano.models import RegionSet, ValueSet, ValueSetItem
+from serrano.genomic import MAX_POSITION, bin_from_range, \
+    overlapping_bin_ranges, bin_range_sql, bin_range_children
+from serrano.regions import REGION_LIST, parse_regions, merge_regions, \
+    get_region_set, RegionSetSubquery
+from serrano.search import ValueIndex
 from serrano.tokens import token_generator, generate_random_token
+from serrano.values import sample_values
+from serrano.valuesets import IN_SET, get_value_set
+from .models import Variant
 
 
 class TokenTestCase(TestCase):
@@ -111,3 +132,378 @@ class TokenBackendTestCase(TestCase):
         resp = self.client.get(reverse('serrano:root'),
                                HTTP_ACCEPT='application/json')
         self.assertEqual(resp.status_code, codes.unauthorized)
+
+
+class CompositeContextBuilderTestCase(TestCase):
+    def setUp(self):
+        self.request = HttpRequest()
+        self.request.session = SessionStore()
+        self.request.session.save()
+
+    def build(self):
+        builder = CompositeContextBuilder(self.request, 1)
+
+        chr_child = {'language': 'Chromosome equals', 'value': '1',
+                     'field': 1, 'operator': 'exact'}
+        start_child = {'language': 'Start in range', 'value': 10,
+                       'field': 2, 'operator': 'gt'}
+
+        ref, language = builder.add([chr_child, start_child], 'and')
+        self.assertEqual(language, 'Chromosome equals and Start in range')
+
+        parent = {'type': 'and', 'children': [{'composite': ref}]}
+        return builder, ref, parent
+
+    def test_flush(self):
+        builder, ref, parent = self.build()
+
+        # Identical composites share a reference
+        attrs = builder.pending[ref]
+        self.assertEqual(builder.add(attrs['children'], 'and')[0], ref)
+        self.assertEqual(len(builder.pending), 1)
+
+        ids = builder.flush()
+        resolved = builder.resolve(parent)
+
+        composite = DataContext.objects.get(pk=ids[ref])
+        self.assertEqual(resolved['children'][0]['composite'], composite.pk)
+        self.assertEqual(composite.keywords, 'composite')
+        self.assertEqual(composite.json['type'], 'and')
+
+    def test_reuse(self):
+        builder, ref, parent = self.build()
+        first = builder.flush()[ref]
+        count = DataContext.objects.count()
+
+        # Building the same tree again reuses the existing composite
+        builder, ref, parent = self.build()
+        self.assertEqual(builder.flush()[ref], first)
+        self.assertEqual(DataContext.objects.count(), count)
+
+    def build_nested(self):
+        builder, ref, parent = self.build()
+        top, language = builder.add([{'composite': ref,
+                                      'language': 'Chromosome equals'}], 'or')
+        return builder, ref, top
+
+    def test_reuse_missing_child(self):
+        builder, ref, top = self.build_nested()
+        ids = builder.flush()
+        DataContext.objects.filter(pk=ids[ref]).delete()
+
+        # A composite whose child was collected is not reused
+        builder, ref, top = self.build_nested()
+        ids = builder.flush()
+        composite = DataContext.objects.get(pk=ids[top])
+        self.assertEqual(composite.json['children'][0]['composite'], ids[ref])
+        self.assertTrue(DataContext.objects.filter(pk=ids[ref]).exists())
+
+
+class CollectCompositesTestCase(TestCase):
+    def composite(self, attrs=None):
+        instance = DataContext(keywords='composite', json=attrs or {})
+        instance.save()
+        return instance
+
+    def test_collect(self):
+        b = self.composite()
+        a = self.composite({'type': 'and', 'children': [{'composite': b.pk}]})
+        orphan = self.composite()
+        DataContext(json={'children': [{'composite': a.pk}]}).save()
+
+        DataContext.objects.filter(pk__in=[a.pk, b.pk, orphan.pk])\
+            .update(modified=datetime.now() - timedelta(days=1))
+
+        # Recently modified composites are kept
+        young = self.composite()
+
+        deleted, reclaimed = collect_composites(dry_run=True)
+        self.assertEqual(deleted, 1)
+        self.assertTrue(DataContext.objects.filter(pk=orphan.pk).exists())
+
+        deleted, reclaimed = collect_composites()
+        self.assertEqual(deleted, 1)
+        self.assertFalse(DataContext.objects.filter(pk=orphan.pk).exists())
+        self.assertEqual(DataContext.objects.filter(
+            pk__in=[a.pk, b.pk, young.pk]).count(), 3)
+
+    def test_collect_revisions(self):
+        composite = self.composite()
+        context = DataContext(json={'children': [{'composite': composite.pk}]})
+        context.save()
+
+        # Only a stored revision still refers to the composite
+        Revision.objects.create(content_type=ContentType.objects
+                                .get_for_model(DataContext),
+                                object_id=context.pk,
+                                data={'json': context.json})
+        context.json = {}
+        context.save()
+
+        DataContext.objects.filter(pk=composite.pk)\
+            .update(modified=datetime.now() - timedelta(days=1))
+
+        deleted, reclaimed = collect_composites()
+        self.assertEqual(deleted, 0)
+        self.assertTrue(DataContext.objects.filter(pk=composite.pk).exists())
+
+    def test_collect_sets(self):
+        kept = get_value_set(['BRCA1', 'BRCA2'])
+        nested = get_region_set(parse_regions('chr1 150 1100'))
+        orphan = get_value_set(['TP53'])
+
+        composite = self.composite({'operator': REGION_LIST,
+                                    'value': nested.pk})
+        DataContext(json={'children': [
+            {'operator': IN_SET, 'value': kept.pk},
+            {'composite': composite.pk},
+        ]}).save()
+
+        ValueSet.objects.update(created=datetime.now() - timedelta(days=1))
+        RegionSet.objects.update(created=datetime.now() - timedelta(days=1))
+
+        # Recently created sets are kept
+        young = get_value_set(['NF1'])
+
+        self.assertEqual(collect_sets(dry_run=True), (1, 0))
+        self.assertTrue(ValueSet.objects.filter(pk=orphan.pk).exists())
+
+        self.assertEqual(collect_sets(), (1, 0))
+        self.assertEqual(sorted(ValueSet.objects.values_list('pk', flat=True)),
+                         sorted([kept.pk, young.pk]))
+        self.assertFalse(ValueSetItem.objects.filter(value='TP53').exists())
+        self.assertTrue(RegionSet.objects.filter(pk=nested.pk).exists())
+
+    def test_collect_parents_first(self):
+        child = self.composite()
+        parent = self.composite({'type': 'and',
+                                 'children': [{'composite': child.pk}]})
+
+        DataContext.objects.filter(pk__in=[child.pk, parent.pk])\
+            .update(modified=datetime.now() - timedelta(days=1))
+
+        deleted, reclaimed = collect_composites(batch_size=1, max_batches=1)
+        self.assertEqual(deleted, 1)
+        self.assertFalse(DataContext.objects.filter(pk=parent.pk).exists())
+        self.assertTrue(DataContext.objects.filter(pk=child.pk).exists())
+
+
+class GenomicBinTestCase(TestCase):
+    def test_bin_from_range(self):
+        # Smallest 128kb bins start at 585
+        self.assertEqual(bin_from_range(0, 100), 585)
+        self.assertEqual(bin_from_range(131072, 131073), 586)
+        # Zero-length intervals are binned at their position
+        self.assertEqual(bin_from_range(1000, 1000), 585)
+        # Crossing a 128kb boundary moves up to the 1Mb bins
+        self.assertEqual(bin_from_range(131000, 132000), 73)
+        # Crossing a 64Mb boundary only fits the top bin
+        self.assertEqual(bin_from_range(60000000, 70000000), 0)
+
+        self.assertRaises(ValueError, bin_from_range, 0, MAX_POSITION + 1)
+
+    def test_overlapping_bin_ranges(self):
+        ranges = overlapping_bin_ranges(100000, 300000)
+        self.assertEqual(ranges, [(585, 587), (73, 73), (9, 9), (1, 1),
+                                  (0, 0)])
+
+        # Every record overlapping the region falls in one of the ranges
+        for start, end in [(0, 1), (99999, 100001), (250000, 2000000),
+                           (299999, 300000), (0, 100000000)]:
+            value = bin_from_range(start, end)
+            self.assertTrue(any(first <= value <= last
+                                for first, last in ranges))
+
+    def test_bin_range_sql(self):
+        self.assertEqual(bin_range_sql(0, 100),
+                         '(bin BETWEEN 585 AND 585 OR bin BETWEEN 73 AND 73 '
+                         'OR bin BETWEEN 9 AND 9 OR bin BETWEEN 1 AND 1 '
+                         'OR bin BETWEEN 0 AND 0 OR bin IS NULL)')
+
+    def test_bin_range_children(self):
+        children = bin_range_children(1, 2, 0, 100)
+        self.assertEqual([c['value'] for c in children],
+                         [[585, 585], [73, 73], [9, 9], [1, 1], [0, 0], True])
+        # Records loaded since the bins were indexed are not excluded
+        self.assertEqual(children[-1]['operator'], 'isnull')
+
+        self.assertRaises(ValueError, bin_range_children, 1, 2,
+                          MAX_POSITION + 1, MAX_POSITION + 2)
+
+
+class RegionListTestCase(TestCase):
+    def test_parse_regions(self):
+        regions = parse_regions('# panel\nchr1 99 200\n\nChrX:1,001-2,000\n')
+        self.assertEqual(regions, [('1', 99, 200), ('X', 1000, 2000)])
+        self.assertRaises(ValueError, parse_regions, '1:abc')
+
+    def test_merge_regions(self):
+        merged = merge_regions([('1', 500, 600), ('1', 100, 200),
+                                ('1', 200, 250), ('1', 150, 180),
+                                ('2', 100, 200)])
+        self.assertEqual(merged, [('1', 100, 250), ('1', 500, 600),
+                                  ('2', 100, 200)])
+
+    def test_apply(self):
+        for name in ('Chr', 'Start', 'Stop'):
+            DataField.objects.create(model_version_id=1, name=name,
+                                     app_name='base', model_name='variant',
+                                     field_name=name.lower())
+
+        a = Variant.objects.create(chr='1', start=100, stop=200)
+        b = Variant.objects.create(chr='1', start=1000, stop=2000)
+        Variant.objects.create(chr='1', start=5000, stop=5001)
+        Variant.objects.create(chr='2', start=150, stop=160)
+
+        region_set = get_region_set(parse_regions('chr1 150 1100'))
+
+        context = DataContext(json={
+            'field': DataField.objects.get(name='Chr').pk,
+            'operator': REGION_LIST,
+            'value': region_set.pk,
+        })
+
+        queryset = context.apply(queryset=Variant.objects.all(),
+                                 tree=Variant)
+        self.assertEqual(sorted(queryset.values_list('pk', flat=True)),
+                         [a.pk, b.pk])
+
+    def test_subquery(self):
+        a = Variant.objects.create(chr='1', start=100, stop=200)
+        Variant.objects.create(chr='1', start=5000, stop=5001)
+
+        region_set = get_region_set(parse_regions('chr1 150 1100'))
+        subquery = RegionSetSubquery(region_set, Variant, 'chr', 'start',
+                                     'stop')
+
+        # The subquery does not depend on the rows of the outer query
+        sql, params = subquery._as_sql(connection)
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+        self.assertEqual([row[0] for row in cursor.fetchall()], [a.pk])
+
+
+class ValueSetTestCase(TestCase):
+    def test_get_value_set(self):
+        value_set = get_value_set(['BRCA2', 'BRCA1', 'BRCA2', 'TP53'])
+        self.assertEqual(value_set.count, 3)
+        self.assertEqual(list(value_set.items.values_list('value', flat=True)),
+                         ['BRCA2', 'BRCA1', 'TP53'])
+
+        # The same values in any order share the set
+        self.assertEqual(get_value_set(['TP53', 'BRCA1', 'BRCA2']).pk,
+                         value_set.pk)
+        self.assertNotEqual(get_value_set(['TP53']).pk, value_set.pk)
+
+    def test_apply(self):
+        field = DataField.objects.create(name='Gene', app_name='base',
+                                         model_name='variant',
+                                         field_name='gene')
+
+        a = Variant.objects.create(chr='17', start=1, stop=2, gene='BRCA1')
+        Variant.objects.create(chr='17', start=3, stop=4, gene='NF1')
+        b = Variant.objects.create(chr='13', start=5, stop=6, gene='BRCA2')
+
+        value_set = get_value_set(['BRCA1', 'BRCA2', 'TP53'])
+
+        context = DataContext(json={
+            'field': field.pk,
+            'operator': IN_SET,
+            'value': value_set.pk,
+        })
+
+        queryset = context.apply(queryset=Variant.objects.all(),
+                                 tree=Variant)
+        self.assertEqual(sorted(queryset.values_list('pk', flat=True)),
+                         [a.pk, b.pk])
+
+
+class SampleValuesTestCase(TestCase):
+    def setUp(self):
+        random.seed(0)
+
+        genes = ['BRCA1', 'BRCA2', 'TP53', 'NF1', 'KRAS', 'EGFR']
+
+        for i, gene in enumerate(genes):
+            Variant.objects.create(chr='1', start=i, stop=i + 1, gene=gene)
+
+        # Rows without a value are not drawn
+        Variant.objects.create(chr='1', start=10, stop=11, gene='')
+        self.genes = set(genes)
+
+    def test_sample(self):
+        queryset = Variant.objects.exclude(gene='')
+
+        values = sample_values(queryset, 'gene', 3)
+        self.assertEqual(len(values), 3)
+        self.assertEqual(len(set(values)), 3)
+        self.assertTrue(set(values) <= self.genes)
+
+        # At most the population is returned
+        values = sample_values(queryset, 'gene', 10)
+        self.assertTrue(len(values) <= len(self.genes))
+        self.assertEqual(len(set(values)), len(values))
+        self.assertTrue(set(values) <= self.genes)
+
+    def test_sample_filtered(self):
+        queryset = Variant.objects.filter(gene__startswith='BRCA')
+
+        values = sample_values(queryset, 'gene', 5)
+        self.assertTrue(set(values) <= set(['BRCA1', 'BRCA2']))
+
+        self.assertEqual(sample_values(Variant.objects.none(), 'gene', 3),
+                         [])
+
+
+class ValueIndexTestCase(TestCase):
+    def setUp(self):
+        names = ['BRCA1', 'BRCA2', 'ABRAXAS1', 'TP53', 'TP53BP1', 'NBR1']
+        self.index = ValueIndex([(name, name) for name in names])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.search('tp5'),
+                         [('TP53', 'TP53'), ('TP53BP1', 'TP53BP1')])
+
+    def test_contains(self):
+        # Prefix matches are ranked before other substring matches
+        self.assertEqual([v for v, l in self.index.search('br')],
+                         ['BRCA1', 'BRCA2', 'ABRAXAS1', 'NBR1'])
+        self.assertEqual([v for v, l in self.index.search('bra')],
+                         ['ABRAXAS1'])
+        self.assertEqual([v for v, l in self.index.search('r1')],
+                         ['NBR1'])
+        self.assertEqual([v for v, l in self.index.search('bp1')],
+                         ['TP53BP1'])
+        self.assertEqual(self.index.search('xyz'), [])
+
+    def test_limit(self):
+        self.assertEqual(len(self.index.search('1', limit=2)), 2)
+
+    def test_search_texts(self):
+        # Values are searched by their search texts, e.g. gene aliases
+        index = ValueIndex([(1, 'BRCA1', 'BRCA1'), (1, 'BRCA1', 'RNF53'),
+                            (2, 'TP53', 'TP53'), (2, 'TP53', 'P53')])
+
+        self.assertEqual(index.search('rnf'), [(1, 'BRCA1')])
+        self.assertEqual(index.search('53'), [(1, 'BRCA1'), (2, 'TP53')])
+        self.assertEqual(index.values, [1, 2])
+
+
+@skipUnless(dep_supported('numpy'), 'NumPy is not installed')
+class NumpyKmeansTestCase(TestCase):
+    def test_find_outliers(self):
+        from serrano import kmeans
+
+        obs = [[float(i % 10)] for i in xrange(100)] + [[1000.0]]
+        self.assertEqual(list(kmeans.find_outliers(obs).nonzero()[0]), [100])
+        self.assertEqual(list(kmeans.find_outliers(obs, 'iqr').nonzero()[0]),
+                         [100])
+
+    def test_weighted_counts(self):
+        from serrano import kmeans
+
+        obs = [[0.0, 0.0], [0.1, 0.1], [10.0, 10.0], [10.1, 10.1]]
+        points, outliers = kmeans.weighted_counts(obs, [1, 2, 3, 4], k=2)
+
+        self.assertEqual(outliers, [])
+        self.assertEqual(sorted(p['count'] for p in points), [3, 7])
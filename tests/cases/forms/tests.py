@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 import logging
 import time
+from datetime import datetime, timedelta
 from django.contrib.sessions.backends.file import SessionStore
 from django.contrib.auth.models import User
 from django.core import mail, management
+from django.core.cache import cache
 from django.http import HttpRequest
 from django.test import TestCase
 from django.test.utils import override_settings
 from avocado.models import DataConcept, DataConceptField, DataContext, \
     DataField, DataView
+from avocado.query import pipeline
+from serrano import forms
+from serrano.counts import COUNT_TOKEN_KEY, run_context_count
 from serrano.forms import ContextForm, QueryForm, ViewForm
 from ...models import Employee, MockHandler
 
@@ -92,6 +97,104 @@ class ContextFormTestCase(BaseTestCase):
         instance = form.save()
         self.assertEqual(instance.count, expected_count)
 
+    @override_settings(SERRANO_ASYNC_CONTEXT_COUNT=True)
+    def test_async_count(self):
+        scheduled = []
+
+        def schedule(context_id, *args):
+            scheduled.append(context_id)
+
+        original = forms.schedule_context_count
+        forms.schedule_context_count = schedule
+
+        try:
+            form = ContextForm(self.request, {}, force_count=True)
+            self.assertTrue(form.is_valid())
+            instance = form.save()
+        finally:
+            forms.schedule_context_count = original
+
+        # The count is deferred to the worker
+        self.assertIsNone(instance.count)
+        self.assertEqual(scheduled, [instance.pk])
+
+    @override_settings(SERRANO_ASYNC_CONTEXT_COUNT=True)
+    def test_async_count_no_commit(self):
+        scheduled = []
+
+        def schedule(context_id, *args):
+            scheduled.append(context_id)
+
+        original = forms.schedule_context_count
+        forms.schedule_context_count = schedule
+
+        try:
+            form = ContextForm(self.request, {}, force_count=True)
+            self.assertTrue(form.is_valid())
+            instance = form.save(commit=False)
+        finally:
+            forms.schedule_context_count = original
+
+        # Nothing is scheduled for an unsaved context
+        self.assertIsNone(instance.pk)
+        self.assertEqual(scheduled, [])
+
+    def test_run_context_count(self):
+        instance = DataContext(json={'sync': False})
+        instance.save()
+
+        key = COUNT_TOKEN_KEY.format(instance.pk)
+        cache.set(key, 'token')
+
+        run_context_count(instance.pk, 'token', {'model_type': 'sample'},
+                          'default', Employee)
+
+        instance = DataContext.objects.get(pk=instance.pk)
+        self.assertEqual(instance.count, Employee.objects.count())
+        self.assertTrue(instance.json['sync'])
+        self.assertIsNone(cache.get(key))
+
+    def test_run_context_count_edited(self):
+        instance = DataContext(json={'sync': False})
+        instance.save()
+
+        # Edited after the count started
+        DataContext.objects.filter(pk=instance.pk)\
+            .update(modified=datetime.now() + timedelta(hours=1))
+
+        cache.set(COUNT_TOKEN_KEY.format(instance.pk), 'token')
+        run_context_count(instance.pk, 'token', {'model_type': 'sample'},
+                          'default', Employee)
+
+        instance = DataContext.objects.get(pk=instance.pk)
+        self.assertIsNone(instance.count)
+        self.assertFalse(instance.json['sync'])
+
+    def test_run_context_count_request(self):
+        user = User.objects.create_user(username='counter', password='pw')
+        instance = DataContext(json={'sync': False}, user=user)
+        instance.save()
+
+        users = []
+
+        class RequestProcessor(pipeline.QueryProcessor):
+            def get_queryset(self, *args, **kwargs):
+                users.append(kwargs['request'].user)
+                return super(RequestProcessor, self)\
+                    .get_queryset(*args, **kwargs)
+
+        pipeline.query_processors.register(RequestProcessor, 'request')
+
+        try:
+            cache.set(COUNT_TOKEN_KEY.format(instance.pk), 'token')
+            run_context_count(instance.pk, 'token', {'model_type': 'sample'},
+                              'request', Employee, user_id=user.pk)
+        finally:
+            pipeline.query_processors.unregister('request')
+
+        # The processor sees the user the context belongs to
+        self.assertEqual(users, [user])
+
     def test_no_commit(self):
         previous_context_count = DataContext.objects.count()
 
@@ -2,6 +2,7 @@ import json
 import time
 from django.contrib.auth.models import User
 from django.core import management
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.utils import override_settings
 from restlib2.http import codes
@@ -9,12 +10,17 @@ from avocado.history.models import Revision
 from avocado.models import DataField, DataView, DataContext
 from serrano.resources import API_VERSION
 from serrano.models import ApiToken
+from serrano.search import clear_value_indexes
 
 
 class BaseTestCase(TestCase):
     fixtures = ['test_data.json']
 
     def setUp(self):
+        # Cached value lists and counts must not leak between tests
+        cache.clear()
+        clear_value_indexes()
+
         management.call_command('avocado', 'init', 'tests', quiet=True,
                                 publish=False, concepts=False)
         DataField.objects.filter(
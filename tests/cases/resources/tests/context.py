@@ -1,6 +1,11 @@
 import json
+from django.test import TestCase
+from django.test.utils import override_settings
 from restlib2.http import codes
 from avocado.models import DataContext, DataField
+from serrano.models import RegionSet, ValueSet
+from serrano.resources.context import build_sample_child
+from serrano.valuesets import IN_SET
 from .base import AuthenticatedBaseTestCase
 
 
@@ -242,3 +247,72 @@ class ContextsRevisionsResourceTestCase(AuthenticatedBaseTestCase):
                                    HTTP_ACCEPT='application/json')
         self.assertEqual(response.status_code, codes.ok)
         self.assertEqual(len(json.loads(response.content)), 1)
+
+
+class RegionSetsResourceTestCase(AuthenticatedBaseTestCase):
+    def test_post(self):
+        regions = '\n'.join([
+            'track name=panel',
+            'chr1\t100\t200\tA',
+            'chr1\t150\t300\tB',
+            '2:1001-2000',
+        ])
+
+        response = self.client.post('/api/contexts/regions/',
+                                    json.dumps({'regions': regions}),
+                                    content_type='application/json',
+                                    HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.created)
+
+        data = json.loads(response.content)
+        self.assertEqual(data['submitted'], 3)
+        self.assertEqual(data['count'], 2)
+
+        region_set = RegionSet.objects.get(pk=data['id'])
+        self.assertEqual(region_set.max_length, 1000)
+        self.assertEqual(list(region_set.regions.values_list(
+            'chr', 'start', 'stop')), [('1', 100, 300), ('2', 1000, 2000)])
+
+        # The same regions reuse the set
+        response = self.client.post('/api/contexts/regions/',
+                                    json.dumps({'regions': regions}),
+                                    content_type='application/json',
+                                    HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['id'], region_set.pk)
+
+    def test_invalid(self):
+        response = self.client.post('/api/contexts/regions/',
+                                    json.dumps({'regions': 'chr1\tx\ty'}),
+                                    content_type='application/json',
+                                    HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.unprocessable_entity)
+
+
+class SampleChildTestCase(TestCase):
+    sample_field = {'id': 7}
+
+    @override_settings(SERRANO_VALUE_SET_MIN_SIZE=2)
+    def test_small_cohort(self):
+        child = build_sample_child(1, ['s1', 's2'], self.sample_field)
+
+        self.assertEqual(child['operator'], 'in')
+        self.assertEqual(child['value'], ['s1', 's2'])
+        self.assertEqual(child['field'], 7)
+        self.assertEqual(ValueSet.objects.count(), 0)
+
+    @override_settings(SERRANO_VALUE_SET_MIN_SIZE=2)
+    def test_large_cohort(self):
+        child = build_sample_child(1, [3, 1, 2, 3], self.sample_field)
+
+        self.assertEqual(child['operator'], IN_SET)
+        self.assertEqual(child['field'], 7)
+
+        value_set = ValueSet.objects.get(pk=child['value'])
+        self.assertEqual(value_set.count, 3)
+        self.assertEqual(sorted(value_set.items.values_list('value',
+                                                            flat=True)),
+                         ['1', '2', '3'])
+
+        # The same cohort reuses the set
+        child = build_sample_child(1, [1, 2, 3], self.sample_field)
+        self.assertEqual(child['value'], value_set.pk)
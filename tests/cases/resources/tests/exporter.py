@@ -1,8 +1,21 @@
+import os
 import json
-from django.test import TestCase
+import gzip
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from cStringIO import StringIO
+from django.contrib.auth.models import User
+from django.test import TestCase, RequestFactory
+from django.test.utils import override_settings
 from restlib2.http import codes
 from avocado.conf import OPTIONAL_DEPS
+from serrano.exports import parse_range, export_fingerprint, \
+    get_cached_export, store_export, evict_exports, compress_chunks, \
+    parallel_export_supported, maintain_export_jobs, job_request
+from serrano.models import ExportJob
 from serrano.resources import API_VERSION
+from serrano.resources.exporter import get_export_encoding
 
 
 class ExporterResourceTestCase(TestCase):
@@ -88,3 +101,168 @@ class ExporterResourceTestCase(TestCase):
     def test_export_bad_page_range(self):
         response = self.client.get('/api/data/export/csv/3...1/')
         self.assertEqual(response.status_code, codes.not_found)
+
+
+class ExportJobRangeTestCase(TestCase):
+    def test_parse_range(self):
+        self.assertEqual(parse_range(None, 100), None)
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-200', 100), (0, 99))
+
+        # Unsupported ranges fallback to the whole file
+        self.assertEqual(parse_range('bytes=0-9,20-29', 100), None)
+        self.assertEqual(parse_range('items=0-9', 100), None)
+
+    def test_unsatisfiable_range(self):
+        self.assertRaises(ValueError, parse_range, 'bytes=100-', 100)
+        self.assertRaises(ValueError, parse_range, 'bytes=20-10', 100)
+
+    def test_unknown_export_type(self):
+        response = self.client.post('/api/data/export/jobs/',
+                                    data=json.dumps({'export_type': 'bad'}),
+                                    content_type='application/json',
+                                    HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.unprocessable_entity)
+
+
+class ExportJobMaintenanceTestCase(TestCase):
+    def job(self, **kwargs):
+        job = ExportJob(model_version_id=1, export_type='csv', **kwargs)
+        job.save()
+        return job
+
+    def test_stale_jobs(self):
+        stale = self.job(status=ExportJob.RUNNING)
+        running = self.job(status=ExportJob.RUNNING)
+
+        ExportJob.objects.filter(pk=stale.pk)\
+            .update(modified=datetime.now() - timedelta(days=1))
+
+        maintain_export_jobs()
+
+        self.assertEqual(ExportJob.objects.get(pk=stale.pk).status,
+                         ExportJob.FAILED)
+        self.assertEqual(ExportJob.objects.get(pk=running.pk).status,
+                         ExportJob.RUNNING)
+
+    def test_expired_jobs(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        expired = self.job(status=ExportJob.DONE, path=path,
+                           finished=datetime.now() - timedelta(days=2))
+        done = self.job(status=ExportJob.DONE, finished=datetime.now())
+
+        maintain_export_jobs()
+
+        self.assertFalse(ExportJob.objects.filter(pk=expired.pk).exists())
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(ExportJob.objects.filter(pk=done.pk).exists())
+
+
+class ExportCacheTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_fingerprint(self):
+        a = export_fingerprint({'field': 1, 'operator': 'exact', 'value': 2},
+                               {'columns': [1, 2]}, 'csv', 'default', 1)
+        b = export_fingerprint({'value': 2, 'operator': 'exact', 'field': 1},
+                               {'columns': [1, 2]}, 'csv', 'default', 1)
+        c = export_fingerprint({'field': 1, 'operator': 'exact', 'value': 2},
+                               {'columns': [1, 2]}, 'json', 'default', 1)
+
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+        # Exports are not shared across users
+        d = export_fingerprint({'field': 1, 'operator': 'exact', 'value': 2},
+                               {'columns': [1, 2]}, 'csv', 'default', 1,
+                               owner='user:2')
+        self.assertNotEqual(a, d)
+
+    def test_store_and_evict(self):
+        with override_settings(SERRANO_EXPORT_CACHE_ROOT=self.root,
+                               SERRANO_EXPORT_CACHE_MAX_SIZE=10):
+            self.assertEqual(get_cached_export('a', 'csv'), None)
+
+            store_export('12345', 'a', 'csv')
+            path = get_cached_export('a', 'csv')
+            self.assertEqual(open(path).read(), '12345')
+
+            # Mark as least recently used
+            os.utime(path, (0, 0))
+
+            # Exceeds the limit, so the least recently used is removed
+            store_export('123456', 'b', 'csv')
+            self.assertEqual(get_cached_export('a', 'csv'), None)
+            self.assertTrue(get_cached_export('b', 'csv'))
+
+            self.assertEqual(evict_exports(0), 6)
+
+
+class ExportCompressionTestCase(TestCase):
+    def test_gzip_chunks(self):
+        chunks = ['chr\tpos\n'] + ['1\t{0}\n'.format(i) for i in range(1000)]
+        compressed = ''.join(compress_chunks(iter(chunks), 'gzip'))
+
+        self.assertTrue(len(compressed) < len(''.join(chunks)))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(),
+                         ''.join(chunks))
+
+    def test_export_encoding(self):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip')
+
+        self.assertEqual(get_export_encoding(request), (None, False))
+        self.assertEqual(get_export_encoding(request, 'true'), ('gzip', True))
+        self.assertRaises(ValueError, get_export_encoding, request, 'bad')
+
+        with override_settings(SERRANO_EXPORT_ACCEPT_ENCODING=True):
+            self.assertEqual(get_export_encoding(request), ('gzip', False))
+
+
+class ParallelExportTestCase(TestCase):
+    class Queryset(object):
+        def __init__(self, order_by):
+            self.query = type('query', (object,), {'order_by': order_by})()
+
+    def test_supported(self):
+        variant = {'model_type': 'catalog', 'record_type': 'variant'}
+        sample = {'model_type': 'sample', 'record_type': 'sample'}
+
+        with override_settings(SERRANO_EXPORT_PARALLEL_WORKERS=2):
+            self.assertTrue(parallel_export_supported(
+                'csv', variant, self.Queryset([])))
+
+            # Not line-oriented
+            self.assertFalse(parallel_export_supported(
+                'json', variant, self.Queryset([])))
+
+            # No chromosome to partition by
+            self.assertFalse(parallel_export_supported(
+                'csv', sample, self.Queryset([])))
+
+            # Ordered by the view
+            self.assertFalse(parallel_export_supported(
+                'csv', variant, self.Queryset(['-quality'])))
+
+        with override_settings(SERRANO_EXPORT_PARALLEL_WORKERS=0):
+            self.assertFalse(parallel_export_supported(
+                'csv', variant, self.Queryset([])))
+
+    def test_job_request(self):
+        user = User.objects.create_user(username='exporter', password='x')
+
+        # Partitions and jobs run as the user or session of the export
+        request = job_request(user.pk)
+        self.assertEqual(request.user, user)
+
+        request = job_request(session_key='abc')
+        self.assertFalse(request.user.is_authenticated())
+        self.assertEqual(request.session.session_key, 'abc')
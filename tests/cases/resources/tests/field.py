@@ -1,10 +1,19 @@
 import json
+from datetime import datetime
+from django.core.cache import cache
 from django.test.utils import override_settings
-from avocado.models import DataField
+from avocado.models import DataContext, DataField
 from avocado.events.models import Log
 from restlib2.http import codes
+from modeltree.tree import trees
+from serrano.aggregates import precompute_field, compute_distribution, \
+    get_precomputed_distribution
+from serrano.resources.field import FieldDistribution, \
+    FieldsDistribution
+from serrano.search import peek_value_index
+from serrano.values import values_cache_key
 from .base import BaseTestCase
-from tests.models import Title
+from tests.models import Employee, Title
 
 
 class FieldResourceTestCase(BaseTestCase):
@@ -123,6 +132,25 @@ class FieldResourceTestCase(BaseTestCase):
         self.assertFalse('previous' in data['_links'])
         self.assertFalse('next' in data['_links'])
 
+    def test_values_cached(self):
+        response = self.client.get('/api/fields/2/values/?limit=0',
+                                   HTTP_ACCEPT='application/json')
+        values = json.loads(response.content)['values']
+        self.assertTrue(values)
+
+        # The list is cached until the field's data is modified
+        Title.objects.all().delete()
+
+        response = self.client.get('/api/fields/2/values/?limit=0',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['values'], values)
+
+        DataField.objects.filter(pk=2).update(data_modified=datetime.now())
+
+        response = self.client.get('/api/fields/2/values/?limit=0',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['values'], [])
+
     def test_zero_division_error(self):
         # Delete everything for now
         Title.objects.all().delete()
@@ -140,6 +168,37 @@ class FieldResourceTestCase(BaseTestCase):
         self.assertEqual(response.status_code, codes.ok)
         self.assertEqual(len(json.loads(response.content)), 3)
 
+        # A cached value list is sampled rather than the rows
+        values = [{'label': 'A', 'value': 'a'}, {'label': 'B', 'value': 'b'},
+                  {'label': 'C', 'value': 'c'}]
+        cache.set(values_cache_key(DataField.objects.get(pk=2)), values)
+
+        response = self.client.get('/api/fields/2/values/?random=3',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(sorted(json.loads(response.content)), values)
+        cache.clear()
+
+        # The value lists of fields with allowed values hold values that are
+        # not in the data, so the rows are sampled instead.
+        names = set(Title.objects.values_list('name', flat=True))
+        field = DataField.objects.get(pk=2)
+        field.allowed_values = ['Astronaut', 'QA']
+        field.save()
+
+        response = self.client.get('/api/fields/2/values/',
+                                   HTTP_ACCEPT='application/json')
+        self.assertTrue({'label': 'Missing', 'value': 'Missing'} in
+                        json.loads(response.content)['values'])
+
+        response = self.client.get('/api/fields/2/values/?random=3',
+                                   HTTP_ACCEPT='application/json')
+        content = json.loads(response.content)
+        self.assertEqual(len(content), 3)
+        for item in content:
+            self.assertTrue(item['value'] in names)
+
+        cache.clear()
+
         # Even though we are requesting 3 values, the query processor should
         # limit the population to 1 value so make sure that the call returns
         # only that single value since all values in the population should be
@@ -174,6 +233,46 @@ class FieldResourceTestCase(BaseTestCase):
             {'label': 'QA', 'value': 'QA'},
         ])
 
+    def test_values_cache_key_owner(self):
+        instance = DataField.objects.get(pk=2)
+        context = DataContext(json={'field': 2, 'operator': 'exact',
+                                    'value': 'QA'})
+
+        # Lists of the same context are cached per user or session
+        self.assertNotEqual(
+            values_cache_key(instance, context=context, owner='user:1'),
+            values_cache_key(instance, context=context, owner='user:2'))
+
+        # Context-unaware lists are shared
+        self.assertEqual(values_cache_key(instance, owner='user:1'),
+                         values_cache_key(instance, owner='user:2'))
+
+    def test_values_query_index(self):
+        key = values_cache_key(DataField.objects.get(pk=2))
+
+        # Fields with too many values are searched in the database
+        with self.settings(SERRANO_FIELD_SEARCH_INDEX_MAX_LENGTH=1):
+            response = self.client.get('/api/fields/2/values/?query=qa',
+                                       HTTP_ACCEPT='application/json')
+            self.assertEqual(json.loads(response.content)['values'],
+                             [{'label': 'QA', 'value': 'QA'}])
+            self.assertIsNone(peek_value_index(key))
+
+        cache.clear()
+
+        # Context-aware searches are not indexed
+        response = self.client.get('/api/fields/2/values/?query=qa&aware=1',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['values'],
+                         [{'label': 'QA', 'value': 'QA'}])
+        self.assertIsNone(peek_value_index(key))
+
+        response = self.client.get('/api/fields/2/values/?query=qa',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['values'],
+                         [{'label': 'QA', 'value': 'QA'}])
+        self.assertTrue(peek_value_index(key))
+
     def test_values_validate(self):
         # Valid, single dict
         response = self.client.post(
@@ -190,6 +289,8 @@ class FieldResourceTestCase(BaseTestCase):
         })
         message = Log.objects.get(event='validate', object_id=2)
         self.assertEqual(message.data['count'], 1)
+        self.assertFalse(message.data['streamed'])
+        self.assertTrue('time' in message.data)
 
         # Invalid
         response = self.client.post(
@@ -239,6 +340,31 @@ class FieldResourceTestCase(BaseTestCase):
             HTTP_ACCEPT='application/json')
         self.assertEqual(response.status_code, codes.unprocessable_entity)
 
+    @override_settings(SERRANO_FIELD_VALIDATE_CHUNK_SIZE=2)
+    def test_values_validate_chunked(self):
+        response = self.client.post(
+            '/api/fields/2/values/',
+            data=json.dumps([
+                {'value': 'IT'},
+                {'label': 'Bartender'},
+                {'value': 'Programmer'}
+            ]),
+            content_type='application/json',
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        content = json.loads(''.join(response.streaming_content))
+        self.assertEqual(content, [
+            {'value': 'IT', 'label': 'IT', 'valid': True},
+            {'value': 'Bartender', 'label': 'Bartender', 'valid': False},
+            {'value': 'Programmer', 'label': 'Programmer', 'valid': True},
+        ])
+
+        message = Log.objects.get(event='validate', object_id=2)
+        self.assertEqual(message.data['count'], 3)
+        self.assertTrue(message.data['streamed'])
+        self.assertTrue('time' in message.data)
+
     def test_labels_validate(self):
         # Valid, single dict
         response = self.client.post(
@@ -323,6 +449,123 @@ class FieldResourceTestCase(BaseTestCase):
         self.assertEqual(stats['min'], '2000-01-01')
         self.assertEqual(stats['max'], '2010-01-01')
 
+    def test_bulk_stats(self):
+        # title.name, title.salary and project.due_date
+        response = self.client.get(
+            '/api/fields/stats/?fields=2&fields=3&fields=11',
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        stats = json.loads(response.content)
+        self.assertEqual(sorted(stats), ['11', '2', '3'])
+
+        self.assertTrue(stats['2']['count'])
+        self.assertEqual(stats['3']['min'], 10000)
+        self.assertEqual(stats['3']['max'], 200000)
+        self.assertAlmostEqual(stats['3']['avg'], 53571.42857, places=5)
+        self.assertEqual(stats['11']['min'], '2000-01-01')
+        self.assertEqual(stats['11']['max'], '2010-01-01')
+        self.assertTrue(
+            Log.objects.filter(event='stats', object_id=3).exists())
+
+        # Query processors apply to all fields
+        response = self.client.get(
+            '/api/fields/stats/?fields=3&processor=under_twenty_thousand',
+            HTTP_ACCEPT='application/json')
+        stats = json.loads(response.content)
+        self.assertEqual(stats['3']['max'], 15000)
+
+        response = self.client.get('/api/fields/stats/',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.unprocessable_entity)
+
+    def test_stats_precomputed(self):
+        # title.salary
+        instance = DataField.objects.get(pk=3)
+
+        # Fields without a data_modified timestamp are not precomputed
+        self.assertIsNone(precompute_field(instance, instance.model))
+
+        instance.data_modified = datetime(2020, 1, 1)
+        instance.save()
+        aggregate = precompute_field(instance, instance.model)
+
+        response = self.client.get('/api/fields/3/stats/',
+                                   HTTP_ACCEPT='application/json')
+        stats = json.loads(response.content)
+        self.assertEqual(stats['min'], 10000)
+        self.assertEqual(stats['max'], 200000)
+        self.assertFalse('percentiles' in stats)
+
+        # Percentiles are returned the same way by both paths
+        response = self.client.get('/api/fields/3/stats/?percentiles=1',
+                                   HTTP_ACCEPT='application/json')
+        precomputed = json.loads(response.content)['percentiles']
+        self.assertEqual(sorted(precomputed), ['25', '50', '75'])
+
+        response = self.client.get(
+            '/api/fields/3/stats/?percentiles=1&aware=1',
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['percentiles'],
+                         precomputed)
+
+        # Served from the stored aggregate
+        aggregate.stats = json.dumps({'min': 0})
+        aggregate.save()
+
+        response = self.client.get('/api/fields/3/stats/',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['min'], 0)
+
+        # Context-aware stats are always computed
+        response = self.client.get('/api/fields/3/stats/?aware=1',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['min'], 10000)
+
+        # Ignored once the data of the field is modified
+        instance.data_modified = datetime.now()
+        instance.save()
+
+        response = self.client.get('/api/fields/3/stats/',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['min'], 10000)
+
+    def test_dist_precomputed(self):
+        # title.name
+        instance = DataField.objects.get(pk=2)
+        instance.enumerable = True
+        instance.data_modified = datetime(2020, 1, 1)
+        instance.save()
+
+        tree = trees.default
+        aggregate = precompute_field(instance, tree)
+        queryset = tree.root_model.objects.all()
+
+        distribution = json.loads(json.dumps(
+            compute_distribution(instance, tree, queryset)))
+        self.assertEqual(get_precomputed_distribution(instance),
+                         distribution)
+        self.assertTrue(distribution['size'])
+
+        # Served from the stored aggregate
+        aggregate.distribution = json.dumps({
+            'data': [{'values': ['Stored'], 'count': 1}],
+            'clustered': False,
+            'outliers': [],
+            'size': 1,
+        })
+        aggregate.save()
+
+        response = self.client.get('/api/fields/2/dist/',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['data'],
+                         [{'values': ['Stored'], 'count': 1}])
+
+        # Not used for requests with other parameters
+        response = self.client.get('/api/fields/2/dist/?nulls=1',
+                                   HTTP_ACCEPT='application/json')
+        self.assertNotEqual(json.loads(response.content)['data'],
+                            [{'values': ['Stored'], 'count': 1}])
+
     def test_empty_stats(self):
         Title.objects.all().delete()
 
@@ -380,3 +623,106 @@ class FieldResourceTestCase(BaseTestCase):
                 u'values': [15000]
             }]
         })
+
+    def test_dist_batched(self):
+        # title.salary and title.name with title.salary
+        response = self.client.get('/api/fields/dist/?sets=3&sets=2,3',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        content = json.loads(response.content)
+        self.assertEqual([d['dimensions'] for d in content], [[3], [2, 3]])
+
+        salaries = dict((p['values'][0], p['count'])
+                        for p in content[0]['data'])
+        self.assertEqual(salaries, {15000: 3, 10000: 1, 20000: 1,
+                                    200000: 1})
+        self.assertEqual(content[0]['size'], 4)
+
+        self.assertTrue(content[1]['size'])
+        for point in content[1]['data']:
+            self.assertEqual(len(point['values']), 2)
+
+        # Unknown fields are ignored
+        response = self.client.get('/api/fields/dist/?sets=3,999',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)[0]['dimensions'], [3])
+
+        response = self.client.get('/api/fields/dist/',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.unprocessable_entity)
+
+    def test_dist_binned_alias(self):
+        # The queryset already joins title through another path, so the
+        # binned title.salary must use the alias of its own join.
+        queryset = Employee.objects.filter(office__employee__title__name='CEO')
+        fields = [DataField.objects.get(pk=3)]
+
+        dist = FieldDistribution().get_binned(None, queryset, fields,
+                                              ['title__salary'], 2)
+        self.assertEqual([(p['values'], p['count']) for p in dist['data']],
+                         [([10000.0], 5), ([105000.0], 1)])
+
+    def test_dist_grouping_sets(self):
+        resource = FieldsDistribution()
+        queryset = trees.default.root_model.objects.all()
+        sets = [['title__name', 'title__salary'], ['title__salary'],
+                ['title__salary', 'title__name']]
+
+        sql, params, indexes = resource.grouping_sets_sql(queryset, 'id',
+                                                          sets)
+        self.assertEqual(indexes, [[0, 1], [1], [1, 0]])
+
+        # The reordered set is grouped once
+        self.assertTrue(sql.endswith(
+            'GROUP BY GROUPING SETS (("c0", "c1"), ("c1"))'))
+        self.assertTrue(sql.startswith(
+            'SELECT "c0", "c1", COUNT(DISTINCT "pk"), '
+            'GROUPING("c0"), GROUPING("c1") FROM ('))
+
+        # Rows of (c0, c1, count, grouping(c0), grouping(c1))
+        rows = [
+            ('Analyst', 10000, 1, 0, 0),
+            ('Analyst', None, 2, 0, 0),
+            (None, 10000, 1, 1, 0),
+            (None, None, 3, 1, 1),
+        ]
+
+        points = resource.map_grouping_rows(rows, indexes, False)
+        self.assertEqual(points, [
+            [{'values': ['Analyst', 10000], 'count': 1}],
+            [{'values': [10000], 'count': 1}],
+            [{'values': [10000, 'Analyst'], 'count': 1}],
+        ])
+
+        points = resource.map_grouping_rows(rows, indexes, True)
+        self.assertEqual(points[2], [
+            {'values': [10000, 'Analyst'], 'count': 1},
+            {'values': [None, 'Analyst'], 'count': 2},
+        ])
+
+    def test_dist_binned(self):
+        # title.salary ranges from 10000 to 200000
+        response = self.client.get('/api/fields/3/dist/?bins=2',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertEqual(json.loads(response.content), {
+            u'size': 2,
+            u'bins': 2,
+            u'binned': True,
+            u'clustered': False,
+            u'outliers': [],
+            u'data': [{
+                u'count': 5,
+                u'values': [10000.0],
+                u'ranges': [[10000.0, 105000.0]],
+            }, {
+                u'count': 1,
+                u'values': [105000.0],
+                u'ranges': [[105000.0, 200000.0]],
+            }]
+        })
+
+        # Binning is only supported for numeric fields (title.name)
+        response = self.client.get('/api/fields/2/dist/?bins=2',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.unprocessable_entity)
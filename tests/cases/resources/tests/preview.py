@@ -2,7 +2,14 @@ import json
 from django.contrib.auth.models import User
 from django.test import TestCase
 from restlib2.http import codes
+from avocado.models import DataConcept, DataConceptField, DataField
+from serrano.resources.pagination import encode_cursor, decode_cursor, \
+    get_keyset, seek, get_next_cursor
+from serrano.resources.base import requires_unbounded_read, \
+    drop_order_only_columns
+from serrano.resources.preview import get_cell_formatters
 from .base import BaseTestCase
+from tests.models import Title
 
 
 class PreviewResourceProcessorTestCase(BaseTestCase):
@@ -85,3 +92,158 @@ class PreviewResourceTestCase(TestCase):
             'num_pages': 1,
             'limit': 20,
         })
+
+
+class PreviewCellFormatterTestCase(TestCase):
+    def format(self, header, type_map, values):
+        formatters = get_cell_formatters(header, type_map)
+        return [f(v) for f, v in zip(formatters, values)]
+
+    def test_types(self):
+        header = [
+            {'id': 1, 'name': 'Gene'},
+            {'id': 2, 'name': 'Quality'},
+            {'id': 3, 'name': 'Depth'},
+            {'id': 4, 'name': 'Genomic Coordinate'},
+        ]
+        type_map = {1: 'String', 2: 'Float', 3: 'Integer'}
+
+        self.assertEqual(
+            self.format(header, type_map, ['"BRCA1"', '1.50', '3.0', '1 99']),
+            ['BRCA1', '1.5', 3, '1_100'])
+
+    def test_missing(self):
+        header = [
+            {'id': 1, 'name': 'Gene'},
+            {'id': 2, 'name': 'Depth'},
+            {'id': 3, 'name': 'Gene'},
+        ]
+        type_map = {2: 'Integer'}
+
+        self.assertEqual(
+            self.format(header, type_map, ['None', '0', '<em>n/a</em>']),
+            ['?', '0', '?'])
+
+    def test_escape(self):
+        header = [{'id': 1, 'name': 'Note'}]
+        self.assertEqual(self.format(header, {}, ['a & b']), ['a &amp; b'])
+
+    def test_url_template(self):
+        header = [{'id': 1, 'name': 'dbSNP', 'url_temp': 'http://x/?id=$$'}]
+
+        self.assertEqual(
+            self.format(header, {}, ['rs123']),
+            ['<a target="_blank" href="http://x/?id=rs123">rs123</a>'])
+
+        # Missing values are not linked
+        self.assertEqual(self.format(header, {}, ['None']), ['?'])
+
+
+class KeysetPaginationTestCase(TestCase):
+    def test_cursor(self):
+        values = ['X', 1000, 1001, 'A/T']
+        token = encode_cursor(values)
+
+        self.assertFalse('=' in token)
+        self.assertEqual(decode_cursor(token), values)
+
+    def test_invalid_cursor(self):
+        self.assertRaises(ValueError, decode_cursor, 'not a cursor')
+        self.assertRaises(ValueError, decode_cursor, encode_cursor({'a': 1}))
+
+    def test_keyset(self):
+        self.assertEqual(get_keyset({'model_type': 'sample'}), ['id'])
+        self.assertEqual(get_keyset({'model_type': 'project'}), None)
+        self.assertEqual(get_keyset({
+            'model_type': 'catalog',
+            'record_type': 'variant',
+        }), ['chr', 'pos_start', 'pos_stop', 'ref_alts'])
+        self.assertEqual(get_keyset({
+            'model_type': 'catalog',
+            'record_type': 'region',
+            'keys': [{'symbol': 'gene'}],
+        }), ['chr', 'pos_start', 'pos_stop', 'gene'])
+
+    def test_seek(self):
+        for salary in [20000, None, 10000, 20000, None, 15000]:
+            Title.objects.create(name='Title', salary=salary)
+
+        queryset = Title.objects.order_by('salary', 'id')
+        expected = list(queryset.values_list('pk', flat=True))
+
+        # Rows with NULL keys are paged like any other row
+        for keys in (['id'], ['salary', 'id']):
+            queryset = Title.objects.order_by(*keys)
+            pks = []
+            after = None
+
+            while True:
+                page = seek(queryset, keys, decode_cursor(after)) \
+                    if after else queryset
+                pks.extend(page[:2].values_list('pk', flat=True))
+
+                after = get_next_cursor(page, keys, 2)
+                if after is None:
+                    break
+
+            self.assertEqual(pks, list(queryset.values_list('pk',
+                                                            flat=True)))
+
+        self.assertEqual(pks, expected)
+
+        # A cursor of NULLs
+        nulls = Title.objects.filter(salary__isnull=True).order_by('id')
+        last = nulls.reverse()[0]
+        self.assertEqual(list(seek(nulls, ['salary', 'id'],
+                                   [None, last.pk])), [])
+
+
+class OrderOnlyColumnsTestCase(TestCase):
+    fixtures = ['test_data.json']
+
+    class ViewNode(object):
+        "Parsed view of a visible concept ordered by a hidden one."
+        def __init__(self, visible, hidden):
+            self.visible = visible
+            self.facets = [{'concept': visible.pk},
+                           {'concept': hidden.pk, 'visible': False}]
+
+        def get_concepts_for_select(self):
+            return [self.visible]
+
+    def concept(self, field_name):
+        # Fields of generated models are named by their table
+        field = DataField.objects.create(name=field_name, model_version_id=1,
+                                         app_name='tests',
+                                         model_name='tests_title',
+                                         field_name=field_name)
+        concept = DataConcept.objects.create(name=field_name,
+                                             model_version_id=1)
+        DataConceptField.objects.create(concept=concept, field=field)
+        return concept
+
+    def test_drop_order_only_columns(self):
+        view_node = self.ViewNode(self.concept('name'),
+                                  self.concept('salary'))
+
+        queryset = Title.objects.values_list('name', 'salary')\
+            .order_by('-salary', 'name').distinct()
+
+        self.assertTrue(requires_unbounded_read(queryset, view_node, 1,
+                                                limit=2, offset=1))
+
+        drop_order_only_columns(queryset, view_node, 1)
+        self.assertEqual([tuple(s) for s in queryset.query.select],
+                         [('tests_title', 'name')])
+
+        # The bounds are applied by the query and the hidden column still
+        # orders the rows.
+        self.assertFalse(requires_unbounded_read(queryset, view_node, 1,
+                                                 limit=2, offset=1))
+
+        page = queryset[1:3]
+        self.assertTrue('LIMIT' in str(page.query))
+        self.assertEqual(list(page), [('Lawyer',), ('Analyst',)])
+
+        # Nothing to bound
+        self.assertFalse(requires_unbounded_read(queryset, view_node, 1))